@@ -2,16 +2,19 @@ from fastapi import APIRouter, HTTPException, Query
 from pydantic import BaseModel
 from typing import List, Optional
 import database
+import queries
 import json
 import search
 import json
 import search
-import integrity
 import json
 import search
-import integrity
 import security
 import retention_worker
+import org_resolver
+import hold_index
+import audit_chain
+import audit_writer
 
 router = APIRouter()
 
@@ -68,8 +71,7 @@ class LegalHoldCreate(BaseModel):
 
 @router.get("/organizations", response_model=List[OrganizationResponse])
 async def list_organizations():
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         rows = await conn.fetch("SELECT id, name, slug, domains, timestamp_placeholder as created_at FROM organizations ORDER BY id ASC".replace('timestamp_placeholder', 'created_at'))
         return [
             OrganizationResponse(
@@ -80,13 +82,10 @@ async def list_organizations():
                 created_at=str(r['created_at'])
             ) for r in rows
         ]
-    finally:
-        await conn.close()
 
 @router.post("/organizations", response_model=OrganizationResponse)
 async def create_organization(org: OrganizationCreate):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         exists = await conn.fetchval("SELECT 1 FROM organizations WHERE slug = $1", org.slug)
         if exists:
             raise HTTPException(status_code=400, detail="Organization slug already exists")
@@ -95,6 +94,8 @@ async def create_organization(org: OrganizationCreate):
             "INSERT INTO organizations (name, slug, domains) VALUES ($1, $2, $3) RETURNING id, name, slug, domains, created_at",
             org.name, org.slug, org.domains
         )
+        # Refresh now for read-your-writes; other processes reload via NOTIFY
+        await org_resolver.refresh()
         return OrganizationResponse(
             id=row['id'],
             name=row['name'],
@@ -102,13 +103,10 @@ async def create_organization(org: OrganizationCreate):
             domains=row['domains'] if row['domains'] else [],
             created_at=str(row['created_at'])
         )
-    finally:
-        await conn.close()
 
 @router.delete("/organizations/{org_id}")
 async def delete_organization(org_id: int):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         # Check if exists
         exists = await conn.fetchval("SELECT 1 FROM organizations WHERE id = $1", org_id)
         if not exists:
@@ -124,17 +122,16 @@ async def delete_organization(org_id: int):
         await conn.execute("DELETE FROM sidecar_agents WHERE org_id = $1", org_id)
         await conn.execute("DELETE FROM users WHERE org_id = $1", org_id)
         await conn.execute("DELETE FROM organizations WHERE id = $1", org_id)
+        await org_resolver.refresh()
+        await hold_index.org_dropped(conn, org_id)
         
         return {"status": "deleted"}
-    finally:
-        await conn.close()
 
 # --- User Management ---
 
 @router.get("/users", response_model=List[UserResponse])
 async def list_users(org_id: Optional[int] = Query(None)):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         query = "SELECT id, username, role, org_id, domains FROM users"
         params = []
         if org_id:
@@ -157,13 +154,10 @@ async def list_users(org_id: Optional[int] = Query(None)):
                 domains=json.loads(r['domains'])
             ) for r in rows
         ]
-    finally:
-        await conn.close()
 
 @router.post("/users", response_model=UserResponse)
 async def create_user(user: UserCreate):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         # Check if exists
         exists = await conn.fetchval("SELECT 1 FROM users WHERE username = $1", user.username)
         if exists:
@@ -197,30 +191,21 @@ async def create_user(user: UserCreate):
             org_id=row['org_id'],
             domains=json.loads(row['domains'])
         )
-    finally:
-        await conn.close()
 
 @router.delete("/users/{user_id}")
 async def delete_user(user_id: int):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         await conn.execute("DELETE FROM users WHERE id = $1", user_id)
         return {"status": "deleted"}
-    finally:
-        await conn.close()
 
 
 # --- Audit Logs ---
 
 @router.get("/audit-logs", response_model=List[AuditLogEntry])
 async def list_audit_logs(org_id: int, limit: int = 50):
-    conn = await database.get_db_connection()
-    try:
-        # RLS Context
-        await conn.execute(f"SELECT set_config('app.current_org_id', '{org_id}', false)")
-        await conn.execute("SELECT set_config('app.current_role', 'client_admin', false)")
-
-        rows = await conn.fetch("SELECT id, username, action, details, timestamp FROM audit_logs WHERE org_id = $1 ORDER BY timestamp DESC LIMIT $2", org_id, limit)
+    # RLS Context (transaction-local)
+    async with database.connection(org_id=org_id, role='client_admin') as conn:
+        rows = await queries.fetch(conn, 'audit_recent', org_id, limit)
         return [
             AuditLogEntry(
                 id=r['id'],
@@ -230,63 +215,31 @@ async def list_audit_logs(org_id: int, limit: int = 50):
                 timestamp=str(r['timestamp'])
             ) for r in rows
         ]
-    finally:
-        await conn.close()
 
 @router.post("/audit-logs")
 async def create_audit_log(entry: AuditLogCreate, org_id: int):
-    conn = await database.get_db_connection()
-    try:
-        # RLS Context
-        await conn.execute(f"SELECT set_config('app.current_org_id', '{org_id}', false)")
-        await conn.execute("SELECT set_config('app.current_role', 'client_admin', false)")
+    # Sequenced per org (see audit_writer.py); returns once the entry is committed
+    current_hash = await audit_writer.append(org_id, entry.username, entry.action, entry.details)
+    return {"status": "logged", "hash": current_hash}
 
-        # Get the strict JSON string and Timestamp
-        last_hash = await conn.fetchval("SELECT current_hash FROM audit_logs WHERE org_id = $1 ORDER BY id DESC LIMIT 1", org_id) or "ROOT_HASH"
-        
-        # Details should be sorted for stable hashing
-        details_str = json.dumps(entry.details, sort_keys=True)
-        
-        # We won't include the timestamp in the hash if it's generated by DB to avoid drift
-        payload = f"{last_hash}{entry.username}{entry.action}{details_str}{org_id}"
-        current_hash = integrity.calculate_hash(payload.encode())
+@router.get("/audit-logs/verify")
+async def verify_audit_chain(org_id: int, full: bool = Query(False)):
+    # Incremental from the org's signed checkpoint unless full=true
+    result = await audit_chain.verify_org(org_id, full=full)
+    result.pop('failed_id', None)
+    return result
 
-        await conn.execute(
-            """
-            INSERT INTO audit_logs (org_id, username, action, details, previous_hash, current_hash)
-            VALUES ($1, $2, $3, $4, $5, $6)
-            """,
-            org_id, entry.username, entry.action, details_str, last_hash, current_hash
-        )
-        return {"status": "logged", "hash": current_hash}
-    finally:
-        await conn.close()
 
-@router.get("/audit-logs/verify")
-async def verify_audit_chain(org_id: int):
-    conn = await database.get_db_connection()
+@router.get("/audit-logs/{log_id}/proof")
+async def audit_inclusion_proof(log_id: int, org_id: int):
+    """Merkle inclusion proof of one entry within its sealed segment (409 until it is sealed)."""
     try:
-        rows = await conn.fetch("SELECT id, username, action, details, previous_hash, current_hash FROM audit_logs WHERE org_id = $1 ORDER BY id ASC", org_id)
-        
-        last_hash = "ROOT_HASH"
-        for r in rows:
-            # 1. Check link
-            if r['previous_hash'] != last_hash:
-                return {"valid": False, "error": f"Chain broken at ID {r['id']}: Link mismatch."}
-            
-            # 2. Verify current hash
-            details_str = json.dumps(json.loads(r['details']) if r['details'] else {}, sort_keys=True)
-            payload = f"{r['previous_hash']}{r['username']}{r['action']}{details_str}{org_id}"
-            expected_hash = integrity.calculate_hash(payload.encode())
-            
-            if r['current_hash'] != expected_hash:
-                return {"valid": False, "error": f"Integrity failure at ID {r['id']}: Content mismatch."}
-            
-            last_hash = r['current_hash']
-            
-        return {"valid": True, "log_count": len(rows), "head_hash": last_hash}
-    finally:
-        await conn.close()
+        proof = await audit_chain.inclusion_proof(org_id, log_id)
+    except LookupError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if proof is None:
+        raise HTTPException(status_code=404, detail="Audit log entry not found")
+    return proof
 
 
 class LegalHoldApply(BaseModel):
@@ -297,8 +250,7 @@ class LegalHoldApply(BaseModel):
 
 @router.get("/holds")
 async def list_holds(org_id: int):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         # Get holds with item counts
         rows = await conn.fetch("""
             SELECT h.public_id as id, h.name, h.reason, h.filter_criteria, h.created_by, h.created_at, h.active, COUNT(i.id) as item_count
@@ -309,14 +261,12 @@ async def list_holds(org_id: int):
             ORDER BY h.created_at DESC
         """, org_id)
         return [dict(r) for r in rows]
-    finally:
-        await conn.close()
 
 @router.post("/holds")
 async def create_hold(hold: LegalHoldCreate, org_id: int):
-    conn = await database.get_db_connection()
     held_count = 0
-    try:
+    held_ids = []
+    async with database.connection() as conn:
         # Check Uniqueness within org
         exists = await conn.fetchval("SELECT id FROM legal_holds WHERE name = $1 AND org_id = $2", hold.name, org_id)
         if exists:
@@ -342,7 +292,7 @@ async def create_hold(hold: LegalHoldCreate, org_id: int):
             # Convert hold criteria (e.g. {"from": "x"}) to Meilisearch query
             # Simplistic mapping: assuming criteria keys match Meili attributes
             # For complex queries, we might need a translator.
-            # Using search.search_documents with filters.
+            # Using search.iter_documents with filters.
             
             filter_parts = [f'org_id = {org_id}']
             for k, v in hold.filter_criteria.items():
@@ -355,42 +305,20 @@ async def create_hold(hold: LegalHoldCreate, org_id: int):
             
             filter_query = " AND ".join(filter_parts)
             
-            # Fetch ALL matching docs (up to limit)
-            # Default search limit is 20, we need more.
-            # Warning: This is a synchronous blocking call if not async.
-            # core/search.py functions are synchronous wrapper around meili client.
-            # Ideally should be async or background task. For now, doing it inline (limit 1000).
-            
-            s_res = search.search_documents(
-                query="", 
-                filter_query=filter_query,
-                limit=10000 
-            )
-            
-            hits = s_res.get('hits', [])
-            if hits:
-                # Bulk Insert
-                params = [(hold_id, hit['id']) for hit in hits]
-                await conn.executemany(
-                    """
-                    INSERT INTO legal_hold_items (hold_id, message_id)
-                    VALUES ($1, $2)
-                    ON CONFLICT (hold_id, message_id) DO NOTHING
-                    """,
-                    params
-                )
-                held_count = len(hits)
+            # Stream ALL matching docs (no cap) and insert page by page
+            async for page in search.iter_documents(filter_query, fields=['id']):
+                inserted = await queries.fetch(conn, 'hold_insert_items', hold_id, [d['id'] for d in page])
+                held_ids.extend(r['message_id'] for r in inserted)
+                held_count += len(page)
 
+        await hold_index.hold_created(conn, org_id, hold.filter_criteria, held_ids)
         return {"status": "created", "id": returned_id, "auto_held_count": held_count}
-    finally:
-        await conn.close()
 
 @router.get("/holds/{hold_id}")
 async def get_hold(hold_id: str, org_id: int):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         # Lookup by PUBLIC_ID and verify org_id
-        hold = await conn.fetchrow("SELECT *, public_id as id FROM legal_holds WHERE public_id = $1 AND org_id = $2", hold_id, org_id)
+        hold = await queries.fetchrow(conn, 'hold_by_public_id', hold_id, org_id)
         if not hold:
             raise HTTPException(status_code=404, detail="Hold not found")
         
@@ -401,7 +329,7 @@ async def get_hold(hold_id: str, org_id: int):
         internal_id = await conn.fetchval("SELECT id FROM legal_holds WHERE public_id = $1", hold_id)
 
         # Get Held Items Using Internal ID
-        items = await conn.fetch("SELECT message_id, created_at FROM legal_hold_items WHERE hold_id = $1 ORDER BY created_at DESC LIMIT 100", internal_id)
+        items = await queries.fetch(conn, 'hold_items_recent', internal_id)
         
         # Enrich with Details from MeiliSearch (optional but good for UI)
         # We can do a 'get_documents' call if the client supports it, or just return IDs.
@@ -418,7 +346,7 @@ async def get_hold(hold_id: str, org_id: int):
             ids_list = ', '.join([f'"{mid}"' for mid in ids])
             filter_query = f"id IN [{ids_list}]"
             
-            s_res = search.search_documents(query="", filter_query=filter_query, limit=100)
+            s_res = await search.search_documents(query="", filter_query=filter_query, limit=100)
             print(f"DEBUG: Meili Response Hits: {len(s_res.get('hits', []))}")
             
             hits = {h['id']: h for h in s_res.get('hits', [])}
@@ -439,45 +367,32 @@ async def get_hold(hold_id: str, org_id: int):
             "hold": dict(hold),
             "items": enriched_items
         }
-    finally:
-        await conn.close()
 
 @router.post("/holds/{hold_id}/release")
 async def release_hold(hold_id: str, org_id: int):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         # Check if exists and belongs to org
         exists = await conn.fetchval("SELECT id FROM legal_holds WHERE public_id = $1 AND org_id = $2", hold_id, org_id)
         if not exists:
             raise HTTPException(status_code=404, detail="Hold not found")
 
-        # Deactivate
-        await conn.execute("UPDATE legal_holds SET active = FALSE WHERE public_id = $1 AND org_id = $2", hold_id, org_id)
+        # Deactivate (only the active -> released transition touches the hold index)
+        released = await conn.fetchrow("UPDATE legal_holds SET active = FALSE WHERE public_id = $1 AND org_id = $2 AND active = TRUE RETURNING id, filter_criteria", hold_id, org_id)
+        if released:
+            await hold_index.hold_released(conn, org_id, released['id'], json.loads(released['filter_criteria']))
         return {"status": "released", "id": hold_id}
-    finally:
-        await conn.close()
 
 @router.post("/holds/apply")
 async def apply_hold(payload: LegalHoldApply):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         # Bulk insert message IDs for the hold
         # Use ON CONFLICT DO NOTHING to avoid duplicates
-        params = []
-        for mid in payload.message_ids:
-            params.append((payload.hold_id, mid))
-            
-        await conn.executemany(
-            """
-            INSERT INTO legal_hold_items (hold_id, message_id)
-            VALUES ($1, $2)
-            ON CONFLICT (hold_id, message_id) DO NOTHING
-            """,
-            params
-        )
+        inserted = await queries.fetch(conn, 'hold_insert_items', payload.hold_id, payload.message_ids)
+
+        hold = await conn.fetchrow("SELECT org_id, active FROM legal_holds WHERE id = $1", payload.hold_id)
+        if hold and hold['active'] and inserted:
+            await hold_index.items_added(conn, hold['org_id'], [r['message_id'] for r in inserted])
         return {"status": "applied", "count": len(payload.message_ids)}
-    finally:
-        await conn.close()
 
 
 class RetentionPolicyCreate(BaseModel):
@@ -493,10 +408,36 @@ async def manual_retention_run():
     await retention_worker.purge_expired_messages()
     return {"status": "Retention worker triggered"}
 
+@router.get("/retention/plan")
+async def plan_retention(org_id: Optional[int] = Query(None), policy_id: Optional[int] = Query(None)):
+    """Dry run: per-policy counts, held messages, estimated bytes and duration. Deletes nothing."""
+    async with database.connection() as conn:
+        if org_id:
+            rows = await conn.fetch("SELECT id, name, domains, retention_days FROM retention_policies WHERE org_id = $1 ORDER BY created_at DESC", org_id)
+        else:
+            rows = await conn.fetch("SELECT id, name, domains, retention_days FROM retention_policies WHERE org_id IS NULL ORDER BY created_at DESC")
+    if policy_id is not None:
+        rows = [r for r in rows if r['id'] == policy_id]
+        if not rows:
+            raise HTTPException(status_code=404, detail="Retention policy not found")
+    try:
+        return await retention_worker.plan(rows)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Planning failed: {e}")
+
+@router.post("/retention/plan")
+async def plan_proposed_retention(policy: RetentionPolicyCreate):
+    """Dry run for a policy that hasn't been created yet."""
+    try:
+        hold_filter = await retention_worker.account_hold_filter()
+        result = await retention_worker.plan_policy(policy.domains, policy.retention_days, hold_filter)
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Planning failed: {e}")
+    return {'policy_id': None, 'name': policy.name, 'retention_days': policy.retention_days, **result}
+
 @router.get("/retention")
 async def list_retention_policies(org_id: Optional[int] = Query(None)):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         if org_id:
             rows = await conn.fetch("SELECT * FROM retention_policies WHERE org_id = $1 ORDER BY created_at DESC", org_id)
         else:
@@ -509,13 +450,10 @@ async def list_retention_policies(org_id: Optional[int] = Query(None)):
                 'domains': json.loads(r['domains'])
             } for r in rows
         ]
-    finally:
-        await conn.close()
 
 @router.post("/retention")
 async def create_retention_policy(policy: RetentionPolicyCreate, org_id: Optional[int] = Query(None)):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         policy_id = await conn.fetchval(
             """
             INSERT INTO retention_policies (org_id, name, domains, retention_days, action)
@@ -525,13 +463,10 @@ async def create_retention_policy(policy: RetentionPolicyCreate, org_id: Optiona
             org_id, policy.name, json.dumps(policy.domains), policy.retention_days, policy.action
         )
         return {"status": "created", "id": policy_id}
-    finally:
-        await conn.close()
 
 @router.get("/stats")
 async def get_dashboard_stats(org_id: Optional[int] = Query(None)):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         if org_id:
             # Client Admin Stats
             # 1. Get Domains for Meili Filter
@@ -543,7 +478,7 @@ async def get_dashboard_stats(org_id: Optional[int] = Query(None)):
                 or_parts = [f"domains = '{d}'" for d in domains]
                 filter_query = f"({' OR '.join(or_parts)})"
             
-            email_stats = search.get_stats(filter_query)
+            email_stats = await search.get_stats(filter_query)
             
             auditor_count = await conn.fetchval("SELECT COUNT(*) FROM users WHERE org_id = $1 AND role = 'auditor'", org_id)
             hold_count = await conn.fetchval("SELECT COUNT(*) FROM legal_holds WHERE org_id = $1 AND active = TRUE", org_id)
@@ -558,7 +493,7 @@ async def get_dashboard_stats(org_id: Optional[int] = Query(None)):
             }
         else:
             # Super Admin Stats
-            email_stats = search.get_stats()
+            email_stats = await search.get_stats()
             org_count = await conn.fetchval("SELECT COUNT(*) FROM organizations")
             agent_count = await conn.fetchval("SELECT COUNT(*) FROM sidecar_agents WHERE status = 'ONLINE'")
             user_count = await conn.fetchval("SELECT COUNT(*) FROM users")
@@ -569,27 +504,21 @@ async def get_dashboard_stats(org_id: Optional[int] = Query(None)):
                 "online_agents": agent_count,
                 "total_users": user_count
             }
-    finally:
-        await conn.close()
 
 @router.delete("/retention/{policy_id}")
 async def delete_retention_policy(policy_id: int, org_id: Optional[int] = Query(None)):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         if org_id:
             await conn.execute("DELETE FROM retention_policies WHERE id = $1 AND org_id = $2", policy_id, org_id)
         else:
             await conn.execute("DELETE FROM retention_policies WHERE id = $1 AND org_id IS NULL", policy_id)
         return {"status": "deleted"}
-    finally:
-        await conn.close()
 
 # --- Agent Monitoring (Super Admin) ---
 
 @router.get("/system/agents", response_model=List[AgentResponse])
 async def list_agents():
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         rows = await conn.fetch("SELECT id, name, hostname, org_id, status, last_seen FROM sidecar_agents ORDER BY last_seen DESC NULLS LAST")
         return [
             AgentResponse(
@@ -601,5 +530,3 @@ async def list_agents():
                 last_seen=str(r['last_seen']) if r['last_seen'] else None
             ) for r in rows
         ]
-    finally:
-        await conn.close()
@@ -0,0 +1,411 @@
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+import database
+import integrity
+import metrics
+
+logger = logging.getLogger("AuditChain")
+
+# Audit chain verification shared by the admin endpoint and integrity_worker.
+#
+# Checkpoints: after a successful run the chain head (last id, hash and entry
+# count) is stored per org in audit_checkpoints, HMAC-signed with the
+# integrity key, so the next run only streams rows appended since.
+#
+# Segments: verified rows are sealed into fixed-size segments
+# (AUDIT_SEGMENT_SIZE rows) in audit_segments. Each segment stores the Merkle
+# root of its rows' hashes and is chained to the previous segment, so one
+# entry is proven by an O(log n) inclusion proof, and a full re-verification
+# checks segments independently and in parallel.
+ROOT_HASH = "ROOT_HASH"
+AUDIT_VERIFY_CONCURRENCY = int(os.getenv("AUDIT_VERIFY_CONCURRENCY", "4"))
+AUDIT_SEGMENT_SIZE = int(os.getenv("AUDIT_SEGMENT_SIZE", "1024"))
+# Rows are hashed in chunks; once a chain is longer than one chunk (and for
+# segments in a full run) the re-hashing moves to a process pool so large
+# chains don't serialize on the event loop. The pool is started with the app
+# (spawned, never forked from the threaded server); without it, hashing
+# stays inline.
+AUDIT_HASH_CHUNK = int(os.getenv("AUDIT_HASH_CHUNK", "10000"))
+AUDIT_HASH_PROCESSES = int(os.getenv("AUDIT_HASH_PROCESSES", str(min(4, os.cpu_count() or 1))))
+# pg_advisory_xact_lock(namespace, org_id) serializing segment sealing
+SEGMENT_LOCK_NAMESPACE = 0x41534547
+
+_ROW_COLUMNS = "id, username, action, details, previous_hash, current_hash"
+
+class ChainBroken(Exception):
+    def __init__(self, row_id, message: str):
+        super().__init__(message)
+        self.row_id = row_id
+
+def entry_hash(previous_hash: str, username: str, action: str, details, org_id: int) -> str:
+    """Hash of one audit entry; details are hashed as sorted-key JSON."""
+    if isinstance(details, str):
+        details = json.loads(details)
+    details_str = json.dumps(details or {}, sort_keys=True)
+    payload = f"{previous_hash}{username}{action}{details_str}{org_id}"
+    return integrity.calculate_hash(payload.encode())
+
+def _first_mismatch(org_id: int, rows: list):
+    """Id of the first row whose stored hash doesn't match its content, else None (runs in pool processes)."""
+    for row_id, previous_hash, username, action, details, current_hash in rows:
+        if current_hash != entry_hash(previous_hash, username, action, details, org_id):
+            return row_id
+    return None
+
+_pool = None
+
+def start():
+    """Creates the hashing pool (app startup)."""
+    global _pool
+    if _pool is None and AUDIT_HASH_PROCESSES > 0:
+        _pool = ProcessPoolExecutor(max_workers=AUDIT_HASH_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+
+def _hash_pool():
+    return _pool
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+async def _check_hashes(org_id: int, rows: list, offload: bool):
+    pool = _hash_pool() if offload else None
+    if pool is not None:
+        bad = await asyncio.get_running_loop().run_in_executor(pool, _first_mismatch, org_id, rows)
+    else:
+        bad = _first_mismatch(org_id, rows)
+    if bad is not None:
+        raise ChainBroken(bad, f"Integrity failure at ID {bad}: Content mismatch.")
+
+def _row_tuple(r):
+    return (r['id'], r['previous_hash'], r['username'], r['action'], r['details'], r['current_hash'])
+
+async def _verify_range(conn, org_id: int, after_id: int, previous_hash: str):
+    """
+    Streams and checks every row after after_id (inside a transaction).
+    Links are checked inline; each full chunk is re-hashed in the process
+    pool while the next one streams in. Returns (count, last_id, last_hash).
+    """
+    count, last_id = 0, after_id
+    chunk = []
+    pending = None
+    try:
+        async for r in conn.cursor(
+            f"SELECT {_ROW_COLUMNS} FROM audit_logs WHERE org_id = $1 AND id > $2 ORDER BY id ASC",
+            org_id, after_id, prefetch=AUDIT_HASH_CHUNK
+        ):
+            if r['previous_hash'] != previous_hash:
+                # Report an earlier content failure first
+                if pending is not None:
+                    await pending
+                await _check_hashes(org_id, chunk, offload=False)
+                raise ChainBroken(r['id'], f"Chain broken at ID {r['id']}: Link mismatch.")
+            chunk.append(_row_tuple(r))
+            count, last_id, previous_hash = count + 1, r['id'], r['current_hash']
+
+            if len(chunk) >= AUDIT_HASH_CHUNK:
+                if pending is not None:
+                    await pending
+                pending = asyncio.ensure_future(_check_hashes(org_id, chunk, offload=True))
+                chunk = []
+
+        if pending is not None:
+            await pending
+            pending = None
+        await _check_hashes(org_id, chunk, offload=False)
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+    return count, last_id, previous_hash
+
+# --- Merkle trees ---
+
+def _leaf(current_hash: str) -> bytes:
+    return hashlib.sha256(b"\x00" + current_hash.encode()).digest()
+
+def _node(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+def _levels(leaves: list) -> list:
+    """Tree levels from the leaves up; an odd last node is carried up unchanged."""
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([_node(level[i], level[i + 1]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)])
+    return levels
+
+def merkle_root(current_hashes: list) -> str:
+    return _levels([_leaf(h) for h in current_hashes])[-1][0].hex()
+
+def merkle_proof(current_hashes: list, index: int) -> list:
+    """Sibling hashes from the leaf at index up to the root."""
+    proof = []
+    for level in _levels([_leaf(h) for h in current_hashes])[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append({'side': 'left' if sibling < index else 'right', 'hash': level[sibling].hex()})
+        index //= 2
+    return proof
+
+def verify_proof(current_hash: str, proof: list, root: str) -> bool:
+    node = _leaf(current_hash)
+    for step in proof:
+        sibling = bytes.fromhex(step['hash'])
+        node = _node(sibling, node) if step['side'] == 'left' else _node(node, sibling)
+    return node.hex() == root
+
+def segment_hash(org_id: int, seq: int, first_id: int, last_id: int, last_hash: str, root: str, previous_segment_hash: str) -> str:
+    return integrity.calculate_hash(f"{previous_segment_hash}{root}{org_id}{seq}{first_id}{last_id}{last_hash}".encode())
+
+def _check_segment_header(org_id: int, seg) -> bool:
+    expected = segment_hash(org_id, seg['seq'], seg['first_id'], seg['last_id'], seg['last_hash'], seg['merkle_root'], seg['previous_segment_hash'])
+    return seg['segment_hash'] == expected and integrity.verify_integrity(expected.encode(), seg['signature'])
+
+# --- Checkpoints ---
+
+def _checkpoint_signature(org_id: int, last_id: int, last_hash: str, entries: int) -> str:
+    return integrity.sign_data(f"{org_id}:{last_id}:{last_hash}:{entries}".encode())
+
+async def _load_checkpoint(conn, org_id: int):
+    """The org's checkpoint if it is authentic and still matches the log, else None."""
+    cp = await conn.fetchrow("SELECT last_id, last_hash, entries, signature FROM audit_checkpoints WHERE org_id = $1", org_id)
+    if cp is None:
+        return None
+    if not integrity.verify_integrity(f"{org_id}:{cp['last_id']}:{cp['last_hash']}:{cp['entries']}".encode(), cp['signature']):
+        logger.error(f"[SECURITY ALERT] Invalid audit checkpoint signature for Org {org_id}; re-verifying from root.")
+        return None
+    head = await conn.fetchval("SELECT current_hash FROM audit_logs WHERE id = $1 AND org_id = $2", cp['last_id'], org_id)
+    if head != cp['last_hash']:
+        logger.error(f"[SECURITY ALERT] Audit checkpoint for Org {org_id} no longer matches ID {cp['last_id']}; re-verifying from root.")
+        return None
+    return cp
+
+async def _save_checkpoint(conn, org_id: int, last_id: int, last_hash: str, entries: int):
+    await conn.execute("""
+        INSERT INTO audit_checkpoints (org_id, last_id, last_hash, entries, signature, verified_at)
+        VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
+        ON CONFLICT (org_id) DO UPDATE
+        SET last_id = EXCLUDED.last_id, last_hash = EXCLUDED.last_hash, entries = EXCLUDED.entries,
+            signature = EXCLUDED.signature, verified_at = CURRENT_TIMESTAMP
+    """, org_id, last_id, last_hash, entries, _checkpoint_signature(org_id, last_id, last_hash, entries))
+
+# --- Connections ---
+
+# One budget for every connection verification and sealing hold at a time,
+# however orgs and segments fan out (AUDIT_VERIFY_CONCURRENCY in total).
+_connection_budget = asyncio.Semaphore(AUDIT_VERIFY_CONCURRENCY)
+
+@asynccontextmanager
+async def _connection():
+    # Super Admin Context (transaction-local)
+    async with _connection_budget, database.connection(role='super_admin') as conn:
+        yield conn
+
+# --- Segments ---
+
+async def seal_org(org_id: int, verified_id: int) -> int:
+    """
+    Seals every complete run of AUDIT_SEGMENT_SIZE unsealed rows up to
+    verified_id, the head of a chain verify_org has just verified (so rows
+    are not re-hashed, only their links followed). Returns segments sealed.
+    """
+    sealed = 0
+    async with _connection() as conn:
+        await conn.execute("SELECT pg_advisory_xact_lock($1, $2)", SEGMENT_LOCK_NAMESPACE, org_id)
+        last = await conn.fetchrow("SELECT seq, last_id, last_hash, segment_hash FROM audit_segments WHERE org_id = $1 ORDER BY seq DESC LIMIT 1", org_id)
+        seq = last['seq'] + 1 if last else 0
+        after_id = last['last_id'] if last else 0
+        previous_hash = last['last_hash'] if last else ROOT_HASH
+        previous_segment = last['segment_hash'] if last else ROOT_HASH
+
+        while True:
+            rows = await conn.fetch(
+                "SELECT id, previous_hash, current_hash FROM audit_logs WHERE org_id = $1 AND id > $2 AND id <= $3 ORDER BY id ASC LIMIT $4",
+                org_id, after_id, verified_id, AUDIT_SEGMENT_SIZE
+            )
+            if len(rows) < AUDIT_SEGMENT_SIZE:
+                break
+            for r in rows:
+                if r['previous_hash'] != previous_hash:
+                    raise ChainBroken(r['id'], f"Chain broken at ID {r['id']}: Link mismatch.")
+                previous_hash = r['current_hash']
+
+            first_id, last_id = rows[0]['id'], rows[-1]['id']
+            root = merkle_root([r['current_hash'] for r in rows])
+            seg_hash = segment_hash(org_id, seq, first_id, last_id, previous_hash, root, previous_segment)
+            await conn.execute("""
+                INSERT INTO audit_segments (org_id, seq, first_id, last_id, entries, last_hash, merkle_root, previous_segment_hash, segment_hash, signature)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)
+            """, org_id, seq, first_id, last_id, len(rows), previous_hash, root, previous_segment, seg_hash, integrity.sign_data(seg_hash.encode()))
+            seq, after_id, previous_segment = seq + 1, last_id, seg_hash
+            sealed += 1
+
+    metrics.inc("audit_segments_sealed", sealed)
+    return sealed
+
+async def _verify_segment(org_id: int, seg, previous) -> None:
+    """Checks one sealed segment on its own connection; raises ChainBroken."""
+    if seg['previous_segment_hash'] != (previous['segment_hash'] if previous else ROOT_HASH) or not _check_segment_header(org_id, seg):
+        raise ChainBroken(seg['first_id'], f"Segment {seg['seq']} header mismatch (first ID {seg['first_id']}).")
+
+    previous_hash = previous['last_hash'] if previous else ROOT_HASH
+    async with _connection() as conn:
+        rows = await conn.fetch(
+            f"SELECT {_ROW_COLUMNS} FROM audit_logs WHERE org_id = $1 AND id BETWEEN $2 AND $3 ORDER BY id ASC",
+            org_id, seg['first_id'], seg['last_id']
+        )
+
+    hashes = []
+    for r in rows:
+        if r['previous_hash'] != previous_hash:
+            raise ChainBroken(r['id'], f"Chain broken at ID {r['id']}: Link mismatch.")
+        previous_hash = r['current_hash']
+        hashes.append(previous_hash)
+    await _check_hashes(org_id, [_row_tuple(r) for r in rows], offload=True)
+
+    if len(hashes) != seg['entries'] or previous_hash != seg['last_hash'] or merkle_root(hashes) != seg['merkle_root']:
+        raise ChainBroken(seg['first_id'], f"Segment {seg['seq']} content mismatch (IDs {seg['first_id']}-{seg['last_id']}).")
+
+async def _verify_full(org_id: int) -> dict:
+    """Sealed segments in parallel, then the unsealed tail; the checkpoint is reset to the head."""
+    async with _connection() as conn:
+        segments = await conn.fetch("SELECT * FROM audit_segments WHERE org_id = $1 ORDER BY seq ASC", org_id)
+
+    # Each segment check waits for a connection from the shared budget
+    results = await asyncio.gather(
+        *[_verify_segment(org_id, segments[i], segments[i - 1] if i else None) for i in range(len(segments))],
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    last = segments[-1] if segments else None
+    async with _connection() as conn:
+        count, last_id, last_hash = await _verify_range(conn, org_id, last['last_id'] if last else 0, last['last_hash'] if last else ROOT_HASH)
+        entries = sum(s['entries'] for s in segments) + count
+        if entries:
+            await _save_checkpoint(conn, org_id, last_id, last_hash, entries)
+    return {"valid": True, "log_count": entries, "head_id": last_id, "head_hash": last_hash, "verified": entries, "segments": len(segments)}
+
+async def _verify_incremental(org_id: int) -> dict:
+    # The cursor needs the transaction too
+    async with _connection() as conn:
+        cp = await _load_checkpoint(conn, org_id)
+        count, last_id, last_hash = await _verify_range(conn, org_id, cp['last_id'] if cp else 0, cp['last_hash'] if cp else ROOT_HASH)
+        entries = (cp['entries'] if cp else 0) + count
+        if count:
+            await _save_checkpoint(conn, org_id, last_id, last_hash, entries)
+    return {"valid": True, "log_count": entries, "head_id": last_id, "head_hash": last_hash, "verified": count}
+
+async def verify_org(org_id: int, full: bool = False) -> dict:
+    """
+    Verifies an org's chain from its checkpoint, or everything if full.
+    Returns {"valid", "log_count", "head_id", "head_hash", "verified"} or
+    {"valid": False, "error", "failed_id"}.
+    """
+    mode = "full" if full else "incremental"
+    started = time.perf_counter()
+    try:
+        with metrics.timer("audit_verify_seconds", mode=mode):
+            result = await (_verify_full(org_id) if full else _verify_incremental(org_id))
+    except ChainBroken as e:
+        metrics.inc("audit_verify_failures")
+        logger.error(f"[SECURITY ALERT] TAMPERING DETECTED in Org {org_id}: {e}")
+        return {"valid": False, "error": str(e), "failed_id": e.row_id}
+    finally:
+        metrics.set_gauge("audit_verify_org_seconds", round(time.perf_counter() - started, 3), org=org_id)
+    metrics.inc("audit_verify_rows", result['verified'], mode=mode)
+    metrics.set_gauge("audit_verify_org_rows", result['verified'], org=org_id)
+    return result
+
+async def verify_all(full: bool = False) -> dict:
+    """
+    Verifies (then seals) every org with AUDIT_VERIFY_CONCURRENCY workers;
+    all of them share one connection budget. Returns {org_id: result}.
+    """
+    async with _connection() as conn:
+        org_ids = [r['id'] for r in await conn.fetch("SELECT id FROM organizations ORDER BY id")]
+
+    queue = asyncio.Queue()
+    for oid in org_ids:
+        queue.put_nowait(oid)
+    results = {}
+
+    async def worker():
+        while not queue.empty():
+            org_id = queue.get_nowait()
+            try:
+                result = await verify_org(org_id, full=full)
+                if result['valid']:
+                    result['sealed'] = await seal_org(org_id, result['head_id'])
+            except Exception as e:
+                logger.error(f"Audit verification of Org {org_id} failed: {e}")
+                result = {"valid": False, "error": str(e), "failed_id": None}
+            results[org_id] = result
+
+    await asyncio.gather(*[worker() for _ in range(min(AUDIT_VERIFY_CONCURRENCY, len(org_ids)))])
+    return {oid: results[oid] for oid in org_ids}
+
+# --- Inclusion proofs ---
+
+async def _find_segment(conn, org_id: int, log_id: int):
+    return await conn.fetchrow(
+        "SELECT * FROM audit_segments WHERE org_id = $1 AND first_id <= $2 AND last_id >= $2",
+        org_id, log_id
+    )
+
+async def inclusion_proof(org_id: int, log_id: int):
+    """
+    Merkle inclusion proof of one entry in its sealed segment. Returns None if
+    the entry doesn't exist in the org; raises LookupError if it isn't sealed
+    yet (sealing is left to the integrity worker).
+    """
+    async with database.connection(role='super_admin') as conn:
+        entry = await conn.fetchrow(f"SELECT {_ROW_COLUMNS}, timestamp FROM audit_logs WHERE id = $1 AND org_id = $2", log_id, org_id)
+        if entry is None:
+            return None
+        seg = await _find_segment(conn, org_id, log_id)
+        if seg is None:
+            raise LookupError(f"Audit entry {log_id} is not sealed into a segment yet")
+        rows = await conn.fetch(
+            "SELECT id, current_hash FROM audit_logs WHERE org_id = $1 AND id BETWEEN $2 AND $3 ORDER BY id ASC",
+            org_id, seg['first_id'], seg['last_id']
+        )
+
+    hashes = [r['current_hash'] for r in rows]
+    index = next(i for i, r in enumerate(rows) if r['id'] == log_id)
+    proof = merkle_proof(hashes, index)
+    valid = (
+        entry['current_hash'] == entry_hash(entry['previous_hash'], entry['username'], entry['action'], entry['details'], org_id) and
+        verify_proof(entry['current_hash'], proof, seg['merkle_root']) and
+        _check_segment_header(org_id, seg)
+    )
+    if not valid:
+        metrics.inc("audit_verify_failures")
+        logger.error(f"[SECURITY ALERT] Inclusion proof for audit entry {log_id} (Org {org_id}) does not verify.")
+
+    details = entry['details']
+    return {
+        "valid": valid,
+        "entry": {
+            "id": entry['id'],
+            "username": entry['username'],
+            "action": entry['action'],
+            "details": json.loads(details) if isinstance(details, str) else details,
+            "timestamp": entry['timestamp'],
+            "previous_hash": entry['previous_hash'],
+            "current_hash": entry['current_hash'],
+        },
+        "leaf_index": index,
+        "proof": proof,
+        "segment": {k: seg[k] for k in ('seq', 'first_id', 'last_id', 'entries', 'last_hash', 'merkle_root', 'previous_segment_hash', 'segment_hash', 'signature')},
+    }
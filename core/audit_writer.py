@@ -0,0 +1,90 @@
+import asyncio
+import json
+import logging
+import os
+import audit_chain
+import database
+import metrics
+import queries
+
+logger = logging.getLogger("AuditWriter")
+
+# Audit log appends go through one sequencer per org. Entries queue up for a
+# tick (AUDIT_FLUSH_MS), then the batch is chained in memory and written with
+# one multi-row INSERT inside a transaction holding a per-org advisory lock,
+# so concurrent writers (other requests, other processes) can't fork the
+# chain. Each caller gets its entry's hash back once the batch is committed.
+AUDIT_FLUSH_MS = int(os.getenv("AUDIT_FLUSH_MS", "5"))
+AUDIT_MAX_BATCH = int(os.getenv("AUDIT_MAX_BATCH", "500"))
+# pg_advisory_xact_lock(namespace, org_id)
+AUDIT_LOCK_NAMESPACE = 0x41554454
+
+class _Sequencer:
+    """Pending entries of one org; the flush task runs only while there is work."""
+    __slots__ = ('org_id', 'pending', 'task')
+
+    def __init__(self, org_id: int):
+        self.org_id = org_id
+        self.pending = []
+        self.task = None
+
+    def submit(self, entry):
+        self.pending.append(entry)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(AUDIT_FLUSH_MS / 1000)
+            batch, self.pending = self.pending[:AUDIT_MAX_BATCH], self.pending[AUDIT_MAX_BATCH:]
+            try:
+                with metrics.timer("audit_flush_seconds"):
+                    hashes = await _write(self.org_id, batch)
+            except Exception as e:
+                logger.error(f"Audit flush for Org {self.org_id} failed ({len(batch)} entries): {e}")
+                for *_, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            metrics.inc("audit_entries_written", len(batch))
+            for (*_, fut), h in zip(batch, hashes):
+                if not fut.done():
+                    fut.set_result(h)
+
+# org_id -> _Sequencer. Loop-affine: append() must run on the app loop
+# (the SMTP server hands its messages over to it, see smtp_server.py).
+_sequencers = {}
+
+async def _write(org_id: int, batch: list) -> list:
+    """Chains and inserts one batch under the org's advisory lock. Returns the entry hashes."""
+    async with database.connection(org_id=org_id, role='client_admin') as conn:
+        await conn.execute("SELECT pg_advisory_xact_lock($1, $2)", AUDIT_LOCK_NAMESPACE, org_id)
+        last_hash = await queries.fetchval(conn, 'audit_last_hash', org_id) or audit_chain.ROOT_HASH
+
+        usernames, actions, details, previous, hashes = [], [], [], [], []
+        for username, action, details_str, _ in batch:
+            current = audit_chain.entry_hash(last_hash, username, action, details_str, org_id)
+            usernames.append(username)
+            actions.append(action)
+            details.append(details_str)
+            previous.append(last_hash)
+            hashes.append(current)
+            last_hash = current
+
+        await queries.execute(conn, 'audit_insert_batch', org_id, usernames, actions, details, previous, hashes)
+    return hashes
+
+async def append(org_id: int, username: str, action: str, details: dict = None) -> str:
+    """Appends one entry to the org's audit chain. Returns its hash once committed."""
+    seq = _sequencers.get(org_id)
+    if seq is None:
+        seq = _sequencers[org_id] = _Sequencer(org_id)
+
+    fut = asyncio.get_running_loop().create_future()
+    seq.submit((username, action, json.dumps(details or {}, sort_keys=True), fut))
+    return await fut
+
+async def flush():
+    """Waits for every queued entry to be written (shutdown)."""
+    tasks = [s.task for s in _sequencers.values() if s.task is not None]
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import sys
+import database
+import storage
+
+logger = logging.getLogger("CASManifest")
+
+# Manifest of every cas_{hash}.enc object in the bucket (table cas_manifest),
+# fronted by an in-memory bloom filter. A bloom miss is a definite "not stored",
+# so most /cas/check lookups never reach Postgres or object storage.
+# A false "not stored" answer only costs a re-upload, which is idempotent.
+BLOOM_CAPACITY = int(os.getenv("CAS_BLOOM_CAPACITY", "1000000"))
+BLOOM_ERROR_RATE = float(os.getenv("CAS_BLOOM_ERROR_RATE", "0.01"))
+
+def cas_object_name(blob_hash: str) -> str:
+    return f"cas_{blob_hash}.enc"
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1)
+        self.num_bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key: str):
+        # Kirsch-Mitzenmacher double hashing over one blake2b digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'big')
+        h2 = int.from_bytes(digest[8:], 'big') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+_bloom = None
+
+async def load():
+    """Builds the bloom filter from the manifest table (streamed, not fetched at once)."""
+    global _bloom
+    bloom = BloomFilter(BLOOM_CAPACITY, BLOOM_ERROR_RATE)
+    count = 0
+    async with database.connection() as conn:
+        async with conn.transaction():
+            async for r in conn.cursor("SELECT hash FROM cas_manifest", prefetch=10000):
+                bloom.add(r['hash'])
+                count += 1
+    _bloom = bloom
+    logger.info(f"CAS manifest loaded: {count} blobs.")
+
+async def record(blobs):
+    """Adds (hash, size) pairs to the manifest after a successful upload."""
+    blobs = list(blobs)
+    if not blobs:
+        return
+    async with database.connection() as conn:
+        await conn.execute("""
+            INSERT INTO cas_manifest (hash, size)
+            SELECT * FROM unnest($1::text[], $2::bigint[])
+            ON CONFLICT (hash) DO NOTHING
+        """, [h for h, _ in blobs], [size for _, size in blobs])
+    if _bloom is not None:
+        for h, _ in blobs:
+            _bloom.add(h)
+
+async def check(hashes) -> dict:
+    """Returns {hash: exists}. One ANY() query for bloom hits, no object-store calls."""
+    hashes = list(hashes)
+    result = {h: False for h in hashes}
+    try:
+        if _bloom is None:
+            await load()
+        maybe = [h for h in hashes if h in _bloom]
+        if maybe:
+            async with database.connection() as conn:
+                rows = await conn.fetch("SELECT hash FROM cas_manifest WHERE hash = ANY($1)", maybe)
+            for r in rows:
+                result[r['hash']] = True
+    except Exception as e:
+        # Manifest unavailable: fall back to asking object storage directly
+        logger.error(f"CAS manifest lookup failed, falling back to storage: {e}")
+        exists = await asyncio.gather(*[storage.blob_store.exists(cas_object_name(h)) for h in hashes])
+        result = dict(zip(hashes, exists))
+    return result
+
+async def rebuild():
+    """
+    Reconciles the manifest with the bucket: lists every cas_ object, upserts
+    it, drops manifest rows whose object is gone, then reloads the bloom filter.
+    """
+    listed = 0
+    async with database.connection() as conn, conn.transaction():
+        await conn.execute("CREATE TEMP TABLE cas_seen (hash TEXT PRIMARY KEY, size BIGINT) ON COMMIT DROP")
+
+        async for page in storage.blob_store.list_pages(prefix="cas_"):
+            batch = [(key[len("cas_"):-len(".enc")], size) for key, size in page if key.endswith(".enc")]
+            if batch:
+                await conn.copy_records_to_table('cas_seen', records=batch)
+                listed += len(batch)
+
+        await conn.execute("""
+            INSERT INTO cas_manifest (hash, size)
+            SELECT hash, size FROM cas_seen
+            ON CONFLICT (hash) DO UPDATE SET size = EXCLUDED.size
+        """)
+        removed = await conn.execute("DELETE FROM cas_manifest m WHERE NOT EXISTS (SELECT 1 FROM cas_seen s WHERE s.hash = m.hash)")
+
+    removed_count = int(removed.split()[-1])
+    logger.info(f"CAS manifest rebuilt from bucket: {listed} objects listed, {removed_count} stale rows removed.")
+    await load()
+    return {"listed": listed, "removed": removed_count}
+
+if __name__ == "__main__":
+    # Usage: python cas_manifest.py rebuild
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] != "rebuild":
+        print("Usage: python cas_manifest.py rebuild")
+        sys.exit(1)
+
+    async def _main():
+        await database.connect()
+        try:
+            print(await rebuild())
+        finally:
+            await database.disconnect()
+
+    asyncio.run(_main())
@@ -3,6 +3,7 @@ from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
 import database
+import queries
 import json
 import uuid
 import exports
@@ -49,24 +50,13 @@ class StatusUpdate(BaseModel):
 
 @router.get("", response_model=List[CaseResponse])
 async def list_cases(org_id: int):
-    conn = await database.get_db_connection()
-    try:
-        rows = await conn.fetch("""
-            SELECT c.*, COUNT(ci.id) as item_count 
-            FROM cases c 
-            LEFT JOIN case_items ci ON c.id = ci.case_id 
-            WHERE c.org_id = $1
-            GROUP BY c.id 
-            ORDER BY c.created_at DESC
-        """, org_id)
+    async with database.connection() as conn:
+        rows = await queries.fetch(conn, 'cases_for_org', org_id)
         return [dict(r) for r in rows]
-    finally:
-        await conn.close()
 
 @router.post("", response_model=CaseResponse)
 async def create_case(case: CaseCreate, org_id: int):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         row = await conn.fetchrow(
             """
             INSERT INTO cases (org_id, name, description, created_by)
@@ -76,15 +66,12 @@ async def create_case(case: CaseCreate, org_id: int):
             org_id, case.name, case.description, case.created_by
         )
         return {**dict(row), "item_count": 0}
-    finally:
-        await conn.close()
 
 # --- Specialized Item Routes (Literal segments) ---
 
 @router.post("/items/batch-assign")
 async def batch_assign_items(payload: BatchAssignRequest, org_id: int):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         # Verify all items belong to a case in the same org
         check = await conn.fetchval("""
             SELECT 1 FROM case_items ci 
@@ -100,83 +87,56 @@ async def batch_assign_items(payload: BatchAssignRequest, org_id: int):
             payload.assignee_id, payload.item_ids
         )
         return {"status": "assigned", "count": len(payload.item_ids)}
-    finally:
-        await conn.close()
 
 @router.get("/assignments/{user_id}")
 async def list_assignments(user_id: int):
-    conn = await database.get_db_connection()
-    try:
-        rows = await conn.fetch("""
-            SELECT ci.*, c.name as case_name 
-            FROM case_items ci 
-            JOIN cases c ON ci.case_id = c.id 
-            WHERE ci.assignee_id = $1 
-            ORDER BY ci.added_at DESC
-        """, user_id)
+    async with database.connection() as conn:
+        rows = await queries.fetch(conn, 'case_assignments', user_id)
         return [
             {
                 **dict(r),
                 "tags": json.loads(r['tags'])
             } for r in rows
         ]
-    finally:
-        await conn.close()
 
 @router.put("/items/{item_id}/tags")
 async def update_item_tags(item_id: int, payload: TagUpdate):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         await conn.execute(
             "UPDATE case_items SET tags = $1 WHERE id = $2",
             json.dumps(payload.tags), item_id
         )
         return {"status": "updated"}
-    finally:
-        await conn.close()
 
 @router.put("/items/{item_id}/status")
 async def update_item_status(item_id: int, payload: StatusUpdate):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         await conn.execute(
             "UPDATE case_items SET review_status = $1 WHERE id = $2",
             payload.status, item_id
         )
         return {"status": "updated"}
-    finally:
-        await conn.close()
 
 @router.delete("/items/{item_id}")
 async def remove_item_from_case(item_id: int):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         exists = await conn.fetchval("SELECT 1 FROM case_items WHERE id = $1", item_id)
         if not exists:
             raise HTTPException(status_code=404, detail="Item not found")
             
         await conn.execute("DELETE FROM case_items WHERE id = $1", item_id)
         return {"status": "removed", "id": item_id}
-    finally:
-        await conn.close()
 
 # --- Parameterized Case Routes ---
 
 @router.get("/{case_id}")
 async def get_case(case_id: int, org_id: int):
-    conn = await database.get_db_connection()
-    try:
-        case = await conn.fetchrow("SELECT * FROM cases WHERE id = $1 AND org_id = $2", case_id, org_id)
+    async with database.connection() as conn:
+        case = await queries.fetchrow(conn, 'case_by_id', case_id, org_id)
         if not case:
             raise HTTPException(status_code=404, detail="Case not found")
             
-        items = await conn.fetch("""
-            SELECT ci.*, u.username as assignee_name 
-            FROM case_items ci 
-            LEFT JOIN users u ON ci.assignee_id = u.id 
-            WHERE ci.case_id = $1 
-            ORDER BY ci.added_at DESC
-        """, case_id)
+        items = await queries.fetch(conn, 'case_items', case_id)
         
         return {
             "case": dict(case),
@@ -187,13 +147,10 @@ async def get_case(case_id: int, org_id: int):
                 } for i in items
             ]
         }
-    finally:
-        await conn.close()
 
 @router.post("/{case_id}/items")
 async def add_items_to_case(case_id: int, payload: AddToCaseRequest, org_id: int):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         # Verify case org
         case_check = await conn.fetchval("SELECT 1 FROM cases WHERE id = $1 AND org_id = $2", case_id, org_id)
         if not case_check:
@@ -212,13 +169,10 @@ async def add_items_to_case(case_id: int, payload: AddToCaseRequest, org_id: int
             params
         )
         return {"status": "added", "count": len(payload.message_ids)}
-    finally:
-        await conn.close()
 
 @router.post("/{case_id}/export")
 async def export_case(case_id: int, org_id: int, background_tasks: BackgroundTasks, payload: ExportRequest = Body(...)):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         case = await conn.fetchrow("SELECT name FROM cases WHERE id = $1 AND org_id = $2", case_id, org_id)
         if not case:
             raise HTTPException(status_code=404, detail="Case not found")
@@ -239,18 +193,13 @@ async def export_case(case_id: int, org_id: int, background_tasks: BackgroundTas
             "message": "Export started in background.",
             "download_url": f"/api/v1/downloads/{job_id}.zip"
         }
-    finally:
-        await conn.close()
 
 @router.delete("/{case_id}")
 async def delete_case(case_id: int, org_id: int):
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         exists = await conn.fetchval("SELECT 1 FROM cases WHERE id = $1 AND org_id = $2", case_id, org_id)
         if not exists:
             raise HTTPException(status_code=404, detail="Case not found")
             
         await conn.execute("DELETE FROM cases WHERE id = $1 AND org_id = $2", case_id, org_id)
         return {"status": "deleted", "id": case_id}
-    finally:
-        await conn.close()
@@ -2,11 +2,20 @@ import asyncpg
 import os
 import asyncio
 import json
+from contextlib import asynccontextmanager
+import queries
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required")
 
+# Pool Tuning
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "1024"))
+DB_MAX_CACHED_STATEMENT_LIFETIME = int(os.getenv("DB_MAX_CACHED_STATEMENT_LIFETIME", "0"))
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_CONNECTION_LIFETIME", "300"))
+
 # Global Pool
 pool = None
 
@@ -14,7 +23,15 @@ async def connect():
     global pool
     if not pool:
         print("Initializing Database Connection Pool...")
-        pool = await asyncpg.create_pool(DATABASE_URL, min_size=5, max_size=20)
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            max_cached_statement_lifetime=DB_MAX_CACHED_STATEMENT_LIFETIME,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+            init=queries.init_connection,
+        )
         print("Database Pool Initialized.")
 
 async def disconnect():
@@ -23,15 +40,36 @@ async def disconnect():
         await pool.close()
         print("Database Pool Closed.")
 
-async def get_db_connection():
-    global pool
+@asynccontextmanager
+async def connection(org_id: int = None, role: str = None):
+    """
+    Borrows a pooled connection and returns it to the pool on exit.
+    If org_id/role are given, the block runs in a transaction with the RLS
+    settings (app.current_org_id / app.current_role) applied via
+    set_config(..., true), so they end with the transaction and never leak
+    to the next borrower.
+
+        async with database.connection(org_id=org_id, role='client_admin') as conn:
+            ...
+    """
     if not pool:
         await connect()
-    return await pool.acquire()
+    async with pool.acquire() as conn:
+        if org_id is None and role is None:
+            yield conn
+            return
+        async with conn.transaction():
+            if org_id is not None:
+                await conn.execute("SELECT set_config('app.current_org_id', $1, true)", str(org_id))
+            if role is not None:
+                await conn.execute("SELECT set_config('app.current_role', $1, true)", role)
+            yield conn
 
 async def init_db():
-    # Use direct connection for initialization if pool not ready (or just use pool)
-    conn = await get_db_connection()
+    async with connection() as conn:
+        await _create_schema(conn)
+
+async def _create_schema(conn):
     try:
         # 1. Organizations Table
         await conn.execute("""
@@ -49,6 +87,25 @@ async def init_db():
         except Exception as e:
             print(f"Migration error (domains): {e}")
 
+        # Domain Change Notifications (consumed by org_resolver's LISTEN loop)
+        try:
+            await conn.execute("""
+                CREATE OR REPLACE FUNCTION notify_org_domains_changed() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM pg_notify('org_domains_changed', '');
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            await conn.execute("DROP TRIGGER IF EXISTS org_domains_changed ON organizations")
+            await conn.execute("""
+                CREATE TRIGGER org_domains_changed
+                AFTER INSERT OR DELETE OR UPDATE OF domains ON organizations
+                FOR EACH STATEMENT EXECUTE FUNCTION notify_org_domains_changed();
+            """)
+        except Exception as e:
+            print(f"Migration error (org_domains_changed trigger): {e}")
+
         # Schema Migration: Add password_hash if missing
         try:
             await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS password_hash TEXT")
@@ -162,6 +219,8 @@ async def init_db():
                 UNIQUE(hold_id, message_id)
             );
         """)
+        # Retention anti-joins candidate ids against held message ids
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_legal_hold_items_message ON legal_hold_items (message_id)")
         
         # 5. Retention Policies Table (Updated)
         await conn.execute("""
@@ -218,13 +277,163 @@ async def init_db():
             );
         """)
         
+        # 8. CAS Manifest (known cas_{hash}.enc objects, see cas_manifest.py)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS cas_manifest (
+                hash TEXT PRIMARY KEY,
+                size BIGINT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        
+        # 9. Ingest Outbox (stored-but-not-yet-indexed messages, see ingest_outbox.py)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_outbox (
+                message_id TEXT PRIMARY KEY,
+                document JSONB NOT NULL,
+                status TEXT DEFAULT 'PENDING', -- 'PENDING', 'ENQUEUED'
+                task_uid BIGINT,
+                attempts INTEGER DEFAULT 0,
+                last_error TEXT,
+                next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_ingest_outbox_status ON ingest_outbox (status, next_attempt_at)")
+        
+        # 10. Hold Sync Queue (messages whose hold_ids must be pushed to the index, see hold_sync.py)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS hold_sync_pending (
+                message_id TEXT PRIMARY KEY,
+                queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        try:
+            await conn.execute("""
+                CREATE OR REPLACE FUNCTION queue_hold_sync_items() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'INSERT' THEN
+                        INSERT INTO hold_sync_pending (message_id)
+                        SELECT DISTINCT message_id FROM changed_items
+                        ON CONFLICT (message_id) DO NOTHING;
+                    ELSE
+                        INSERT INTO hold_sync_pending (message_id)
+                        SELECT DISTINCT message_id FROM removed_items
+                        ON CONFLICT (message_id) DO NOTHING;
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            await conn.execute("""
+                CREATE OR REPLACE FUNCTION queue_hold_sync_holds() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO hold_sync_pending (message_id)
+                    SELECT DISTINCT i.message_id
+                    FROM new_holds n
+                    JOIN old_holds o ON o.id = n.id
+                    JOIN legal_hold_items i ON i.hold_id = n.id
+                    WHERE n.active IS DISTINCT FROM o.active
+                    ON CONFLICT (message_id) DO NOTHING;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql;
+            """)
+            await conn.execute("DROP TRIGGER IF EXISTS hold_items_inserted ON legal_hold_items")
+            await conn.execute("""
+                CREATE TRIGGER hold_items_inserted
+                AFTER INSERT ON legal_hold_items
+                REFERENCING NEW TABLE AS changed_items
+                FOR EACH STATEMENT EXECUTE FUNCTION queue_hold_sync_items();
+            """)
+            await conn.execute("DROP TRIGGER IF EXISTS hold_items_deleted ON legal_hold_items")
+            await conn.execute("""
+                CREATE TRIGGER hold_items_deleted
+                AFTER DELETE ON legal_hold_items
+                REFERENCING OLD TABLE AS removed_items
+                FOR EACH STATEMENT EXECUTE FUNCTION queue_hold_sync_items();
+            """)
+            await conn.execute("DROP TRIGGER IF EXISTS holds_active_changed ON legal_holds")
+            await conn.execute("""
+                CREATE TRIGGER holds_active_changed
+                AFTER UPDATE ON legal_holds
+                REFERENCING OLD TABLE AS old_holds NEW TABLE AS new_holds
+                FOR EACH STATEMENT EXECUTE FUNCTION queue_hold_sync_holds();
+            """)
+        except Exception as e:
+            print(f"Migration error (hold sync triggers): {e}")
+
+        # 11. Retention Checkpoints (resume point of an interrupted purge, see retention_worker.py)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS retention_checkpoints (
+                policy_id INTEGER REFERENCES retention_policies(id) ON DELETE CASCADE,
+                domain TEXT NOT NULL,
+                cutoff_ts BIGINT NOT NULL,
+                last_ts BIGINT,
+                purged BIGINT DEFAULT 0,
+                completed BOOLEAN DEFAULT FALSE,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (policy_id, domain)
+            );
+        """)
+
+        # 12. Audit Checkpoints (signed head of the last verified chain per org, see audit_chain.py)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS audit_checkpoints (
+                org_id INTEGER PRIMARY KEY REFERENCES organizations(id) ON DELETE CASCADE,
+                last_id BIGINT NOT NULL,
+                last_hash TEXT NOT NULL,
+                entries BIGINT NOT NULL,
+                signature TEXT NOT NULL,
+                verified_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+
+        # 13. Audit Segments (Merkle roots of fixed-size runs of audit_logs, see audit_chain.py)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS audit_segments (
+                org_id INTEGER REFERENCES organizations(id) ON DELETE CASCADE,
+                seq INTEGER NOT NULL,
+                first_id BIGINT NOT NULL,
+                last_id BIGINT NOT NULL,
+                entries INTEGER NOT NULL,
+                last_hash TEXT NOT NULL,
+                merkle_root TEXT NOT NULL,
+                previous_segment_hash TEXT NOT NULL,
+                segment_hash TEXT NOT NULL,
+                signature TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (org_id, seq)
+            );
+        """)
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_audit_segments_range ON audit_segments (org_id, last_id)")
+
+        # 14. Blob Scrubber (resume position per pass + objects that failed verification, see scrub_worker.py)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS scrub_progress (
+                kind TEXT PRIMARY KEY,
+                position TEXT,
+                scanned BIGINT DEFAULT 0,
+                failures BIGINT DEFAULT 0,
+                completed_at TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS scrub_results (
+                object_key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                detail TEXT,
+                checked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+
         print("Database Schema Finalized for Multi-Tenancy.")
         
     except Exception as e:
         print(f"DB Initialization Error: {e}")
-    finally:
-        # Release connection back to pool
-        await conn.close()
 
 
 create_tables = init_db
@@ -0,0 +1,106 @@
+import re
+import email.utils
+import org_resolver
+
+# Documents that match no organization are archived under the Default Org
+DEFAULT_ORG_ID = 1
+
+_BRACKETED_EMAIL = re.compile(r'<(.+?)>')
+
+def _as_list(value):
+    if not value:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def extract_email(email_str):
+    """Handles both "Name <email@domain.com>" and bare "email@domain.com"."""
+    if not email_str or not isinstance(email_str, str):
+        return None
+    match = _BRACKETED_EMAIL.search(email_str)
+    if match:
+        return match.group(1).lower().strip()
+    if '@' in email_str:
+        return email_str.strip().lower()
+    return None
+
+def extract_domain(email_str):
+    email_addr = extract_email(email_str)
+    if email_addr:
+        return email_addr.split('@')[-1]
+    return None
+
+def collect_domains(doc: dict) -> set:
+    """Every domain seen in the header and envelope addresses (used for org resolution)."""
+    domains = set()
+    for field in ('from', 'to', 'envelope_from', 'envelope_rcpt'):
+        for val in _as_list(doc.get(field)):
+            if isinstance(val, str) and "@" in val:
+                domains.add(val.split("@")[-1].strip().lower().rstrip('>'))
+    return domains
+
+def parse_date_timestamp(date_str) -> int:
+    """RFC 2822 Date header -> unix timestamp (0 when missing or unparseable)."""
+    if not date_str:
+        return 0
+    try:
+        return int(email.utils.parsedate_to_datetime(date_str).timestamp())
+    except Exception as e:
+        print(f"Warning: Failed to parse date '{date_str}': {e}")
+        return 0
+
+def enrich_document(doc: dict, org_ids) -> dict:
+    """Adds tenant, address, domain and sort fields to one document in place."""
+    doc['org_id'] = sorted(org_ids) if org_ids else [DEFAULT_ORG_ID]
+
+    # Clean emails for Legal Holds (envelope is more authoritative than headers)
+    sender_email = extract_email(doc.get('from'))
+    env_from = extract_email(doc.get('envelope_from'))
+    if env_from:
+        sender_email = env_from
+
+    recipient_emails = set()
+    for val in _as_list(doc.get('to')) + _as_list(doc.get('envelope_rcpt')):
+        e = extract_email(val)
+        if e:
+            recipient_emails.add(e)
+
+    doc['sender_email'] = sender_email
+    doc['recipient_emails'] = list(recipient_emails)
+
+    # Domains for Multi-Tenancy Filtering
+    domains = set()
+    recipient_domains = set()
+    header_sender_domain = extract_domain(doc.get('from'))
+    env_sender_domain = extract_domain(doc.get('envelope_from'))
+    sender_domain = env_sender_domain or header_sender_domain
+    domains.update(filter(None, (header_sender_domain, env_sender_domain)))
+    for val in _as_list(doc.get('to')) + _as_list(doc.get('envelope_rcpt')):
+        rd = extract_domain(val)
+        if rd:
+            recipient_domains.add(rd)
+            domains.add(rd)
+
+    doc['domains'] = list(domains)
+    doc['sender_domain'] = sender_domain
+    doc['recipient_domains'] = list(recipient_domains)
+
+    # Sorting: date_timestamp for Meilisearch
+    doc['date_timestamp'] = parse_date_timestamp(doc.get('date'))
+    return doc
+
+async def enrich_batch(docs: list) -> list:
+    """
+    Enriches a whole sync batch in one pass: the domains of every document
+    are resolved to organizations together (one lookup per batch), then
+    the results are fanned back out to each document.
+    """
+    domain_sets = [collect_domains(doc) for doc in docs]
+    try:
+        org_sets = await org_resolver.resolve_batch(domain_sets)
+    except Exception as e:
+        print(f"Error resolving orgs: {e}")
+        org_sets = [set() for _ in docs]
+
+    for doc, org_ids in zip(docs, org_sets):
+        enrich_document(doc, org_ids)
+    return docs
@@ -20,10 +20,21 @@ os.makedirs(EXPORT_DIR, exist_ok=True)
 import re
 import base64
 
-def generate_eml(metadata, decrypted_body):
+CAS_HEADER_RE = re.compile(r"X-OpenArchive-CAS-Ref:\s*([a-fA-F0-9]+)")
+CAS_PLACEHOLDER_RE = re.compile(r"\[CAS_REF:(.*?)\]")
+
+def find_cas_refs(decrypted_body):
+    """All CAS hashes referenced by a stripped message (header or placeholder form)."""
+    refs = set(CAS_HEADER_RE.findall(decrypted_body))
+    refs.update(r.strip() for r in CAS_PLACEHOLDER_RE.findall(decrypted_body))
+    return refs
+
+def generate_eml(metadata, decrypted_body, cas_blobs=None):
     """
     Reconstructs the original EML object from the stripped source (decrypted_body),
     re-hydrating any CAS-stripped attachments.
+    cas_blobs: optional {hash: bytes} prefetched via storage.blob_store.batch_get;
+    without it each attachment is fetched synchronously.
     """
     import email
     from email import encoders
@@ -45,7 +56,10 @@ def generate_eml(metadata, decrypted_body):
 
         if cas_ref:
             cas_hash = cas_ref.strip()
-            blob_data = storage.get_blob(f"cas_{cas_hash}.enc")
+            if cas_blobs is not None:
+                blob_data = cas_blobs.get(cas_hash)
+            else:
+                blob_data = storage.get_blob(f"cas_{cas_hash}.enc")
             
             if blob_data:
                 # Re-attach content
@@ -162,9 +176,12 @@ async def create_export_job(export_id: str, items: list, format: str = "native",
                 quoted_ids = [f'"{mid}"' for mid in chunk_ids]
                 id_list_str = ', '.join(quoted_ids)
                 id_filter = f"id IN [{id_list_str}]"
-                results = search.search_documents(query="", filter_query=id_filter, limit=chunk_size)
+                results = await search.search_documents(query="", filter_query=id_filter, limit=chunk_size)
                 hits = {h['id']: h for h in results.get('hits', [])}
                 
+                # Fetch the chunk's blobs concurrently
+                blobs = await storage.blob_store.batch_get([f"{mid}.enc" for mid in chunk_ids if hits.get(mid, {}).get('key')])
+                
                 for mid in chunk_ids:
                     meta = hits.get(mid)
                     if not meta:
@@ -175,7 +192,7 @@ async def create_export_job(export_id: str, items: list, format: str = "native",
                         continue
                         
                     # Fetch Blob
-                    blob_enc = storage.get_blob(f"{mid}.enc")
+                    blob_enc = blobs.get(f"{mid}.enc")
                     if not blob_enc:
                         continue
                         
@@ -190,8 +207,14 @@ async def create_export_job(export_id: str, items: list, format: str = "native",
                             meta['from'] = redaction.redact_text(meta.get('from', ''))
                             meta['to'] = redaction.redact_text(meta.get('to', ''))
                         
+                        cas_blobs = None
+                        if format in ('native', 'mbox'):
+                            cas_hashes = find_cas_refs(decrypted_body)
+                            fetched = await storage.blob_store.batch_get([f"cas_{h}.enc" for h in cas_hashes])
+                            cas_blobs = {h: fetched[f"cas_{h}.enc"] for h in cas_hashes}
+                        
                         if format == 'native':
-                            eml = generate_eml(meta, decrypted_body)
+                            eml = generate_eml(meta, decrypted_body, cas_blobs)
                             # Ensure proper CRLF and MIME formatting for standard viewers
                             from email.generator import BytesGenerator
                             fp = io.BytesIO()
@@ -203,7 +226,7 @@ async def create_export_job(export_id: str, items: list, format: str = "native",
                             pdf_bytes = generate_pdf(meta, decrypted_body, mid)
                             zf.writestr(f"{mid}.pdf", pdf_bytes)
                         elif format == 'mbox':
-                            eml = generate_eml(meta, decrypted_body)
+                            eml = generate_eml(meta, decrypted_body, cas_blobs)
                             # Convert EmailMessage to mbox Message
                             msg = mailbox.mboxMessage(eml.as_bytes())
                             mbox.add(msg)
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+import uuid
+import asyncpg
+import database
+import metrics
+import queries
+
+logger = logging.getLogger("HoldIndex")
+
+# Per-org, in-process index of what active legal holds cover, so search
+# annotation ("is this hit held?") is a set lookup instead of two full-table
+# queries per request. Each org is loaded once (streamed), then kept current
+# incrementally by the hold endpoints in admin.py. Other core processes are
+# told to drop their copy via NOTIFY on NOTIFY_CHANNEL.
+NOTIFY_CHANNEL = "legal_holds_changed"
+INSTANCE_ID = uuid.uuid4().hex
+
+def _key(message_id: str):
+    """Canonical UUID ids are stored as 16 raw bytes (about half the size of the str)."""
+    if len(message_id) == 36:
+        try:
+            u = uuid.UUID(message_id)
+            if str(u) == message_id:
+                return u.bytes
+        except ValueError:
+            pass
+    return message_id
+
+def _add(counts: dict, key, n: int = 1):
+    counts[key] = counts.get(key, 0) + n
+
+def _remove(counts: dict, key):
+    left = counts.get(key, 0) - 1
+    if left > 0:
+        counts[key] = left
+    else:
+        counts.pop(key, None)
+
+class OrgHolds:
+    """
+    Reference-counted sets (a message or address can be covered by several
+    holds), so releasing one hold only drops what no other active hold covers.
+    """
+    __slots__ = ('held', 'held_from', 'held_to')
+
+    def __init__(self):
+        self.held = {}
+        self.held_from = {}
+        self.held_to = {}
+
+    def add_messages(self, message_ids):
+        for mid in message_ids:
+            _add(self.held, _key(mid))
+
+    def add_criteria(self, criteria: dict):
+        if criteria.get('from'): _add(self.held_from, criteria['from'])
+        if criteria.get('to'): _add(self.held_to, criteria['to'])
+
+    def remove_criteria(self, criteria: dict):
+        if criteria.get('from'): _remove(self.held_from, criteria['from'])
+        if criteria.get('to'): _remove(self.held_to, criteria['to'])
+
+    def is_held(self, hit: dict) -> bool:
+        return (
+            _key(hit['id']) in self.held or
+            hit.get('sender_email') in self.held_from or
+            any(r in self.held_to for r in hit.get('recipient_emails') or []) or
+            hit.get('from') in self.held_from or
+            hit.get('to') in self.held_to
+        )
+
+_orgs = {}
+# Bumped on every change; a load that raced with a change is not cached
+_versions = {}
+_load_locks = {}
+
+def _criteria(value) -> dict:
+    if isinstance(value, str):
+        return json.loads(value)
+    return value or {}
+
+async def _load(org_id: int) -> OrgHolds:
+    holds = OrgHolds()
+    async with database.connection() as conn:
+        async with conn.transaction():
+            async for r in queries.iterate(conn, 'held_ids_for_org', org_id):
+                _add(holds.held, _key(r['message_id']))
+        for r in await queries.fetch(conn, 'active_hold_criteria', org_id):
+            holds.add_criteria(_criteria(r['filter_criteria']))
+    return holds
+
+async def get(org_id: int) -> OrgHolds:
+    holds = _orgs.get(org_id)
+    if holds is not None:
+        metrics.inc("hold_index_hits")
+        return holds
+
+    lock = _load_locks.setdefault(org_id, asyncio.Lock())
+    async with lock:
+        holds = _orgs.get(org_id)
+        if holds is not None:
+            return holds
+        version = _versions.get(org_id, 0)
+        with metrics.timer("hold_index_load_seconds"):
+            holds = await _load(org_id)
+        if _versions.get(org_id, 0) == version:
+            _orgs[org_id] = holds
+        metrics.inc("hold_index_loads")
+        logger.info(f"Hold index loaded for org {org_id}: {len(holds.held)} messages, {len(holds.held_from) + len(holds.held_to)} addresses.")
+        return holds
+
+def invalidate(org_id: int):
+    _versions[org_id] = _versions.get(org_id, 0) + 1
+    _orgs.pop(org_id, None)
+
+def _changed(org_id: int):
+    """Records a local change; returns the cached index to update (None if not loaded)."""
+    _versions[org_id] = _versions.get(org_id, 0) + 1
+    return _orgs.get(org_id)
+
+# --- Incremental updates (called after the change is committed) ---
+
+async def hold_created(conn, org_id: int, criteria: dict, message_ids):
+    holds = _changed(org_id)
+    if holds is not None:
+        holds.add_criteria(criteria or {})
+        holds.add_messages(message_ids)
+    await _notify(conn, org_id)
+
+async def items_added(conn, org_id: int, message_ids):
+    """message_ids must be only the newly inserted rows of an active hold."""
+    holds = _changed(org_id)
+    if holds is not None:
+        holds.add_messages(message_ids)
+    await _notify(conn, org_id)
+
+async def hold_released(conn, org_id: int, hold_id: int, criteria: dict):
+    holds = _changed(org_id)
+    if holds is not None:
+        async with conn.transaction():
+            async for r in conn.cursor("SELECT message_id FROM legal_hold_items WHERE hold_id = $1", hold_id, prefetch=10000):
+                _remove(holds.held, _key(r['message_id']))
+        holds.remove_criteria(criteria or {})
+    await _notify(conn, org_id)
+
+async def org_dropped(conn, org_id: int):
+    invalidate(org_id)
+    await _notify(conn, org_id)
+
+# --- Cross-process invalidation ---
+
+async def _notify(conn, org_id: int):
+    await conn.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL, f"{INSTANCE_ID}:{org_id}")
+
+def _on_notify(connection, pid, channel, payload):
+    instance, _, org_id = payload.partition(':')
+    if instance != INSTANCE_ID and org_id.isdigit():
+        invalidate(int(org_id))
+
+async def start_listener():
+    """Dedicated LISTEN connection; on reconnect everything is dropped (changes may have been missed)."""
+    logger.info(f"Hold Index listening on '{NOTIFY_CHANNEL}'.")
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(database.DATABASE_URL)
+            await conn.add_listener(NOTIFY_CHANNEL, _on_notify)
+            for org_id in list(_orgs):
+                invalidate(org_id)
+            while not conn.is_closed():
+                await asyncio.sleep(30)
+        except Exception as e:
+            logger.error(f"Hold Index listener error: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(5)
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+import sys
+import database
+import metrics
+import search
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("HoldSync")
+
+# Keeps the hold_ids attribute of indexed messages in step with legal holds.
+# Triggers on legal_hold_items / legal_holds (see database.init_db) queue the
+# affected message ids in hold_sync_pending; this worker claims them in large
+# batches, recomputes each message's active hold ids and sends one partial
+# document update per batch. Claims are transactional: if the update fails,
+# the rows go back to the queue. Messages still waiting to be indexed are
+# re-queued rather than dropped.
+HOLD_SYNC_BATCH_SIZE = int(os.getenv("HOLD_SYNC_BATCH_SIZE", "5000"))
+HOLD_SYNC_POLL_SECONDS = float(os.getenv("HOLD_SYNC_POLL_SECONDS", "5"))
+
+async def sync_batch() -> int:
+    """Pushes one batch of pending memberships. Returns the number of messages settled (not re-queued)."""
+    async with database.connection() as conn, conn.transaction():
+        rows = await conn.fetch("""
+            DELETE FROM hold_sync_pending
+            WHERE message_id IN (
+                SELECT message_id FROM hold_sync_pending
+                ORDER BY queued_at
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING message_id
+        """, HOLD_SYNC_BATCH_SIZE)
+        if not rows:
+            return 0
+        ids = [r['message_id'] for r in rows]
+
+        memberships = await conn.fetch("""
+            SELECT i.message_id, array_agg(DISTINCT i.hold_id ORDER BY i.hold_id) AS hold_ids
+            FROM legal_hold_items i
+            JOIN legal_holds h ON i.hold_id = h.id
+            WHERE h.active = TRUE AND i.message_id = ANY($1::text[])
+            GROUP BY i.message_id
+        """, ids)
+        hold_ids = {r['message_id']: list(r['hold_ids']) for r in memberships}
+
+        # Stored but not yet indexed (index_queue / outbox): checked before the
+        # index so a row completing in between is still seen as indexed below
+        in_outbox = await conn.fetch(
+            "SELECT message_id FROM ingest_outbox WHERE message_id = ANY($1::text[])", ids
+        )
+        # A partial update would create a stub document for ids that aren't indexed
+        indexed = await search.existing_ids(ids)
+        docs = [{'id': mid, 'hold_ids': hold_ids.get(mid, [])} for mid in ids if mid in indexed]
+        if docs and await search.update_documents(docs) is None:
+            raise RuntimeError(f"hold_ids update failed for {len(docs)} documents")
+
+        # Re-queue those at the back; ids that are neither indexed nor pending don't exist
+        requeue = [r['message_id'] for r in in_outbox if r['message_id'] not in indexed]
+        if requeue:
+            await conn.execute("""
+                INSERT INTO hold_sync_pending (message_id)
+                SELECT * FROM unnest($1::text[])
+                ON CONFLICT (message_id) DO NOTHING
+            """, requeue)
+
+    metrics.inc("hold_sync_documents", len(docs))
+    metrics.inc("hold_sync_requeued", len(requeue))
+    return len(ids) - len(requeue)
+
+async def sync_pending():
+    total = 0
+    while True:
+        with metrics.timer("hold_sync_batch_seconds"):
+            claimed = await sync_batch()
+        total += claimed
+        if claimed < HOLD_SYNC_BATCH_SIZE:
+            return total
+
+async def backfill():
+    """Queues every message that is on any hold (initial rollout / full resync)."""
+    async with database.connection() as conn:
+        status = await conn.execute("""
+            INSERT INTO hold_sync_pending (message_id)
+            SELECT DISTINCT message_id FROM legal_hold_items
+            ON CONFLICT (message_id) DO NOTHING
+        """)
+    return int(status.split()[-1])
+
+async def start_worker():
+    logger.info(f"Hold Sync Worker Started. Polling every {HOLD_SYNC_POLL_SECONDS:g} seconds.")
+    while True:
+        try:
+            synced = await sync_pending()
+            if synced:
+                logger.info(f"Synced hold_ids for {synced} messages.")
+        except Exception as e:
+            logger.error(f"Hold Sync Error: {e}")
+        await asyncio.sleep(HOLD_SYNC_POLL_SECONDS)
+
+if __name__ == "__main__":
+    # Usage: python hold_sync.py [backfill]
+    async def _main():
+        await database.connect()
+        try:
+            if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+                print(f"Queued {await backfill()} messages.")
+            print(f"Synced {await sync_pending()} messages.")
+        finally:
+            await database.disconnect()
+
+    asyncio.run(_main())
@@ -0,0 +1,204 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+import ingest_outbox
+import metrics
+import search
+
+logger = logging.getLogger("IndexQueue")
+
+# Write-behind buffer in front of Meilisearch. Documents from concurrent sync
+# requests and SMTP deliveries are appended to a spill file (fsync'd) and
+# acknowledged, then flushed as one add_documents call once MAX_DOCS are
+# buffered or FLUSH_MS has passed. The spill file is replayed on startup, so
+# an acknowledged message survives a crash; replays are safe because
+# Meilisearch upserts by id.
+INDEX_QUEUE_MAX_DOCS = int(os.getenv("INDEX_QUEUE_MAX_DOCS", "1000"))
+INDEX_QUEUE_FLUSH_MS = int(os.getenv("INDEX_QUEUE_FLUSH_MS", "500"))
+INDEX_QUEUE_SPILL_PATH = os.getenv("INDEX_QUEUE_SPILL_PATH", "data/index_queue.jsonl")
+INDEX_QUEUE_RETRY_MAX_SECONDS = float(os.getenv("INDEX_QUEUE_RETRY_MAX_SECONDS", "30"))
+
+class IndexQueue:
+    """
+    One queue per process; the spill path must not be shared between processes.
+    The lock, buffer and wake event belong to the app loop: callers on other
+    threads (the SMTP server) must submit through run_coroutine_threadsafe.
+    While a batch is in flight its spill segment is renamed to
+    <path>.flushing.<n> and removed once Meilisearch has accepted the task.
+    """
+    def __init__(self, max_docs: int, flush_ms: int, spill_path: str):
+        self.max_docs = max(1, max_docs)
+        self.flush_interval = max(flush_ms, 1) / 1000
+        self.spill_path = spill_path
+        self._buffer = []
+        self._spill = None
+        self._segment = 0
+        self._lock = asyncio.Lock()
+        self._wake = asyncio.Event()
+        self._task = None
+
+    # --- Spill file (blocking helpers, run in threads) ---
+
+    def _open_spill(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.spill_path)), exist_ok=True)
+        self._spill = open(self.spill_path, 'a', encoding='utf-8')
+
+    def _append_spill(self, lines: str):
+        self._spill.write(lines)
+        self._spill.flush()
+        os.fsync(self._spill.fileno())
+
+    def _rotate_spill(self) -> str:
+        """Moves the current segment aside for an in-flight flush and starts a new one."""
+        self._spill.close()
+        self._segment += 1
+        flushing_path = f"{self.spill_path}.flushing.{self._segment}"
+        os.replace(self.spill_path, flushing_path)
+        self._open_spill()
+        return flushing_path
+
+    def _replay_spill(self) -> list:
+        docs = []
+        paths = sorted(glob.glob(f"{glob.escape(self.spill_path)}.flushing.*"))
+        if os.path.exists(self.spill_path):
+            paths.append(self.spill_path)
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        docs.append(json.loads(line))
+                    except ValueError:
+                        # Torn last line from a crash mid-write: it was never acknowledged
+                        logger.warning(f"Skipping unreadable line in {path}")
+        if paths:
+            # Rewrite everything into a single fresh segment before dropping the old files
+            tmp_path = f"{self.spill_path}.replay"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(d) + '\n' for d in docs))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.spill_path)
+            for path in paths:
+                if path != self.spill_path:
+                    os.remove(path)
+        self._open_spill()
+        return docs
+
+    # --- Lifecycle ---
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._buffer = await asyncio.to_thread(self._replay_spill)
+        if self._buffer:
+            logger.info(f"Replayed {len(self._buffer)} unflushed documents from {self.spill_path}.")
+            self._wake.set()
+        metrics.set_gauge("index_queue_depth", len(self._buffer))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flushes what is buffered; anything that fails stays in the spill file."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    # --- Producer side ---
+
+    async def submit(self, documents: list):
+        """
+        Durably queues documents for indexing and returns once they are on disk.
+        Raises if the spill write fails (the caller must not acknowledge).
+        """
+        if not documents:
+            return
+        if self._task is None:
+            await self.start()
+        lines = ''.join(json.dumps(d) + '\n' for d in documents)
+        async with self._lock:
+            await asyncio.to_thread(self._append_spill, lines)
+            self._buffer.extend(documents)
+            depth = len(self._buffer)
+        metrics.inc("index_queue_submitted_docs", len(documents))
+        metrics.set_gauge("index_queue_depth", depth)
+        if depth >= self.max_docs:
+            self._wake.set()
+
+    # --- Flusher ---
+
+    async def _run(self):
+        backoff = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=backoff)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                ok = await self.flush()
+            except Exception as e:
+                logger.error(f"Index queue flush error: {e}")
+                ok = False
+            backoff = self.flush_interval if ok else min(max(backoff * 2, 1.0), INDEX_QUEUE_RETRY_MAX_SECONDS)
+
+    async def flush(self) -> bool:
+        """Sends everything buffered in MAX_DOCS chunks. Returns False if any chunk failed."""
+        async with self._lock:
+            if not self._buffer:
+                return True
+            docs, self._buffer = self._buffer, []
+            flushing_path = await asyncio.to_thread(self._rotate_spill)
+
+        started = time.perf_counter()
+        failed = []
+        for i in range(0, len(docs), self.max_docs):
+            chunk = docs[i:i + self.max_docs]
+            task_uid = None if failed else await search.index_documents(chunk)
+            if task_uid is None:
+                failed.extend(chunk)
+                continue
+            try:
+                await ingest_outbox.mark_enqueued([d['id'] for d in chunk], task_uid)
+            except Exception as e:
+                # Rows stay PENDING; the outbox drainer will re-send them after its grace period
+                logger.warning(f"Could not mark outbox rows enqueued (task {task_uid}): {e}")
+        metrics.observe("index_queue_flush_seconds", time.perf_counter() - started)
+
+        if failed:
+            # Put the failed documents back into the live segment before dropping the old one
+            lines = ''.join(json.dumps(d) + '\n' for d in failed)
+            async with self._lock:
+                await asyncio.to_thread(self._append_spill, lines)
+                self._buffer[:0] = failed
+                depth = len(self._buffer)
+            metrics.inc("index_queue_flush_failures")
+            logger.warning(f"Index flush failed, {len(failed)} documents requeued.")
+        else:
+            depth = len(self._buffer)
+
+        await asyncio.to_thread(os.remove, flushing_path)
+        metrics.inc("index_queue_flushed_docs", len(docs) - len(failed))
+        metrics.set_gauge("index_queue_depth", depth)
+        return not failed
+
+queue = IndexQueue(INDEX_QUEUE_MAX_DOCS, INDEX_QUEUE_FLUSH_MS, INDEX_QUEUE_SPILL_PATH)
+
+async def start():
+    await queue.start()
+
+async def stop():
+    await queue.stop()
+
+async def submit(documents: list):
+    await queue.submit(documents)
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import os
+import httpx
+import database
+import metrics
+import search
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("IngestOutbox")
+
+# Every message whose blob is stored gets an ingest_outbox row before the
+# sidecar is acknowledged. Rows move PENDING -> ENQUEUED (Meilisearch task
+# uid known) and are deleted once that task has succeeded, so the table only
+# ever holds messages that may not be searchable yet. The drainer below
+# re-sends stale PENDING rows with exponential backoff and reconciles
+# ENQUEUED rows against the Meilisearch task API; recovery never needs a
+# bucket scan.
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "30"))
+# PENDING rows younger than this are still expected to go out via index_queue
+OUTBOX_GRACE_SECONDS = int(os.getenv("OUTBOX_GRACE_SECONDS", "300"))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_BACKOFF_BASE_SECONDS = int(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "30"))
+OUTBOX_BACKOFF_MAX_SECONDS = int(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "3600"))
+
+async def record(documents: list):
+    """Writes (or re-arms) outbox rows for freshly stored messages."""
+    if not documents:
+        return
+    async with database.connection() as conn:
+        await conn.execute("""
+            INSERT INTO ingest_outbox (message_id, document)
+            SELECT * FROM unnest($1::text[], $2::jsonb[])
+            ON CONFLICT (message_id) DO UPDATE
+            SET document = EXCLUDED.document, status = 'PENDING', task_uid = NULL,
+                attempts = 0, next_attempt_at = CURRENT_TIMESTAMP, last_error = NULL,
+                updated_at = CURRENT_TIMESTAMP
+        """, [d['id'] for d in documents], [json.dumps(d) for d in documents])
+
+async def mark_enqueued(message_ids: list, task_uid: int):
+    """Called once Meilisearch has accepted the add_documents task."""
+    if not message_ids:
+        return
+    async with database.connection() as conn:
+        await conn.execute("""
+            UPDATE ingest_outbox
+            SET status = 'ENQUEUED', task_uid = $2, updated_at = CURRENT_TIMESTAMP
+            WHERE message_id = ANY($1::text[])
+        """, message_ids, task_uid)
+
+async def _mark_retry(conn, message_ids: list, error: str):
+    await conn.execute("""
+        UPDATE ingest_outbox
+        SET status = 'PENDING', task_uid = NULL, attempts = attempts + 1, last_error = $2,
+            next_attempt_at = CURRENT_TIMESTAMP
+                + make_interval(secs => LEAST($3::float8 * power(2, attempts), $4::float8)),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE message_id = ANY($1::text[])
+    """, message_ids, error, OUTBOX_BACKOFF_BASE_SECONDS, OUTBOX_BACKOFF_MAX_SECONDS)
+
+async def reconcile(conn) -> int:
+    """Resolves ENQUEUED rows against Meilisearch task status. Returns rows completed."""
+    tasks = await conn.fetch("""
+        SELECT task_uid, array_agg(message_id) AS ids
+        FROM ingest_outbox
+        WHERE status = 'ENQUEUED' AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => $1::float8)
+        GROUP BY task_uid
+        LIMIT $2
+    """, OUTBOX_POLL_SECONDS, OUTBOX_BATCH_SIZE)
+
+    completed = 0
+    for t in tasks:
+        ids = list(t['ids'])
+        try:
+            task = await search.async_client.get_task(t['task_uid'])
+            status = task['status']
+            error = (task.get('error') or {}).get('message')
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            # Task history was pruned: fall back to checking the documents themselves
+            indexed = await search.existing_ids(ids)
+            missing = [mid for mid in ids if mid not in indexed]
+            await conn.execute("DELETE FROM ingest_outbox WHERE message_id = ANY($1::text[])", list(indexed))
+            if missing:
+                await _mark_retry(conn, missing, f"task {t['task_uid']} not found")
+            completed += len(indexed)
+            continue
+
+        if status == 'succeeded':
+            await conn.execute("DELETE FROM ingest_outbox WHERE message_id = ANY($1::text[])", ids)
+            completed += len(ids)
+        elif status in ('failed', 'canceled'):
+            logger.warning(f"Index task {t['task_uid']} {status} for {len(ids)} messages: {error}")
+            await _mark_retry(conn, ids, error or status)
+    return completed
+
+async def retry_pending(conn) -> int:
+    """Re-sends PENDING rows whose grace period/backoff has elapsed. Returns rows re-sent."""
+    rows = await conn.fetch("""
+        SELECT message_id, document FROM ingest_outbox
+        WHERE status = 'PENDING'
+          AND next_attempt_at <= CURRENT_TIMESTAMP
+          AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => $1::float8)
+        ORDER BY next_attempt_at
+        LIMIT $2
+    """, OUTBOX_GRACE_SECONDS, OUTBOX_BATCH_SIZE)
+    if not rows:
+        return 0
+
+    ids = [r['message_id'] for r in rows]
+    docs = [json.loads(r['document']) for r in rows]
+    task_uid = await search.index_documents(docs)
+    if task_uid is None:
+        await _mark_retry(conn, ids, "index request failed")
+        metrics.inc("ingest_outbox_retry_failures")
+        return 0
+
+    await conn.execute("""
+        UPDATE ingest_outbox
+        SET status = 'ENQUEUED', task_uid = $2, attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+        WHERE message_id = ANY($1::text[])
+    """, ids, task_uid)
+    metrics.inc("ingest_outbox_retried", len(ids))
+    return len(ids)
+
+async def drain_once():
+    async with database.connection() as conn:
+        completed = await reconcile(conn)
+        retried = await retry_pending(conn)
+        counts = await conn.fetch("SELECT status, count(*) AS n FROM ingest_outbox GROUP BY status")
+
+    for status in ('PENDING', 'ENQUEUED'):
+        metrics.set_gauge("ingest_outbox_rows", 0, status=status)
+    for r in counts:
+        metrics.set_gauge("ingest_outbox_rows", r['n'], status=r['status'])
+    metrics.inc("ingest_outbox_completed", completed)
+    if completed or retried:
+        logger.info(f"Outbox drain: {completed} confirmed indexed, {retried} re-sent.")
+
+async def start_worker():
+    logger.info(f"Ingest Outbox Drainer Started. Running every {OUTBOX_POLL_SECONDS:g} seconds.")
+    while True:
+        try:
+            await drain_once()
+        except Exception as e:
+            logger.error(f"Ingest Outbox Drainer Error: {e}")
+        await asyncio.sleep(OUTBOX_POLL_SECONDS)
+
+if __name__ == "__main__":
+    asyncio.run(start_worker())
@@ -1,90 +1,49 @@
 import asyncio
 import logging
-import json
-import database
-import integrity
+import os
+import time
+import audit_chain
+import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("IntegrityWorker")
 
-async def verify_chains():
+# Regular runs only verify audit entries appended since each org's checkpoint
+# (see audit_chain.py); every AUDIT_FULL_VERIFY_HOURS the whole history is
+# re-verified, orgs in parallel.
+AUDIT_VERIFY_INTERVAL = int(os.getenv("AUDIT_VERIFY_INTERVAL", "600"))
+AUDIT_FULL_VERIFY_HOURS = float(os.getenv("AUDIT_FULL_VERIFY_HOURS", "24"))
+
+_last_full = None
+
+async def verify_chains(full: bool = False):
     """Verifies the hash chain integrity for all organizations."""
+    started = time.perf_counter()
     try:
-        # We need a SUPER ADMIN connection to bypass RLS for this worker!
-        # Assuming the worker runs with Super Admin privileges or bypassing RLS.
-        # How to bypass RLS in worker?
-        # Option 1: Set 'app.current_role' = 'super_admin' on connection.
-        conn = await database.get_db_connection()
-        try:
-            # Set Super Admin Context
-            await conn.execute("SELECT set_config('app.current_role', 'super_admin', false)")
-            
-            # Get All Orgs
-            orgs = await conn.fetch("SELECT id, name FROM organizations")
-            
-            for org in orgs:
-                oid = org['id']
-                logger.debug(f"Verifying Audit Chain for Org {oid} ({org['name']})...")
-                
-                # Fetch Logs sequentially
-                # Note: For huge logs, this should be paginated or streamed. 
-                # For MVP/PoC, fetching all.
-                rows = await conn.fetch("SELECT id, username, action, details, previous_hash, current_hash FROM audit_logs WHERE org_id = $1 ORDER BY id ASC", oid)
-                
-                if not rows:
-                    continue
-                    
-                last_hash = "ROOT_HASH"
-                for r in rows:
-                    failed = False
-                    reason = ""
-                    
-                    # 1. Check Previous Link
-                    if r['previous_hash'] != last_hash:
-                        failed = True
-                        reason = f"Link Mismatch at ID {r['id']}. Expected prev={last_hash}, Got={r['previous_hash']}"
-                    
-                    # 2. Verify Computation
-                    else:
-                        # Re-compute
-                        # Need to ensure details formatting matches exactly what was inserted.
-                        # admin.py uses json.dumps(details, sort_keys=True)
-                        details_val = r['details']
-                        if isinstance(details_val, str):
-                            details_dict = json.loads(details_val)
-                        else:
-                            details_dict = details_val if details_val else {}
-                            
-                        details_str = json.dumps(details_dict, sort_keys=True)
-                        
-                        payload = f"{r['previous_hash']}{r['username']}{r['action']}{details_str}{oid}"
-                        expected_hash = integrity.calculate_hash(payload.encode())
-                        
-                        if r['current_hash'] != expected_hash:
-                            failed = True
-                            reason = f"Hash Mismatch at ID {r['id']}. Re-computed={expected_hash}, Stored={r['current_hash']}"
-                    
-                    if failed:
-                        logger.error(f"[SECURITY ALERT] TAMPERING DETECTED in Org {oid}: {reason}")
-                        # In real world: Send Email / Slack Alert / SNMP Trap
-                        break # Stop checking this chain
-                    
-                    last_hash = r['current_hash']
-                    
-                else:
-                    logger.debug(f"Org {oid} Audit Chain Integrated Verified ({len(rows)} entries).")
-
-        finally:
-            await conn.close()
-            
+        results = await audit_chain.verify_all(full=full)
+        elapsed = time.perf_counter() - started
+        metrics.set_gauge("integrity_cycle_seconds", round(elapsed, 3), mode="full" if full else "incremental")
+        metrics.set_gauge("integrity_cycle_orgs", len(results))
+        if elapsed > AUDIT_VERIFY_INTERVAL:
+            logger.warning(f"Verification cycle took {elapsed:.0f}s for {len(results)} orgs (interval {AUDIT_VERIFY_INTERVAL}s).")
+        for oid, result in results.items():
+            if result['valid']:
+                logger.debug(f"Org {oid} Audit Chain Verified ({result['verified']} new, {result['log_count']} total entries).")
+        # Tampering is logged (and counted in audit_verify_failures) by audit_chain
+        # In real world: Send Email / Slack Alert / SNMP Trap
+        return results
     except Exception as e:
         logger.error(f"Integrity Worker Error: {e}")
 
 async def start_worker():
-    logger.info("Integrity Worker Started. Running every 10 minutes.")
+    global _last_full
+    logger.info(f"Integrity Worker Started. Running every {AUDIT_VERIFY_INTERVAL // 60} minutes (full re-verification every {AUDIT_FULL_VERIFY_HOURS:g} hours).")
     while True:
-        await verify_chains()
-        await asyncio.sleep(600) # 10 minutes
+        full = _last_full is None or time.monotonic() - _last_full >= AUDIT_FULL_VERIFY_HOURS * 3600
+        await verify_chains(full=full)
+        if full:
+            _last_full = time.monotonic()
+        await asyncio.sleep(AUDIT_VERIFY_INTERVAL)
 
 if __name__ == "__main__":
     asyncio.run(start_worker())
@@ -13,6 +13,7 @@ import storage
 import search
 import admin
 import database
+import queries
 import cases
 import exports
 import threads
@@ -22,7 +23,20 @@ import integrity
 import security
 import retention_worker
 import integrity_worker
+import scrub_worker
+import message_cache
+import audit_writer
+import audit_chain
 import smtp_server
+import org_resolver
+import enrichment
+import sync_stream
+import cas_manifest
+import index_queue
+import hold_index
+import hold_sync
+import ingest_outbox
+import metrics
 import asyncio
 
 app = FastAPI(title="OpenArchive Core API")
@@ -46,6 +60,44 @@ async def startup_db_client():
     except Exception as e:
         print(f"Migration warning: {e}")
     
+    # Check/Create the blob bucket once; storage only re-checks after NoSuchBucket
+    try:
+        await storage.blob_store.ensure_ready()
+    except Exception as e:
+        print(f"Blob store check failed: {e}")
+    
+    # Apply Meilisearch index settings once (only pushed if they differ from the live config)
+    try:
+        await search.ensure_index()
+    except Exception as e:
+        print(f"Search index setup failed: {e}")
+    # Pagination key for documents indexed before id_key existed (no-op once done)
+    asyncio.create_task(search.run_id_key_backfill())
+    
+    # Load Domain -> Org Index and keep it fresh via LISTEN/NOTIFY
+    await org_resolver.refresh()
+    asyncio.create_task(org_resolver.start_listener())
+    
+    # Keep per-org legal hold indexes coherent across core processes
+    asyncio.create_task(hold_index.start_listener())
+    
+    # Load CAS Manifest Bloom Filter (answers /cas/check without S3 HEADs)
+    try:
+        await cas_manifest.load()
+    except Exception as e:
+        print(f"CAS manifest load failed: {e}")
+    
+    # Start the audit hash pool (spawn context, see audit_chain.py)
+    audit_chain.start()
+    
+    # Start Write-Behind Index Queue (replays anything left in the spill file)
+    await index_queue.start()
+    
+    # Start Ingest Outbox Drainer (re-sends/reconciles unindexed messages)
+    asyncio.create_task(ingest_outbox.start_worker())
+    
+    # Start Hold Sync Worker (pushes hold_ids partial updates to the index)
+    asyncio.create_task(hold_sync.start_worker())
     
     # Start Retention Worker (Background Loop)
     asyncio.create_task(retention_worker.start_worker())
@@ -53,12 +105,19 @@ async def startup_db_client():
     # Start Integrity Worker (Background Loop)
     asyncio.create_task(integrity_worker.start_worker())
     
+    # Start Scrub Worker (throttled re-verification of stored blobs)
+    asyncio.create_task(scrub_worker.start_worker())
+    
     # Start SMTP Server (Port 2525)
     smtp_server.start_smtp_server()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await index_queue.stop()
+    await audit_writer.flush()
+    audit_chain.shutdown()
     await database.disconnect()
+    await search.close()
 
     # Initialize Search
 
@@ -66,6 +125,7 @@ app.include_router(admin.router, prefix="/api/v1/admin", tags=["admin"])
 app.include_router(cases.router, prefix="/api/v1/cases", tags=["cases"])
 
 API_KEY = os.getenv("CORE_API_KEY", "secret")
+SYNC_CONCURRENCY = int(os.getenv("SYNC_CONCURRENCY", "8"))
 
 class SyncItem(BaseModel):
     id: str
@@ -87,9 +147,8 @@ async def login(creds: LoginRequest):
         return {"id": 1, "username": "admin", "role": "super_admin", "org_id": 1, "domains": []}
 
     # 2. Database Lookup
-    conn = await database.get_db_connection()
-    try:
-        user = await conn.fetchrow("SELECT * FROM users WHERE username = $1", creds.username)
+    async with database.connection() as conn:
+        user = await queries.fetchrow(conn, 'user_by_username', creds.username)
         if user:
             # 3. Verify Password
             if not user['password_hash']:
@@ -123,185 +182,170 @@ async def login(creds: LoginRequest):
             }
         
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    finally:
-        await conn.close()
+
+def _hash_and_sign(blob_data: bytes):
+    """CPU-bound integrity work, run in a worker thread."""
+    return integrity.calculate_hash(blob_data), integrity.sign_data(blob_data)
+
+async def _store_sync_blob(item_id: str, key: str, metadata: Dict[str, Any], blob_data: bytes):
+    """
+    Hashes and uploads one message blob (both off the event loop).
+    Returns (result, doc) where doc is None if the item failed.
+    """
+    try:
+        object_name = f"{item_id}.enc"
+        (sha_hash, signature), uploaded = await asyncio.gather(
+            asyncio.to_thread(_hash_and_sign, blob_data),
+            storage.blob_store.put(object_name, blob_data),
+        )
+        if not uploaded:
+            print(f"Failed to upload blob for {item_id}")
+            return {"id": item_id, "ok": False, "error": "upload failed"}, None
+
+        # Prepare Metadata for Indexing (tenant/address enrichment happens per batch)
+        doc = metadata
+        doc['id'] = item_id
+        doc['key'] = key 
+        doc['size'] = len(blob_data)
+        
+        # CRYPTOGRAPHIC INTEGRITY
+        doc['sha256'] = sha_hash
+        doc['signature'] = signature
+        
+        return {"id": item_id, "ok": True}, doc
+            
+    except Exception as e:
+        print(f"Error processing item {item_id}: {e}")
+        return {"id": item_id, "ok": False, "error": str(e)}, None
+
+async def _ingest_sync_item(item: SyncItem, semaphore: asyncio.Semaphore):
+    """Runs one base64 SyncItem through decode -> hash -> upload."""
+    async with semaphore:
+        try:
+            blob_data = await asyncio.to_thread(base64.b64decode, item.blob_b64)
+        except Exception as e:
+            print(f"Error processing item {item.id}: {e}")
+            return {"id": item.id, "ok": False, "error": str(e)}, None
+        return await _store_sync_blob(item.id, item.key, item.metadata, blob_data)
+
+async def _finish_sync(outcomes):
+    """Enrichment + batch indexing shared by the JSON and binary sync endpoints."""
+    results = [result for result, _ in outcomes]
+    documents_to_index = [doc for _, doc in outcomes if doc is not None]
+
+    # Enrichment stage: org resolution + address/domain/date fields for the whole batch
+    if documents_to_index:
+        await enrichment.enrich_batch(documents_to_index)
+
+    # Record in the ingest outbox, then hand off to the write-behind index queue.
+    # Nothing is acknowledged until both are durable.
+    if documents_to_index:
+        try:
+            await ingest_outbox.record(documents_to_index)
+            await index_queue.submit(documents_to_index)
+        except Exception as e:
+            print(f"Error queueing documents for indexing: {e}")
+            # Blobs are stored but not queued: report failure so the sidecar retries.
+            for result in results:
+                if result["ok"]:
+                    result["ok"] = False
+                    result["error"] = "index failed"
+
+    processed = sum(1 for r in results if r["ok"])
+    return {"status": "ok", "processed": processed, "results": results}
 
 @app.post("/api/v1/sync")
 async def sync_messages(payload: SyncBatch, x_api_key: str = Header(None), x_org_id: int = Header(1)):
     if x_api_key != API_KEY:
         raise HTTPException(status_code=401, detail="Invalid API Key")
     
-    successful_ids = []
-    documents_to_index = []
-    
-    for item in payload.batch:
+    # Pipeline: every item is decoded, hashed and uploaded concurrently,
+    # bounded by SYNC_CONCURRENCY so a large batch can't exhaust the S3/DB pools.
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+    outcomes = await asyncio.gather(*[_ingest_sync_item(item, semaphore) for item in payload.batch])
+    return await _finish_sync(outcomes)
+
+async def _store_cas_blob(blob_hash: str, blob_data: bytes):
+    uploaded = await storage.blob_store.put(cas_manifest.cas_object_name(blob_hash), blob_data)
+    if uploaded:
+        await cas_manifest.record([(blob_hash, len(blob_data))])
+    return {"hash": blob_hash, "ok": bool(uploaded)}
+
+@app.post("/api/v1/sync/stream")
+async def sync_messages_stream(request: Request, x_api_key: str = Header(None), x_org_id: int = Header(1)):
+    """
+    Binary sync: length-prefixed frames (see sync_stream.py) instead of a JSON
+    body of base64 blobs. Blobs are read one frame at a time and handed to an
+    upload task; at most SYNC_CONCURRENCY blobs, and SYNC_STREAM_MAX_BUFFERED_BYTES
+    of blob data, are held in memory at once.
+    """
+    if x_api_key != API_KEY:
+        raise HTTPException(status_code=401, detail="Invalid API Key")
+
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+    budget = sync_stream.ByteBudget(sync_stream.MAX_BUFFERED_BYTES)
+    message_tasks = []
+    cas_tasks = []
+
+    async def run_bounded(coro, nbytes):
         try:
-            # 1. Decode Blob
-            blob_data = base64.b64decode(item.blob_b64)
-            
-            # 2. Upload to Storage
-            object_name = f"{item.id}.enc"
-            if storage.upload_blob(object_name, blob_data):
-                successful_ids.append(item.id)
-                
-                # 3. Prepare Metadata for Indexing
-                doc = item.metadata
-                doc['id'] = item.id
-                doc['key'] = item.key 
-                
-                # MULTI-TENANT RESOLUTION
-                # 1. Extract Domains
-                domain_set = set()
-                def extract_all_domains(email_val):
-                    if not email_val: return
-                    if isinstance(email_val, list):
-                        for e in email_val: extract_all_domains(e)
-                    elif isinstance(email_val, str):
-                        if "@" in email_val:
-                            d = email_val.split("@")[-1].strip().lower().rstrip('>')
-                            domain_set.add(d)
-                
-                extract_all_domains(doc.get('from'))
-                extract_all_domains(doc.get('to'))
-                extract_all_domains(doc.get('envelope_from'))
-                extract_all_domains(doc.get('envelope_rcpt'))
-                
-                # 2. Query DB for matching Orgs
-                # Using a fresh connection for this request
-                domain_list = list(domain_set)
-                resolved_org_ids = []
-                
+            return await coro
+        finally:
+            await budget.release(nbytes)
+            semaphore.release()
+
+    reader = sync_stream.FrameReader(request.stream())
+    try:
+        try:
+            while True:
+                header = await reader.read_header()
+                if header is None:
+                    break
+                ftype, length = header
+                if ftype == sync_stream.FRAME_BLOB:
+                    raise sync_stream.FrameError("Blob frame without metadata")
+                meta = await reader.read_metadata(length)
+
+                # Backpressure: don't pull the next blob off the socket until an
+                # upload slot is free and its bytes fit in the buffer budget
+                blob_length = await reader.expect_blob_header()
+                await semaphore.acquire()
                 try:
-                    conn = await database.get_db_connection()
-                    try:
-                        # Find orgs where any of the email domains exist in the organization's 'domains' array
-                        # Postgres overlap operator: domains && ARRAY[...]
-                        q = "SELECT id FROM organizations WHERE domains && $1" 
-                        rows = await conn.fetch(q, domain_list)
-                        resolved_org_ids = [r['id'] for r in rows]
-                    finally:
-                        await conn.close()
-                except Exception as e:
-                    print(f"Error resolving orgs: {e}")
-
-                # 3. Fallback to Default Org (1) if no resolution (or x_org_id if explicitly provided as fallback)
-                if not resolved_org_ids:
-                    resolved_org_ids = [1]
-                    
-                doc['org_id'] = resolved_org_ids # Now a LIST of integers
-                
-                # CRYPTOGRAPHIC INTEGRITY
-                doc['sha256'] = integrity.calculate_hash(blob_data)
-                doc['signature'] = integrity.sign_data(blob_data)
-                
-                # Robust email address extraction
-                def extract_email(email_str):
-                    if not email_str: return None
-                    import re
-                    # Handle "Name <email@domain.com>"
-                    match = re.search(r'<(.+?)>', email_str)
-                    if match: return match.group(1).lower().strip()
-                    # Handle "email@domain.com"
-                    if '@' in email_str: return email_str.strip().lower()
-                    return None
-
-                # Robust domain extraction
-                def extract_domain(email_str):
-                    email = extract_email(email_str)
-                    if email:
-                        return email.split('@')[-1]
-                    return None
-
-                # Indexing clean emails for Legal Holds
-                recipient_emails = set()
-                
-                # Header From
-                doc['sender_email'] = extract_email(doc.get('from'))
-                # Header To
-                to_val = doc.get('to')
-                if to_val:
-                    if isinstance(to_val, list):
-                        for t in to_val:
-                            e = extract_email(t)
-                            if e: recipient_emails.add(e)
+                    await budget.acquire(blob_length)
+                except BaseException:
+                    semaphore.release()
+                    raise
+                try:
+                    blob_data = await reader.read_body(blob_length)
+                    if ftype == sync_stream.FRAME_MESSAGE:
+                        coro = _store_sync_blob(meta['id'], meta['key'], meta.get('metadata') or {}, blob_data)
                     else:
-                        e = extract_email(to_val)
-                        if e: recipient_emails.add(e)
-                
-                # Envelope Overwrites/Additions
-                env_from = extract_email(doc.get('envelope_from'))
-                if env_from:
-                    doc['sender_email'] = env_from
-                
-                env_rcpts = doc.get('envelope_rcpt')
-                if env_rcpts:
-                    for r in env_rcpts:
-                        e = extract_email(r)
-                        if e: recipient_emails.add(e)
-                
-                doc['recipient_emails'] = list(recipient_emails)
-
-                # EXTRACT DOMAINS for Multi-Tenancy Filtering
-                domains = set()
-                recipient_domains = set()
-                sender_domain = None
-
-                # Check headers
-                s_dom = extract_domain(doc.get('from'))
-                if s_dom: 
-                    sender_domain = s_dom
-                    domains.add(s_dom)
-                
-                r_dom = extract_domain(doc.get('to'))
-                if r_dom:
-                    recipient_domains.add(r_dom)
-                    domains.add(r_dom)
-                
-                # Check envelope (more reliable)
-                env_s_dom = extract_domain(doc.get('envelope_from'))
-                if env_s_dom:
-                    sender_domain = env_s_dom # Envelope sender is more authoritative
-                    domains.add(env_s_dom)
-                    
-                if doc.get('envelope_rcpt'):
-                    for rcpt in doc['envelope_rcpt']:
-                        rd = extract_domain(rcpt)
-                        if rd:
-                            recipient_domains.add(rd)
-                            domains.add(rd)
-                
-                # Remove None and convert to list
-                doc['domains'] = list(filter(None, domains))
-                doc['sender_domain'] = sender_domain
-                doc['recipient_domains'] = list(filter(None, recipient_domains))
-
-                # SORTING: Add date_timestamp for Meilisearch sorting
-                import email.utils
-                date_str = doc.get('date')
-                if date_str:
-                    try:
-                        dt = email.utils.parsedate_to_datetime(date_str)
-                        doc['date_timestamp'] = int(dt.timestamp())
-                    except Exception as e:
-                        print(f"Warning: Failed to parse date '{date_str}': {e}")
-                        doc['date_timestamp'] = 0
-                else:
-                    doc['date_timestamp'] = 0
-                
-                # print(f"DEBUG: Ingesting {item.id} | Timestamp: {doc['date_timestamp']} | Domains: {doc['domains']}")
-                
-                documents_to_index.append(doc)
-            else:
-                print(f"Failed to upload blob for {item.id}")
-                
-        except Exception as e:
-            print(f"Error processing item {item.id}: {e}")
-
-    # 4. Batch Index
-    if documents_to_index:
-        search.index_documents(documents_to_index)
-        
-    return {"status": "ok", "processed": len(successful_ids)}
+                        coro = _store_cas_blob(meta['hash'], blob_data)
+                except BaseException:
+                    await budget.release(blob_length)
+                    semaphore.release()
+                    raise
+                tasks = message_tasks if ftype == sync_stream.FRAME_MESSAGE else cas_tasks
+                tasks.append(asyncio.create_task(run_bounded(coro, blob_length)))
+        except (sync_stream.FrameError, ValueError, KeyError, TypeError) as e:
+            # Let in-flight uploads finish; nothing from this request gets indexed
+            await asyncio.gather(*message_tasks, *cas_tasks, return_exceptions=True)
+            raise HTTPException(status_code=400, detail=f"Malformed sync stream: {e}")
+
+        cas_results = await asyncio.gather(*cas_tasks)
+        outcomes = await asyncio.gather(*message_tasks)
+    finally:
+        # Client disconnect or any other failure: don't leave uploads running unowned
+        pending = [t for t in (*message_tasks, *cas_tasks) if not t.done()]
+        for t in pending:
+            t.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    response = await _finish_sync(outcomes)
+    response["cas_saved"] = sum(1 for r in cas_results if r["ok"])
+    response["cas_results"] = cas_results
+    return response
 
 class CASCheckRequest(BaseModel):
     hashes: List[str]
@@ -312,13 +356,8 @@ async def check_cas_availability(req: CASCheckRequest, x_api_key: str = Header(N
         print(f"AUTH FAIL: Received='{x_api_key}' Expected='{API_KEY}'")
         raise HTTPException(status_code=401, detail="Invalid API Key")
     
-    result = {}
-    for h in req.hashes:
-        # Check existence of Encrypted Blob for this hash
-        # Key Pattern: cas_{hash}.enc
-        exists = storage.blob_exists(f"cas_{h}.enc")
-        result[h] = exists
-    return result
+    # Bloom filter + manifest table; only falls back to S3 if the manifest is unavailable
+    return await cas_manifest.check(req.hashes)
 
 class CASUploadItem(BaseModel):
     hash: str
@@ -332,14 +371,15 @@ async def upload_cas_blobs(payload: CASUploadBatch, x_api_key: str = Header(None
     if x_api_key != API_KEY:
         raise HTTPException(status_code=401, detail="Invalid API Key")
     
-    saved = 0
+    saved = []
     for item in payload.batch:
         blob_data = base64.b64decode(item.blob_b64)
         object_name = f"cas_{item.hash}.enc"
-        if storage.upload_blob(object_name, blob_data):
-            saved += 1
-            
-    return {"status": "ok", "saved": saved}
+        if await storage.blob_store.put(object_name, blob_data):
+            saved.append((item.hash, len(blob_data)))
+    
+    await cas_manifest.record(saved)
+    return {"status": "ok", "saved": len(saved)}
 
 @app.get("/api/v1/messages")
 async def search_messages(
@@ -355,7 +395,9 @@ async def search_messages(
     has_attachments: bool = None,
     is_spam: bool = None,
     direction: str = None, # 'sent', 'received', 'internal'
-    attachment_keyword: str = None
+    attachment_keyword: str = None,
+    held: bool = None, # filter on legal hold membership (hold_ids)
+    cursor: str = None # keyset pagination: "" for the first page, then next_cursor
 ):
     # Build filter query
     # org_id in Meilisearch is now an ARRAY of integers.
@@ -365,122 +407,115 @@ async def search_messages(
     
     
     
-    # DB Connection for Org Domain Lookup & Legal Holds
-    conn = await database.get_db_connection()
-    try:
-        if user_domain:
-            # Core restriction: Document must involve ONE of the user's domains
-            # Support comma-separated list
-            raw_domains = [d.strip() for d in user_domain.split(',') if d.strip()]
-            
-            # EXPAND: If a domain belongs to the Org, allow access to ALL Org domains (Domain Aliasing)
-            try:
-                org_domains_raw = await conn.fetchval("SELECT domains FROM organizations WHERE id = $1", org_id)
-                org_domains = set(org_domains_raw) if org_domains_raw else set()
-                
-                expanded_domains = set(raw_domains)
-                if not org_domains.isdisjoint(expanded_domains):
-                     expanded_domains.update(org_domains)
-                
-                u_domains = list(expanded_domains)
-            except Exception as e:
-                print(f"Error expanding domains: {e}")
-                u_domains = raw_domains
-            
-            if u_domains:
-                domain_filters = [f"domains = '{d}'" for d in u_domains]
-                filters.append(f"({' OR '.join(domain_filters)})")
-
+    if user_domain:
+        # Core restriction: Document must involve ONE of the user's domains
+        # Support comma-separated list
+        raw_domains = [d.strip() for d in user_domain.split(',') if d.strip()]
         
-        # Directional logic relative to user_domain(s) - Complex for multiple
-        # For now, if multiple domains, simplify direction logic or apply to all
-        if direction:
-             if direction == 'sent':
-                 # sender_domain IN [d1, d2]
-                 sd_filters = [f"sender_domain = '{d}'" for d in u_domains]
-                 filters.append(f"({' OR '.join(sd_filters)})")
-             elif direction == 'received':
-                 # recipient_domains matches ANY
-                 # recipient_domains = 'd1' OR recipient_domains = 'd2' - strictly checks containment
-                 rd_filters = [f"recipient_domains = '{d}'" for d in u_domains]
-                 filters.append(f"({' OR '.join(rd_filters)})")
-             elif direction == 'internal':
-                 # Both sender && recipient in allowed list
-                 # (sender_domain IN u_domains) AND (recipient_domains IN u_domains)
-                 sd_filters = [f"sender_domain = '{d}'" for d in u_domains]
-                 rd_filters = [f"recipient_domains = '{d}'" for d in u_domains]
-                 filters.append(f"({' OR '.join(sd_filters)}) AND ({' OR '.join(rd_filters)})")
-    
-        if from_addr:
-            if not q: q = from_addr
-            else: q = f"{q} {from_addr}"
+        # EXPAND: If a domain belongs to the Org, allow access to ALL Org domains (Domain Aliasing)
+        try:
+            await org_resolver.ensure_loaded()
+            org_domains = set(org_resolver.get_org_domains(org_id))
             
-        if to_addr:
-             if not q: q = to_addr
-             else: q = f"{q} {to_addr}"
-    
-        if has_attachments is not None:
-            filters.append(f"has_attachments = {str(has_attachments).lower()}")
+            expanded_domains = set(raw_domains)
+            if not org_domains.isdisjoint(expanded_domains):
+                 expanded_domains.update(org_domains)
             
-        if is_spam is not None:
-            filters.append(f"is_spam = {str(is_spam).lower()}")
-    
-        if date_start:
-             filters.append(f"date >= {date_start}")
-             
-        if date_end:
-             filters.append(f"date <= {date_end}")
-    
-        if attachment_keyword:
-            if not q:
-                q = attachment_keyword
-            else:
-                q = f"{q} {attachment_keyword}"
+            u_domains = list(expanded_domains)
+        except Exception as e:
+            print(f"Error expanding domains: {e}")
+            u_domains = raw_domains
+        
+        if u_domains:
+            domain_filters = [f"domains = '{d}'" for d in u_domains]
+            filters.append(f"({' OR '.join(domain_filters)})")
+
     
-        filter_query = " AND ".join(filters) if filters else None
+    # Directional logic relative to user_domain(s) - Complex for multiple
+    # For now, if multiple domains, simplify direction logic or apply to all
+    if direction:
+         if direction == 'sent':
+             # sender_domain IN [d1, d2]
+             sd_filters = [f"sender_domain = '{d}'" for d in u_domains]
+             filters.append(f"({' OR '.join(sd_filters)})")
+         elif direction == 'received':
+             # recipient_domains matches ANY
+             # recipient_domains = 'd1' OR recipient_domains = 'd2' - strictly checks containment
+             rd_filters = [f"recipient_domains = '{d}'" for d in u_domains]
+             filters.append(f"({' OR '.join(rd_filters)})")
+         elif direction == 'internal':
+             # Both sender && recipient in allowed list
+             # (sender_domain IN u_domains) AND (recipient_domains IN u_domains)
+             sd_filters = [f"sender_domain = '{d}'" for d in u_domains]
+             rd_filters = [f"recipient_domains = '{d}'" for d in u_domains]
+             filters.append(f"({' OR '.join(sd_filters)}) AND ({' OR '.join(rd_filters)})")
+
+    if from_addr:
+        if not q: q = from_addr
+        else: q = f"{q} {from_addr}"
         
-        results = search.search_documents(q, limit, filter_query, offset)
+    if to_addr:
+         if not q: q = to_addr
+         else: q = f"{q} {to_addr}"
+
+    if has_attachments is not None:
+        filters.append(f"has_attachments = {str(has_attachments).lower()}")
         
-        # Check for Legal Holds on results
-        if results and results.get('hits'):
-            # 1. Get all held message IDs for this org
-            held_ids = await conn.fetch("SELECT message_id FROM legal_hold_items i JOIN legal_holds h ON i.hold_id = h.id WHERE h.org_id = $1", org_id)
-            held_set = {r['message_id'] for r in held_ids}
-            
-            # 2. Get all held "Accounts" (criteria-based) for this org
-            active_holds = await conn.fetch("SELECT filter_criteria FROM legal_holds WHERE active = TRUE AND org_id = $1", org_id)
-            held_from = set()
-            held_to = set()
-            for h in active_holds:
-                crit = json.loads(h['filter_criteria'])
-                if crit.get('from'): held_from.add(crit['from'])
-                if crit.get('to'): held_to.add(crit['to'])
-
-            for hit in results['hits']:
-                # Clean email checks are most reliable
-                s_email = hit.get('sender_email')
-                r_emails = hit.get('recipient_emails', [])
-                
-                # Expose clean emails for UI
-                hit['sender_email_clean'] = s_email
-                hit['recipient_emails_clean'] = r_emails
-                
-                hit['is_on_hold'] = (
-                    hit['id'] in held_set or 
-                    s_email in held_from or 
-                    any(r in held_to for r in r_emails) or
-                    hit.get('from') in held_from or 
-                    hit.get('to') in held_to
-                )
-    finally:
-        await conn.close()
+    if is_spam is not None:
+        filters.append(f"is_spam = {str(is_spam).lower()}")
+
+    if held is not None:
+        # Same notion of "held" as the hit annotation below: hold items plus account holds
+        holds = await hold_index.get(org_id)
+        if held:
+            filters.append(search.held_filter(holds.held_from, holds.held_to))
+        else:
+            filters.append(search.not_held_filter(holds.held_from, holds.held_to))
+
+    if date_start:
+         filters.append(f"date >= {date_start}")
+         
+    if date_end:
+         filters.append(f"date <= {date_end}")
+
+    if attachment_keyword:
+        if not q:
+            q = attachment_keyword
+        else:
+            q = f"{q} {attachment_keyword}"
+
+    filter_query = " AND ".join(filters) if filters else None
+    
+    try:
+        results = await search.search_documents(q, limit, filter_query, offset, cursor=cursor)
+    except search.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        # Only cursor pages raise; offset searches degrade to an empty page
+        raise HTTPException(status_code=502, detail=f"Search failed: {e}")
+    
+    # Annotate legal holds from the cached per-org hold index (no DB round trips)
+    if results and results.get('hits'):
+        holds = await hold_index.get(org_id)
+        for hit in results['hits']:
+            # Expose clean emails for UI
+            hit['sender_email_clean'] = hit.get('sender_email')
+            hit['recipient_emails_clean'] = hit.get('recipient_emails', [])
+            hit['is_on_hold'] = holds.is_held(hit)
             
     return results
 
 @app.get("/api/v1/messages/{id}")
 async def get_message(id: str, org_id: int):
+    return await get_message_content(id, org_id)
+
+async def get_message_content(id: str, org_id: int):
+    """Parsed message for the view endpoints, served from message_cache when warm."""
+    return await message_cache.get_or_load(id, org_id, lambda: _load_message(id, org_id))
+
+async def _load_message(id: str, org_id: int):
     # 1. Fetch encrypted blob
-    blob_enc = storage.get_blob(f"{id}.enc")
+    blob_enc = await storage.blob_store.get(f"{id}.enc")
     if not blob_enc:
         raise HTTPException(status_code=404, detail="Message not found")
     
@@ -496,11 +531,12 @@ async def get_message(id: str, org_id: int):
     # Since meilisearch search is fast, we filter by ID
     
     try:
-        index = search.client.index('emails')
-        doc = index.get_document(id)
+        doc = await search.get_document(id)
+        if doc is None:
+            raise HTTPException(status_code=404, detail="Message not found")
         
         # Verify org_id in document
-        doc_org_id = getattr(doc, 'org_id', None) or doc.get('org_id')
+        doc_org_id = doc.get('org_id')
         
         # Determine access
         has_access = False
@@ -512,13 +548,7 @@ async def get_message(id: str, org_id: int):
         if not has_access:
             raise HTTPException(status_code=403, detail="Access denied to this message")
 
-        try:
-            # Try attribute access for newer meilisearch client
-            key = getattr(doc, 'key', None)
-        except AttributeError:
-            # Fallback for dict
-            key = doc.get('key')
-
+        key = doc.get('key')
         
         if not key:
              raise HTTPException(status_code=500, detail="Encryption key not found")
@@ -543,7 +573,7 @@ async def get_message(id: str, org_id: int):
                 for cas_hash in cas_matches:
                     print(f"DEBUG: Found CAS Ref {cas_hash} in message {id}")
                     # Fetch CAS Blob (Storage handles Master Key decryption automatically)
-                    cas_blob = storage.get_blob(f"cas_{cas_hash}.enc")
+                    cas_blob = await storage.blob_store.get(f"cas_{cas_hash}.enc")
                     
                     if cas_blob:
                         # Replace the placeholder with the actual content
@@ -556,6 +586,8 @@ async def get_message(id: str, org_id: int):
                              print(f"Error decoding CAS blob {cas_hash}: {e}")
                     else:
                         print(f"Warning: CAS Blob {cas_hash} not found.")
+                        # get() also returns None on transient errors: don't cache this view
+                        message_cache.skip_caching()
 
             # IMPROVED RETURN WITH BODY PARSING
             # Now parse the EML to extract the actual body for the UI
@@ -580,12 +612,13 @@ async def get_message(id: str, org_id: int):
                     
                     if cas_ref:
                         cas_hash = cas_ref.strip()
-                        blob_data = storage.get_blob(f"cas_{cas_hash}.enc")
+                        blob_data = await storage.blob_store.get(f"cas_{cas_hash}.enc")
                         if blob_data:
                             print(f"DEBUG: Re-hydrated CAS Attachment {cas_hash} ({len(blob_data)} bytes)")
                             payload = blob_data
                         else:
                             print(f"Warning: CAS Attachment Blob {cas_hash} not found.")
+                            message_cache.skip_caching()
                             # Fallback if possible. Check if it is multipart before calling get_content
                             if not part.is_multipart():
                                 payload = part.get_content()
@@ -703,11 +736,11 @@ async def get_message_headers_endpoint(id: str, org_id: int):
 async def get_message_thread(id: str, org_id: int):
     # threads.get_thread might need org_id awareness too, but for MVP let's assume get_message base logic is enough
     # Actually threads should also be org-scoped.
-    return threads.get_thread(id, org_id)
+    return await threads.get_thread(id, org_id)
 
 @app.get("/api/v1/messages/{id}/preview-redacted")
 async def preview_redacted_message(id: str, org_id: int):
-    msg = await get_message(id, org_id)
+    msg = await get_message_content(id, org_id)
     content = msg.get("content") or (base64.b64decode(msg["content_b64"]).decode('utf-8') if msg.get("content_b64") else "")
     return {
         "id": id,
@@ -718,21 +751,22 @@ async def preview_redacted_message(id: str, org_id: int):
 @app.get("/api/v1/messages/{id}/verify")
 async def verify_message_integrity(id: str, org_id: int):
     # 1. Fetch encrypted blob
-    blob_enc = storage.get_blob(f"{id}.enc")
+    blob_enc = await storage.blob_store.get(f"{id}.enc")
     if not blob_enc:
         return {"id": id, "verified": False, "error": "Blob not found"}
         
     # 2. Fetch metadata (signature)
     try:
-        index = search.client.index('emails')
-        doc = index.get_document(id)
+        doc = await search.get_document(id)
+        if doc is None:
+            return {"id": id, "status": "UNAVAILABLE", "verified": False, "error": "Metadata not found"}
         
         # Verify org
-        doc_org_id = getattr(doc, 'org_id', None) or doc.get('org_id')
+        doc_org_id = doc.get('org_id')
         if doc_org_id != org_id:
             raise HTTPException(status_code=403, detail="Access denied")
 
-        signature = getattr(doc, 'signature', None) or doc.get('signature')
+        signature = doc.get('signature')
         
         if not signature:
              return {"id": id, "status": "UNAVAILABLE", "verified": False, "error": "Signature not found in metadata"}
@@ -749,6 +783,12 @@ async def verify_message_integrity(id: str, org_id: int):
     except Exception as e:
         return {"id": id, "status": "ERROR", "verified": False, "error": str(e)}
 
+@app.get("/api/v1/metrics")
+async def get_metrics(x_api_key: str = Header(None)):
+    if x_api_key != API_KEY:
+        raise HTTPException(status_code=401, detail="Invalid API Key")
+    return metrics.snapshot()
+
 @app.get("/health")
 def health():
     return {"status": "healthy"}
@@ -0,0 +1,149 @@
+import asyncio
+import contextvars
+import os
+import time
+from collections import OrderedDict
+import metrics
+
+# Parsed message results (get_message's decrypted + re-hydrated + parsed
+# dict), keyed by (id, org_id) so an access check made on load is never
+# reused across orgs. Opening a message fires /messages/{id}, /headers and
+# /preview-redacted together; concurrent misses on one key share a single
+# load, and the rest are served from memory. Bounded by total bytes (LRU
+# eviction) and by age (MESSAGE_CACHE_TTL). Cached values are shared:
+# callers must not mutate them. A loader that had to degrade its result
+# (e.g. a blob read failed) calls skip_caching() so it is served only once.
+MESSAGE_CACHE_MAX_BYTES = int(os.getenv("MESSAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+MESSAGE_CACHE_TTL = float(os.getenv("MESSAGE_CACHE_TTL", "300"))
+# Larger results (huge attachments) are returned but not cached
+MESSAGE_CACHE_MAX_ITEM_BYTES = int(os.getenv("MESSAGE_CACHE_MAX_ITEM_BYTES", str(MESSAGE_CACHE_MAX_BYTES // 8)))
+
+def _size(value) -> int:
+    """Approximate footprint: the length of every string/bytes in the result."""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_size(v) for v in value.values()) + 64
+    if isinstance(value, (list, tuple)):
+        return sum(_size(v) for v in value) + 64
+    return 16
+
+# Per-load flags of the loader running in this task (see skip_caching)
+_load_state = contextvars.ContextVar("message_cache_load_state", default=None)
+# Handed to in-flight waiters when the owning request was cancelled
+_RETRY = object()
+
+class MessageCache:
+    def __init__(self, max_bytes: int, ttl: float, max_item_bytes: int):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_item_bytes = max_item_bytes
+        self.entries = OrderedDict()  # key -> (expires_at, size, value)
+        self.keys_by_id = {}          # id -> {keys}, for invalidation
+        self.bytes = 0
+        self.loading = {}             # key -> Future of an in-flight load
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+        keys = self.keys_by_id.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_id[key[0]]
+
+    def _publish(self):
+        metrics.set_gauge("message_cache_bytes", self.bytes)
+        metrics.set_gauge("message_cache_entries", len(self.entries))
+
+    def get(self, id: str, org_id: int):
+        key = (id, org_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._remove(key)
+            self._publish()
+            return None
+        self.entries.move_to_end(key)
+        return entry[2]
+
+    def put(self, id: str, org_id: int, value):
+        size = _size(value)
+        if size > self.max_item_bytes:
+            metrics.inc("message_cache_skipped_large")
+            return
+        key = (id, org_id)
+        if key in self.entries:
+            self._remove(key)
+        self.entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.keys_by_id.setdefault(id, set()).add(key)
+        self.bytes += size
+        while self.bytes > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+            metrics.inc("message_cache_evictions")
+        self._publish()
+
+    def invalidate(self, ids):
+        for id in ids:
+            for key in list(self.keys_by_id.get(id, ())):
+                self._remove(key)
+        self._publish()
+
+    async def get_or_load(self, id: str, org_id: int, loader):
+        """Cached value, or loader() once per key however many callers miss at the same time."""
+        key = (id, org_id)
+        while True:
+            value = self.get(id, org_id)
+            if value is not None:
+                metrics.inc("message_cache_hits")
+                return value
+
+            pending = self.loading.get(key)
+            if pending is None:
+                break
+            metrics.inc("message_cache_hits", shared="inflight")
+            value = await asyncio.shield(pending)
+            if value is not _RETRY:
+                return value
+            # The owner was cancelled: the first waiter to get here loads it instead
+
+        metrics.inc("message_cache_misses")
+        fut = asyncio.get_running_loop().create_future()
+        self.loading[key] = fut
+        state = {'cacheable': True}
+        token = _load_state.set(state)
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            fut.set_result(_RETRY)
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # Waiters re-raise it; mark it retrieved for the no-waiter case
+            fut.exception()
+            raise
+        else:
+            if state['cacheable']:
+                self.put(id, org_id, value)
+            else:
+                metrics.inc("message_cache_skipped_degraded")
+            fut.set_result(value)
+            return value
+        finally:
+            _load_state.reset(token)
+            self.loading.pop(key, None)
+
+cache = MessageCache(MESSAGE_CACHE_MAX_BYTES, MESSAGE_CACHE_TTL, MESSAGE_CACHE_MAX_ITEM_BYTES)
+
+async def get_or_load(id: str, org_id: int, loader):
+    return await cache.get_or_load(id, org_id, loader)
+
+def invalidate(ids):
+    cache.invalidate(ids)
+
+def skip_caching():
+    """Called from inside a loader: its result is returned but not cached."""
+    state = _load_state.get()
+    if state is not None:
+        state['cacheable'] = False
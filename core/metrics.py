@@ -0,0 +1,88 @@
+import threading
+import time
+
+# Minimal in-process metrics registry, exposed as JSON at /api/v1/metrics.
+# Names follow <component>_<what>[_unit]; labels are passed as keyword args.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+
+def _key(name: str, labels: dict):
+    return (name, tuple(sorted(labels.items())))
+
+def inc(name: str, value: float = 1, **labels):
+    k = _key(name, labels)
+    with _lock:
+        _counters[k] = _counters.get(k, 0) + value
+
+def set_gauge(name: str, value: float, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def observe(name: str, value: float, **labels):
+    k = _key(name, labels)
+    with _lock:
+        h = _histograms.get(k)
+        if h is None:
+            h = _histograms[k] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(DEFAULT_BUCKETS)}
+        h["count"] += 1
+        h["sum"] += value
+        h["max"] = max(h["max"], value)
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                h["buckets"][i] += 1
+
+class timer:
+    """with metrics.timer("flush_seconds"): ...  -> observe(elapsed)"""
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        observe(self.name, self.elapsed, **self.labels)
+        return False
+
+def get_counter(name: str, **labels) -> float:
+    with _lock:
+        return _counters.get(_key(name, labels), 0)
+
+def get_gauge(name: str, **labels):
+    with _lock:
+        return _gauges.get(_key(name, labels))
+
+def get_histogram(name: str, **labels):
+    with _lock:
+        h = _histograms.get(_key(name, labels))
+        return dict(h, buckets=list(h["buckets"])) if h else None
+
+def _fmt(key):
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+def snapshot() -> dict:
+    with _lock:
+        histograms = {}
+        for k, h in _histograms.items():
+            histograms[_fmt(k)] = {
+                "count": h["count"],
+                "sum": round(h["sum"], 6),
+                "avg": round(h["sum"] / h["count"], 6) if h["count"] else 0,
+                "max": round(h["max"], 6),
+                "buckets": {str(b): c for b, c in zip(DEFAULT_BUCKETS, h["buckets"])},
+            }
+        return {
+            "counters": {_fmt(k): v for k, v in _counters.items()},
+            "gauges": {_fmt(k): v for k, v in _gauges.items()},
+            "histograms": histograms,
+        }
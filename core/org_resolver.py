@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import asyncpg
+import database
+
+logger = logging.getLogger("OrgResolver")
+
+# Postgres channel fired by the organizations trigger (see database.init_db)
+NOTIFY_CHANNEL = "org_domains_changed"
+
+# In-process index: lowercase domain -> set of org ids (and the reverse map)
+_domain_index = {}
+_org_domains = {}
+_loaded = False
+# Used on the app loop only (SMTP ingest runs there too, see smtp_server.py)
+_refresh_lock = asyncio.Lock()
+
+def normalize_domain(domain: str) -> str:
+    return str(domain).strip().lower().strip('<>').rstrip('.')
+
+def _build(rows):
+    domain_index = {}
+    org_domains = {}
+    for r in rows:
+        doms = [normalize_domain(d) for d in (r['domains'] or []) if d]
+        org_domains[r['id']] = doms
+        for d in doms:
+            domain_index.setdefault(d, set()).add(r['id'])
+    return domain_index, org_domains
+
+async def refresh():
+    """Reloads the whole domain index from Postgres (one query)."""
+    global _domain_index, _org_domains, _loaded
+    async with _refresh_lock:
+        async with database.connection() as conn:
+            rows = await conn.fetch("SELECT id, domains FROM organizations")
+
+        # Swap atomically so readers never see a half-built index
+        _domain_index, _org_domains = _build(rows)
+        _loaded = True
+        logger.info(f"Domain index loaded: {len(_domain_index)} domains across {len(_org_domains)} orgs.")
+
+async def ensure_loaded():
+    if not _loaded:
+        await refresh()
+
+def _parent_domains(domain: str):
+    """mail.sagasoft.io -> mail.sagasoft.io, sagasoft.io, io"""
+    d = normalize_domain(domain)
+    while d:
+        yield d
+        if '.' not in d:
+            break
+        d = d.split('.', 1)[1]
+
+def resolve_domain(domain: str, index: dict = None) -> set:
+    """
+    Returns the org ids owning a domain. Subdomains fall back to their parent,
+    e.g. mail.sagasoft.io -> sagasoft.io, so the most specific match wins.
+    """
+    index = _domain_index if index is None else index
+    for d in _parent_domains(domain):
+        orgs = index.get(d)
+        if orgs:
+            return orgs
+    return set()
+
+def resolve(domains, index: dict = None) -> set:
+    """Union of org ids for every domain in the iterable."""
+    orgs = set()
+    for d in domains:
+        orgs |= resolve_domain(d, index)
+    return orgs
+
+async def resolve_batch(domain_sets: list) -> list:
+    """
+    Resolves a whole batch at once, returning one org-id set per input set.
+    Served from memory when the index is loaded; otherwise every candidate
+    domain of the batch goes to Postgres in a single unnest query.
+    """
+    if _loaded:
+        return [resolve(ds) for ds in domain_sets]
+
+    candidates = {p for ds in domain_sets for d in ds for p in _parent_domains(d)}
+    index = {}
+    if candidates:
+        async with database.connection() as conn:
+            rows = await conn.fetch("""
+                SELECT c.domain, o.id
+                FROM unnest($1::text[]) AS c(domain)
+                JOIN organizations o
+                  ON EXISTS (SELECT 1 FROM unnest(o.domains) od WHERE lower(od) = c.domain)
+            """, list(candidates))
+        for r in rows:
+            index.setdefault(r['domain'], set()).add(r['id'])
+    return [resolve(ds, index) for ds in domain_sets]
+
+def get_org_domains(org_id: int) -> list:
+    return list(_org_domains.get(org_id, []))
+
+# Loop the listener runs on; notification callbacks schedule refreshes there
+_loop = None
+# Running refreshes (the loop only keeps weak references to tasks)
+_refresh_tasks = set()
+
+def _refresh_done(task):
+    _refresh_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Domain index refresh after change notification failed: {task.exception()}")
+
+def _on_notify(connection, pid, channel, payload):
+    task = _loop.create_task(refresh())
+    _refresh_tasks.add(task)
+    task.add_done_callback(_refresh_done)
+
+async def start_listener():
+    """
+    Keeps a dedicated (non-pooled) connection LISTENing on NOTIFY_CHANNEL.
+    Reconnects and reloads the index if the connection drops. The
+    organizations trigger sends the NOTIFY, so mutation paths need no call.
+    """
+    global _loop
+    _loop = asyncio.get_running_loop()
+    logger.info(f"Org Resolver listening on '{NOTIFY_CHANNEL}'.")
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(database.DATABASE_URL)
+            await conn.add_listener(NOTIFY_CHANNEL, _on_notify)
+            # Changes may have happened while we were disconnected
+            await refresh()
+            while not conn.is_closed():
+                await asyncio.sleep(30)
+        except Exception as e:
+            logger.error(f"Org Resolver listener error: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(5)
@@ -0,0 +1,136 @@
+import logging
+import os
+import time
+import asyncpg
+import metrics
+
+logger = logging.getLogger("Queries")
+
+# Named statements for the hot paths. Each pooled connection prepares them
+# once (database.connect passes init_connection as the pool's init hook) and
+# call sites run them by name, so plans are reused across requests and every
+# execution lands in the db_query_seconds{query=...} histogram.
+SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+
+STATEMENTS = {
+    # Auth
+    'user_by_username': "SELECT * FROM users WHERE username = $1",
+
+    # Legal holds (search annotation, hold checks)
+    'held_ids_for_org': """
+        SELECT i.message_id FROM legal_hold_items i
+        JOIN legal_holds h ON i.hold_id = h.id
+        WHERE h.org_id = $1 AND h.active = TRUE
+    """,
+    'hold_insert_items': """
+        INSERT INTO legal_hold_items (hold_id, message_id)
+        SELECT $1, unnest($2::text[])
+        ON CONFLICT (hold_id, message_id) DO NOTHING
+        RETURNING message_id
+    """,
+    'active_hold_criteria': "SELECT filter_criteria FROM legal_holds WHERE active = TRUE AND org_id = $1",
+    'hold_by_public_id': "SELECT *, public_id as id FROM legal_holds WHERE public_id = $1 AND org_id = $2",
+    'hold_items_recent': "SELECT message_id, created_at FROM legal_hold_items WHERE hold_id = $1 ORDER BY created_at DESC LIMIT 100",
+
+    # Audit chain
+    'audit_last_hash': "SELECT current_hash FROM audit_logs WHERE org_id = $1 ORDER BY id DESC LIMIT 1",
+    'audit_insert_batch': """
+        INSERT INTO audit_logs (org_id, username, action, details, previous_hash, current_hash)
+        SELECT $1, t.username, t.action, t.details::jsonb, t.previous_hash, t.current_hash
+        FROM unnest($2::text[], $3::text[], $4::text[], $5::text[], $6::text[])
+            WITH ORDINALITY AS t(username, action, details, previous_hash, current_hash, n)
+        ORDER BY t.n
+    """,
+    'audit_recent': "SELECT id, username, action, details, timestamp FROM audit_logs WHERE org_id = $1 ORDER BY timestamp DESC LIMIT $2",
+
+    # Cases
+    'cases_for_org': """
+        SELECT c.*, COUNT(ci.id) as item_count
+        FROM cases c
+        LEFT JOIN case_items ci ON c.id = ci.case_id
+        WHERE c.org_id = $1
+        GROUP BY c.id
+        ORDER BY c.created_at DESC
+    """,
+    'case_by_id': "SELECT * FROM cases WHERE id = $1 AND org_id = $2",
+    'case_items': """
+        SELECT ci.*, u.username as assignee_name
+        FROM case_items ci
+        LEFT JOIN users u ON ci.assignee_id = u.id
+        WHERE ci.case_id = $1
+        ORDER BY ci.added_at DESC
+    """,
+    'case_assignments': """
+        SELECT ci.*, c.name as case_name
+        FROM case_items ci
+        JOIN cases c ON ci.case_id = c.id
+        WHERE ci.assignee_id = $1
+        ORDER BY ci.added_at DESC
+    """,
+}
+
+# server pid -> {name: PreparedStatement}; pids identify the physical connection
+# behind pool proxies and are dropped when that connection terminates.
+_prepared = {}
+
+async def init_connection(conn):
+    """Pool init hook: prepares every registered statement on a new connection."""
+    pid = conn.get_server_pid()
+    _prepared[pid] = {}
+    conn.add_termination_listener(lambda c: _prepared.pop(pid, None))
+    for name, sql in STATEMENTS.items():
+        try:
+            _prepared[pid][name] = await conn.prepare(sql)
+        except asyncpg.PostgresError as e:
+            # e.g. table not created yet on first startup; prepared lazily on first use
+            logger.debug(f"Deferred preparing '{name}': {e}")
+
+async def _statement(conn, name: str):
+    statements = _prepared.setdefault(conn.get_server_pid(), {})
+    stmt = statements.get(name)
+    if stmt is None:
+        stmt = statements[name] = await conn.prepare(STATEMENTS[name])
+    return stmt
+
+async def _run(conn, name: str, method: str, args):
+    started = time.perf_counter()
+    try:
+        stmt = await _statement(conn, name)
+        try:
+            return await getattr(stmt, method)(*args)
+        except asyncpg.exceptions.InvalidCachedStatementError:
+            # Schema changed under the plan: drop it. Inside a transaction the
+            # error has aborted it, so only a statement on its own is retried.
+            _prepared.get(conn.get_server_pid(), {}).pop(name, None)
+            if conn.is_in_transaction():
+                raise
+            stmt = await _statement(conn, name)
+            return await getattr(stmt, method)(*args)
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("db_query_seconds", elapsed, query=name)
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            logger.warning(f"Slow query '{name}': {elapsed * 1000:.1f} ms")
+
+async def iterate(conn, name: str, *args, prefetch: int = 10000):
+    """Streams rows through a server-side cursor (caller must be inside a transaction)."""
+    started = time.perf_counter()
+    try:
+        stmt = await _statement(conn, name)
+        async for row in stmt.cursor(*args, prefetch=prefetch):
+            yield row
+    finally:
+        metrics.observe("db_query_seconds", time.perf_counter() - started, query=name)
+
+async def fetch(conn, name: str, *args):
+    return await _run(conn, name, 'fetch', args)
+
+async def fetchrow(conn, name: str, *args):
+    return await _run(conn, name, 'fetchrow', args)
+
+async def fetchval(conn, name: str, *args):
+    return await _run(conn, name, 'fetchval', args)
+
+async def execute(conn, name: str, *args):
+    # PreparedStatement has no execute(); fetch() of a statement without RETURNING is equivalent
+    await _run(conn, name, 'fetch', args)
@@ -1,86 +1,249 @@
 import asyncio
+import json
 import logging
+import os
 import time
 from datetime import datetime, timedelta
 import database
+import message_cache
+import metrics
+import scrub_worker
 import storage
 import search
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("RetentionWorker")
 
+# The purge streams candidates from Meilisearch (keyset pages, newest first),
+# deletes them from the index in batches of RETENTION_DELETE_BATCH and from
+# object storage with multi-key deletes, and checkpoints each (policy, domain)
+# in retention_checkpoints after every batch so a restart resumes where the
+# last batch finished.
+RETENTION_PAGE_SIZE = int(os.getenv("RETENTION_PAGE_SIZE", "1000"))
+RETENTION_DELETE_BATCH = int(os.getenv("RETENTION_DELETE_BATCH", "5000"))
+# Documents whose size is averaged to estimate the bytes a plan would free
+RETENTION_PLAN_SAMPLE = int(os.getenv("RETENTION_PLAN_SAMPLE", "1000"))
+
+def _cutoff_ts(retention_days: int) -> int:
+    return int((datetime.utcnow() - timedelta(days=retention_days)).timestamp())
+
+def _domain_filter(domain: str, cutoff_ts: int) -> str:
+    return f"domains = '{domain}' AND date_timestamp < {cutoff_ts}"
+
+def _deletable_filter(filter_query: str, hold_filter: str = None) -> str:
+    """Drops messages indexed as held (hold_ids) or covered by an account hold."""
+    return " AND ".join(p for p in (filter_query, search.NOT_HELD_FILTER, hold_filter) if p)
+
+async def account_hold_filter() -> str:
+    """
+    Excludes messages to/from addresses under an active account hold. There
+    are few such holds, so they go into the Meilisearch filter and those
+    messages are never returned as candidates.
+    """
+    async with database.connection() as conn:
+        account_holds = await conn.fetch("SELECT filter_criteria FROM legal_holds WHERE active = TRUE")
+
+    held_emails = set()
+    for h in account_holds:
+        crit = json.loads(h['filter_criteria'])
+        if crit.get('from'): held_emails.add(crit['from'])
+        if crit.get('to'): held_emails.add(crit['to'])
+    parts = [search.not_in_filter(attr, held_emails) for attr in ('from', 'to', 'sender_email', 'recipient_emails')]
+    return " AND ".join(p for p in parts if p) or None
+
+async def _unheld(ids: list) -> list:
+    """Anti-joins a page of candidates against legal_hold_items; only deletable ids come back."""
+    async with database.connection() as conn:
+        rows = await conn.fetch("""
+            SELECT c.id FROM unnest($1::text[]) AS c(id)
+            WHERE NOT EXISTS (SELECT 1 FROM legal_hold_items i WHERE i.message_id = c.id)
+        """, ids)
+    return [r['id'] for r in rows]
+
+async def _get_checkpoint(policy_id: int, domain: str):
+    async with database.connection() as conn:
+        return await conn.fetchrow(
+            "SELECT cutoff_ts, last_ts, purged, completed FROM retention_checkpoints WHERE policy_id = $1 AND domain = $2",
+            policy_id, domain
+        )
+
+async def _save_checkpoint(policy_id: int, domain: str, cutoff_ts: int, last_ts, purged: int, completed: bool):
+    async with database.connection() as conn:
+        await conn.execute("""
+            INSERT INTO retention_checkpoints (policy_id, domain, cutoff_ts, last_ts, purged, completed, updated_at)
+            VALUES ($1, $2, $3, $4, $5, $6, CURRENT_TIMESTAMP)
+            ON CONFLICT (policy_id, domain) DO UPDATE
+            SET cutoff_ts = EXCLUDED.cutoff_ts, last_ts = EXCLUDED.last_ts, purged = EXCLUDED.purged,
+                completed = EXCLUDED.completed, updated_at = CURRENT_TIMESTAMP
+        """, policy_id, domain, cutoff_ts, last_ts, purged, completed)
+
+async def _delete_batch(ids: list) -> int:
+    """
+    Index first (waiting for the delete task to succeed), then blobs: a
+    failure can leave an orphaned blob but never a hit without content.
+    """
+    with metrics.timer("retention_batch_seconds"):
+        if await search.delete_documents(ids, wait=True) is None:
+            raise RuntimeError(f"search delete failed for {len(ids)} messages")
+        failed = await storage.blob_store.delete_many([f"{mid}.enc" for mid in ids])
+    message_cache.invalidate(ids)
+    try:
+        await scrub_worker.clear_results([f"{mid}.enc" for mid in ids])
+    except Exception as e:
+        logger.warning(f"Could not clear scrub results for {len(ids)} purged messages: {e}")
+    if failed:
+        metrics.inc("retention_blob_delete_failures", len(failed))
+        logger.error(f"Failed to delete {len(failed)} blobs (e.g. {failed[:5]})")
+    metrics.inc("retention_purged_messages", len(ids))
+    return len(ids)
+
+async def purge_domain(policy_id: int, domain: str, cutoff_ts: int, hold_filter: str = None) -> int:
+    """Purges one domain of a policy. Returns the number of messages deleted by this run."""
+    filter_query = _domain_filter(domain, cutoff_ts)
+
+    # An interrupted run already covered (last_ts, previous cutoff); only what
+    # is below last_ts, or newly expired since then, is left to scan.
+    checkpoint = await _get_checkpoint(policy_id, domain)
+    last_ts, previously = None, 0
+    if checkpoint and not checkpoint['completed'] and checkpoint['last_ts'] is not None:
+        last_ts, previously = checkpoint['last_ts'], checkpoint['purged']
+        filter_query += f" AND (date_timestamp <= {last_ts} OR date_timestamp >= {checkpoint['cutoff_ts']})"
+        logger.info(f"Resuming {domain} (policy {policy_id}) below date_timestamp {last_ts}.")
+
+    purged = 0
+    pending = []
+    # Meilisearch filters out what it knows is held; the rest is checked
+    # against Postgres, which stays authoritative while hold_ids sync lags.
+    async for page in search.iter_documents(_deletable_filter(filter_query, hold_filter), fields=['id', 'date_timestamp'], page_size=RETENTION_PAGE_SIZE):
+        deletable = await _unheld([msg['id'] for msg in page])
+        metrics.inc("retention_skipped_held", len(page) - len(deletable))
+        pending.extend(deletable)
+
+        if len(pending) >= RETENTION_DELETE_BATCH:
+            purged += await _delete_batch(pending)
+            pending = []
+            # Pages are newest first, so everything above this page's oldest hit is done
+            last_ts = page[-1].get('date_timestamp', last_ts)
+            await _save_checkpoint(policy_id, domain, cutoff_ts, last_ts, previously + purged, False)
+
+    if pending:
+        purged += await _delete_batch(pending)
+    await _save_checkpoint(policy_id, domain, cutoff_ts, None, previously + purged, True)
+    return purged
+
 async def purge_expired_messages():
     """Identifies and deletes messages past their retention period (if not held)."""
-    conn = await database.get_db_connection()
     try:
-        # 1. Get Retention Policies
-        policies = await conn.fetch("SELECT domains, retention_days FROM retention_policies")
+        # Policies and holds are read up front; the connection isn't held during the purge
+        async with database.connection() as conn:
+            policies = await conn.fetch("SELECT id, domains, retention_days FROM retention_policies")
         if not policies:
             logger.info("No retention policies defined. Skipping purge.")
             return
-        
-        # ... logic to handle each domain in the policy list ...
-        # (Actually I need to loop through the policies and then through domains)
-
-        # 2. Get all Held Message IDs (Total Protection)
-        held_rows = await conn.fetch("SELECT message_id FROM legal_hold_items")
-        held_ids = {r['message_id'] for r in held_rows}
-        
-        # 3. Get Account Holds (Domains/Emails)
-        account_holds = await conn.fetch("SELECT filter_criteria FROM legal_holds WHERE active = TRUE")
-        held_emails = set()
-        for h in account_holds:
-            import json
-            crit = json.loads(h['filter_criteria'])
-            if crit.get('from'): held_emails.add(crit['from'])
-            if crit.get('to'): held_emails.add(crit['to'])
 
+        hold_filter = await account_hold_filter()
+
+        started = time.perf_counter()
+        total = 0
         for policy in policies:
-            import json
             p_domains = json.loads(policy['domains'])
             days = policy['retention_days']
-            cutoff_ts = int((datetime.utcnow() - timedelta(days=days)).timestamp())
-            
+            cutoff_ts = _cutoff_ts(days)
+
             for domain in p_domains:
                 logger.info(f"Purging messages for {domain} older than {days} days (cutoff TS: {cutoff_ts})")
-                
-                # 4. Search Meili for candidates
-                filter_query = f"domains = '{domain}' AND date_timestamp < {cutoff_ts}"
-                results = search.search_documents(query="", filter_query=filter_query, limit=1000)
-                
-                candidates = results.get('hits', [])
-                purged_count = 0
-                
-                for msg in candidates:
-                    mid = msg['id']
-                    
-                    # PROTECTION CHECK
-                    if mid in held_ids:
-                        logger.debug(f"Skipping {mid}: Explicitly Held.")
-                        continue
-                    
-                    if msg.get('from') in held_emails or msg.get('to') in held_emails:
-                        logger.debug(f"Skipping {mid}: Associated with Held Account.")
-                        continue
-                    
-                    # PERMANENT DELETE
-                    try:
-                        # Remove from Search
-                        search.client.index('emails').delete_document(mid)
-                        # Remove from Storage
-                        storage.delete_blob(f"{mid}.enc")
-                        
-                        purged_count += 1
-                    except Exception as e:
-                        logger.error(f"Failed to purge {mid}: {e}")
-
+                try:
+                    purged_count = await purge_domain(policy['id'], domain, cutoff_ts, hold_filter)
+                except Exception as e:
+                    # The checkpoint stays at the last completed batch; the next run resumes there
+                    logger.error(f"Purge of {domain} (policy {policy['id']}) stopped: {e}")
+                    continue
+                total += purged_count
                 if purged_count > 0:
                     logger.info(f"Successfully purged {purged_count} messages for {domain}.")
 
+        elapsed = time.perf_counter() - started
+        metrics.set_gauge("retention_last_run_seconds", round(elapsed, 3))
+        metrics.set_gauge("retention_last_run_purged", total)
+        if total:
+            rate = total / elapsed if elapsed else 0.0
+            metrics.set_gauge("retention_purge_rate", round(rate, 2))
+            logger.info(f"Retention run purged {total} messages in {elapsed:.1f}s ({rate:.0f} msg/s).")
+
     except Exception as e:
         logger.error(f"Purge Error: {e}")
-    finally:
-        await conn.close()
+
+# --- Dry-run planning ---
+
+def _purge_rate():
+    """Measured messages/sec: last full run, else index+blob delete batches so far. None if never purged."""
+    rate = metrics.get_gauge("retention_purge_rate")
+    if rate:
+        return rate
+    batches = metrics.get_histogram("retention_batch_seconds")
+    if batches and batches['sum'] > 0:
+        return metrics.get_counter("retention_purged_messages") / batches['sum']
+    return None
+
+async def _plan_domain(domain: str, cutoff_ts: int, hold_filter: str) -> dict:
+    filter_query = _domain_filter(domain, cutoff_ts)
+    deletable_filter = _deletable_filter(filter_query, hold_filter)
+    matched, candidates, sample = await asyncio.gather(
+        search.count_documents(filter_query),
+        search.count_documents(deletable_filter),
+        search.fetch_documents(deletable_filter, fields=['id', 'size'], limit=RETENTION_PLAN_SAMPLE),
+    )
+    # Candidates still on an item hold the index doesn't know about yet are
+    # skipped by the purge (_unheld); the sample's unheld share scales the
+    # count, which is exact whenever the sample covers every candidate.
+    docs = sample.get('results', [])
+    unheld = set(await _unheld([d['id'] for d in docs])) if docs else set()
+    if len(docs) >= candidates:
+        deletable = len(unheld)
+    elif docs:
+        deletable = round(candidates * len(unheld) / len(docs))
+    else:
+        deletable = candidates
+    # Messages indexed before 'size' was recorded don't count towards the estimate
+    sizes = [d['size'] for d in docs if d['id'] in unheld and isinstance(d.get('size'), int)]
+    return {
+        'domain': domain,
+        'matched': matched,
+        'held': matched - deletable,
+        'deletable': deletable,
+        'estimated_bytes': round(sum(sizes) / len(sizes) * deletable) if sizes else None,
+        'size_sample': len(sizes),
+    }
+
+async def plan_policy(domains: list, retention_days: int, hold_filter: str = None) -> dict:
+    """
+    What a purge of this policy would delete right now, from count-only
+    searches and a size sample. Nothing is deleted and no blob is read.
+    """
+    cutoff_ts = _cutoff_ts(retention_days)
+    plans = await asyncio.gather(*[_plan_domain(d, cutoff_ts, hold_filter) for d in domains])
+    deletable = sum(p['deletable'] for p in plans)
+    estimated = [p['estimated_bytes'] for p in plans if p['estimated_bytes'] is not None]
+    rate = _purge_rate()
+    return {
+        'cutoff_ts': cutoff_ts,
+        'matched': sum(p['matched'] for p in plans),
+        'held': sum(p['held'] for p in plans),
+        'deletable': deletable,
+        'estimated_bytes': sum(estimated) if estimated else None,
+        'purge_rate': round(rate, 2) if rate else None,
+        'estimated_seconds': round(deletable / rate) if rate else None,
+        'domains': plans,
+    }
+
+async def plan(policies) -> list:
+    """Plans for retention_policies rows (id, name, domains, retention_days)."""
+    hold_filter = await account_hold_filter()
+    results = []
+    for policy in policies:
+        result = await plan_policy(json.loads(policy['domains']), policy['retention_days'], hold_filter)
+        results.append({'policy_id': policy['id'], 'name': policy['name'], 'retention_days': policy['retention_days'], **result})
+    return results
 
 async def start_worker():
     logger.info("Retention Worker Started. Running every 24 hours.")
@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import time
+import database
+import integrity
+import metrics
+import search
+import storage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("ScrubWorker")
+
+# Background scrub of archived blobs for bit rot / tampering:
+#   messages  {id}.enc         streamed from Meilisearch (id, sha256, signature),
+#                              checked against the stored HMAC signature and hash
+#   cas       cas_{hash}.enc   streamed from cas_manifest, checked against the hash
+# Reads are throttled by a byte budget (SCRUB_BYTES_PER_SEC) and a small
+# concurrency cap so interactive reads keep the S3 pool. Progress is stored in
+# scrub_progress after every page, so a restart resumes where it stopped;
+# failures are kept in scrub_results until the object verifies again or is
+# deleted (retention calls clear_results).
+SCRUB_BYTES_PER_SEC = int(os.getenv("SCRUB_BYTES_PER_SEC", str(20 * 1024 * 1024)))
+SCRUB_CONCURRENCY = int(os.getenv("SCRUB_CONCURRENCY", "4"))
+SCRUB_PAGE_SIZE = int(os.getenv("SCRUB_PAGE_SIZE", "500"))
+SCRUB_PASS_INTERVAL_HOURS = float(os.getenv("SCRUB_PASS_INTERVAL_HOURS", "168"))
+
+class ByteBudget:
+    """Token bucket over bytes read; a read may overdraw it, later readers wait it off."""
+    def __init__(self, rate: int, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+    def spend(self, nbytes: int):
+        self.tokens -= nbytes
+
+# --- Progress / results ---
+
+async def _get_progress(kind: str):
+    async with database.connection() as conn:
+        return await conn.fetchrow("""
+            SELECT position, scanned, failures, EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - completed_at) AS since_completed
+            FROM scrub_progress WHERE kind = $1
+        """, kind)
+
+async def _save_progress(kind: str, position, scanned: int, failures: int, completed: bool = False):
+    async with database.connection() as conn:
+        await conn.execute("""
+            INSERT INTO scrub_progress (kind, position, scanned, failures, completed_at, updated_at)
+            VALUES ($1, $2, $3, $4, CASE WHEN $5 THEN CURRENT_TIMESTAMP END, CURRENT_TIMESTAMP)
+            ON CONFLICT (kind) DO UPDATE
+            SET position = EXCLUDED.position, scanned = EXCLUDED.scanned, failures = EXCLUDED.failures,
+                completed_at = COALESCE(EXCLUDED.completed_at, scrub_progress.completed_at),
+                updated_at = CURRENT_TIMESTAMP
+        """, kind, position, scanned, failures, completed)
+
+async def _record_results(kind: str, results: list):
+    """Stores failures; objects that verify again (or were deleted meanwhile) are cleared."""
+    failed = [(key, status, detail) for key, status, detail in results if status not in ('VALID', 'DELETED')]
+    valid = [key for key, status, _ in results if status in ('VALID', 'DELETED')]
+    async with database.connection() as conn:
+        if failed:
+            await conn.executemany("""
+                INSERT INTO scrub_results (object_key, kind, status, detail, checked_at)
+                VALUES ($1, $2, $3, $4, CURRENT_TIMESTAMP)
+                ON CONFLICT (object_key) DO UPDATE
+                SET status = EXCLUDED.status, detail = EXCLUDED.detail, checked_at = CURRENT_TIMESTAMP
+            """, [(key, kind, status, detail) for key, status, detail in failed])
+        if valid:
+            await conn.execute("DELETE FROM scrub_results WHERE object_key = ANY($1::text[])", valid)
+    return len(failed)
+
+async def clear_results(keys: list):
+    """Forgets results for objects that were deliberately deleted."""
+    if not keys:
+        return
+    async with database.connection() as conn:
+        await conn.execute("DELETE FROM scrub_results WHERE object_key = ANY($1::text[])", list(keys))
+
+# --- Verification ---
+
+def _check_message(data: bytes, sha256: str, signature: str):
+    """CPU-bound; run in a worker thread."""
+    if sha256 and integrity.calculate_hash(data) != sha256:
+        return 'TAMPERED', "sha256 mismatch"
+    if not integrity.verify_integrity(data, signature):
+        return 'TAMPERED', "signature mismatch"
+    return 'VALID', None
+
+def _check_cas(data: bytes, blob_hash: str):
+    if integrity.calculate_hash(data) != blob_hash:
+        return 'TAMPERED', "content hash mismatch"
+    return 'VALID', None
+
+async def _fetch(key: str, budget: ByteBudget):
+    await budget.wait()
+    data = await storage.blob_store.get(key)
+    if data is not None:
+        budget.spend(len(data))
+        metrics.inc("scrub_bytes", len(data))
+    return data
+
+async def _message_live(key: str) -> bool:
+    """False once retention has removed the message from the index (blob deleted on purpose)."""
+    return await search.get_document(key[:-len(".enc")]) is not None
+
+async def _scrub_object(key: str, check, args, live, budget: ByteBudget, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        try:
+            data = await _fetch(key, budget)
+            if data is None:
+                # get() also returns None on transient errors
+                if await storage.blob_store.exists(key):
+                    return key, 'ERROR', "read failed"
+                # Deleted between the page being listed and fetched
+                if live is not None and not await live(key):
+                    return key, 'DELETED', None
+                return key, 'MISSING', None
+            status, detail = await asyncio.to_thread(check, data, *args)
+            return key, status, detail
+        except Exception as e:
+            return key, 'ERROR', str(e)
+
+async def _scrub_page(kind: str, items: list, budget: ByteBudget, semaphore: asyncio.Semaphore, live=None) -> int:
+    """items: (key, check, args); live(key) re-checks a missing object. Returns the number of failures."""
+    results = await asyncio.gather(*[_scrub_object(key, check, args, live, budget, semaphore) for key, check, args in items])
+    for key, status, detail in results:
+        metrics.inc("scrub_objects", kind=kind, status=status)
+        if status in ('TAMPERED', 'MISSING'):
+            logger.error(f"[SECURITY ALERT] Scrub {status} {key}: {detail or ''}")
+    return await _record_results(kind, results)
+
+# --- Passes ---
+
+async def scrub_messages(budget: ByteBudget, semaphore: asyncio.Semaphore):
+    """
+    Messages newest first (keyset on date_timestamp); resumes at the saved
+    timestamp (documents without one are iterated last, so they stay in).
+    """
+    progress = await _get_progress('messages')
+    position = progress['position'] if progress else None
+    scanned = progress['scanned'] if progress and position else 0
+    failures = progress['failures'] if progress and position else 0
+
+    filter_query = f"date_timestamp <= {int(position)} OR date_timestamp NOT EXISTS" if position else None
+    async for page in search.iter_documents(filter_query, fields=['id', 'sha256', 'signature', 'date_timestamp'], page_size=SCRUB_PAGE_SIZE):
+        items = []
+        for doc in page:
+            if not doc.get('signature'):
+                metrics.inc("scrub_objects", kind='messages', status='UNSIGNED')
+                continue
+            items.append((f"{doc['id']}.enc", _check_message, (doc.get('sha256'), doc['signature'])))
+        failures += await _scrub_page('messages', items, budget, semaphore, live=_message_live)
+        scanned += len(page)
+        if page[-1].get('date_timestamp') is not None:
+            position = str(page[-1]['date_timestamp'])
+        await _save_progress('messages', position, scanned, failures)
+
+    await _save_progress('messages', None, scanned, failures, completed=True)
+    return scanned, failures
+
+async def scrub_cas(budget: ByteBudget, semaphore: asyncio.Semaphore):
+    """CAS blobs in hash order from cas_manifest; resumes after the saved hash."""
+    progress = await _get_progress('cas')
+    position = progress['position'] if progress else None
+    scanned = progress['scanned'] if progress and position else 0
+    failures = progress['failures'] if progress and position else 0
+
+    while True:
+        async with database.connection() as conn:
+            rows = await conn.fetch(
+                "SELECT hash FROM cas_manifest WHERE hash > $1 ORDER BY hash LIMIT $2",
+                position or "", SCRUB_PAGE_SIZE
+            )
+        if not rows:
+            break
+        items = [(f"cas_{r['hash']}.enc", _check_cas, (r['hash'],)) for r in rows]
+        failures += await _scrub_page('cas', items, budget, semaphore)
+        scanned += len(rows)
+        position = rows[-1]['hash']
+        await _save_progress('cas', position, scanned, failures)
+
+    await _save_progress('cas', None, scanned, failures, completed=True)
+    return scanned, failures
+
+def _due(progress) -> bool:
+    """A pass is due if one is in progress or the last finished long enough ago."""
+    if progress is None or progress['position'] is not None or progress['since_completed'] is None:
+        return True
+    return progress['since_completed'] >= SCRUB_PASS_INTERVAL_HOURS * 3600
+
+async def run_once():
+    budget = ByteBudget(SCRUB_BYTES_PER_SEC)
+    semaphore = asyncio.Semaphore(SCRUB_CONCURRENCY)
+    for kind, scrub in (('messages', scrub_messages), ('cas', scrub_cas)):
+        if not _due(await _get_progress(kind)):
+            continue
+        started = time.perf_counter()
+        scanned, failures = await scrub(budget, semaphore)
+        metrics.set_gauge("scrub_pass_seconds", round(time.perf_counter() - started, 3), kind=kind)
+        logger.info(f"Scrub pass over {kind} finished: {scanned} objects, {failures} failures.")
+
+async def start_worker():
+    logger.info(f"Scrub Worker Started. Pass every {SCRUB_PASS_INTERVAL_HOURS:g} hours at up to {SCRUB_BYTES_PER_SEC // (1024 * 1024)} MB/s.")
+    while True:
+        try:
+            await run_once()
+        except Exception as e:
+            # Progress is saved per page; the next attempt resumes there
+            logger.error(f"Scrub Error: {e}")
+        await asyncio.sleep(3600)
+
+if __name__ == "__main__":
+    asyncio.run(start_worker())
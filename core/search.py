@@ -1,63 +1,490 @@
+import asyncio
+import base64
+import hashlib
+import logging
 import meilisearch
+import httpx
+import json
 import os
 
 MEILI_HOST = os.getenv("MEILI_HOST", "http://localhost:7700")
 MEILI_KEY = os.getenv("MEILI_MASTER_KEY", "masterKey")
+MEILI_MAX_CONNECTIONS = int(os.getenv("MEILI_MAX_CONNECTIONS", "20"))
+MEILI_TIMEOUT = float(os.getenv("MEILI_TIMEOUT", "30"))
 
+INDEX_NAME = 'emails'
+
+INDEX_SETTINGS = {
+    'filterableAttributes': ['id', 'to', 'from', 'date', 'date_timestamp', 'org_id', 'tenant_id', 'domains', 'has_attachments', 'is_spam', 'sender_domain', 'recipient_domains', 'message_id', 'in_reply_to', 'references', 'attachment_content', 'sha256', 'signature', 'envelope_from', 'envelope_rcpt', 'sender_email', 'recipient_emails', 'hold_ids', 'id_key'],
+    'searchableAttributes': ['subject', 'from', 'to', 'attachment_content', 'id', 'sha256'],
+    'sortableAttributes': ['date', 'date_timestamp', 'id_key'],
+    'pagination': {'maxTotalHits': 1000000},
+}
+# Order only matters for searchableAttributes (ranking priority)
+_UNORDERED_SETTINGS = {'filterableAttributes', 'sortableAttributes'}
+
+# Numeric tiebreak for keyset pagination inside a run of equal timestamps.
+# Meilisearch (v1.3 / v1.10 as deployed) only compares numbers in filters,
+# so every document carries id_key: 52 bits of sha256(id), exact as a float.
+# Set on every add (index_documents); older documents get it from
+# backfill_id_keys().
+def id_key(doc_id: str) -> int:
+    return int(hashlib.sha256(str(doc_id).encode('utf-8')).hexdigest()[:13], 16)
+
+# Legal hold membership filters (hold_ids is kept current by hold_sync.py)
+HELD_FILTER = "(hold_ids EXISTS AND NOT hold_ids IS EMPTY)"
+NOT_HELD_FILTER = "(hold_ids NOT EXISTS OR hold_ids IS EMPTY)"
+
+def in_filter(attribute: str, values) -> str:
+    """'attribute IN [...]' for arbitrary string values (None if there are none)."""
+    values = sorted(set(values))
+    if not values:
+        return None
+    quoted = ", ".join("'" + v.replace("\\", "\\\\").replace("'", "\\'") + "'" for v in values)
+    return f"{attribute} IN [{quoted}]"
+
+def not_in_filter(attribute: str, values) -> str:
+    """'NOT attribute IN [...]' for arbitrary string values (None if there are none)."""
+    clause = in_filter(attribute, values)
+    return f"NOT {clause}" if clause else None
+
+def _address_hold_parts(held_from, held_to) -> list:
+    """Address clauses matching hold_index.OrgHolds.is_held for account/criteria holds."""
+    parts = [in_filter('from', held_from), in_filter('sender_email', held_from),
+             in_filter('to', held_to), in_filter('recipient_emails', held_to)]
+    return [p for p in parts if p]
+
+def held_filter(held_from=(), held_to=()) -> str:
+    """Held by an explicit hold item (hold_ids) or by an account hold on an address."""
+    return "(" + " OR ".join([HELD_FILTER] + _address_hold_parts(held_from, held_to)) + ")"
+
+def not_held_filter(held_from=(), held_to=()) -> str:
+    return "(" + " AND ".join([NOT_HELD_FILTER] + [f"NOT {p}" for p in _address_hold_parts(held_from, held_to)]) + ")"
+
+logger = logging.getLogger("Search")
+
+# Synchronous client (used by scripts/)
 client = meilisearch.Client(MEILI_HOST, MEILI_KEY)
 
-def ensure_index():
-    index = client.index('emails')
-    try:
-        client.get_index('emails')
-    except:
-        client.create_index('emails', {'primaryKey': 'id'})
-    
-    # Always update settings to ensure they are current
-    index.update_filterable_attributes(['id', 'to', 'from', 'date', 'date_timestamp', 'org_id', 'tenant_id', 'domains', 'has_attachments', 'is_spam', 'sender_domain', 'recipient_domains', 'message_id', 'in_reply_to', 'references', 'attachment_content', 'sha256', 'signature', 'envelope_from', 'envelope_rcpt', 'sender_email', 'recipient_emails'])
-    index.update_searchable_attributes(['subject', 'from', 'to', 'attachment_content', 'id', 'sha256'])
-    index.update_sortable_attributes(['date', 'date_timestamp'])
-    index.update_pagination_settings({'maxTotalHits': 1000000})
-
-def index_documents(documents):
-    ensure_index()
+class AsyncSearchClient:
+    """
+    httpx-based Meilisearch client sharing one keep-alive connection pool.
+    Index settings are pushed once (and only if they differ from the live
+    config) instead of before every call; write calls return task uids.
+    """
+    def __init__(self, host: str, api_key: str, index_name: str):
+        self.host = host.rstrip('/')
+        self.api_key = api_key
+        self.index_name = index_name
+        self._http = None
+        self._index_ready = False
+        self._index_lock = asyncio.Lock()
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.host,
+                headers={'Authorization': f'Bearer {self.api_key}'},
+                limits=httpx.Limits(max_connections=MEILI_MAX_CONNECTIONS, max_keepalive_connections=MEILI_MAX_CONNECTIONS),
+                timeout=MEILI_TIMEOUT,
+            )
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def _request(self, method: str, path: str, **kwargs):
+        resp = await self._client().request(method, path, **kwargs)
+        resp.raise_for_status()
+        return resp.json() if resp.content else None
+
+    @property
+    def _index_path(self) -> str:
+        return f"/indexes/{self.index_name}"
+
+    # --- Tasks ---
+
+    async def get_task(self, task_uid: int) -> dict:
+        return await self._request('GET', f"/tasks/{task_uid}")
+
+    async def wait_for_task(self, task_uid: int, timeout: float = 30.0, interval: float = 0.1) -> dict:
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            task = await self.get_task(task_uid)
+            if task['status'] in ('succeeded', 'failed', 'canceled'):
+                return task
+            if asyncio.get_running_loop().time() >= deadline:
+                raise TimeoutError(f"Meilisearch task {task_uid} still {task['status']} after {timeout}s")
+            await asyncio.sleep(interval)
+
+    # --- Index / Settings ---
+
+    @staticmethod
+    def _settings_diff(live: dict) -> dict:
+        changes = {}
+        for name, wanted in INDEX_SETTINGS.items():
+            current = live.get(name)
+            if name in _UNORDERED_SETTINGS:
+                same = set(current or []) == set(wanted)
+            elif isinstance(wanted, dict):
+                same = all((current or {}).get(k) == v for k, v in wanted.items())
+            else:
+                same = current == wanted
+            if not same:
+                changes[name] = wanted
+        return changes
+
+    async def ensure_index(self):
+        """Creates the index and applies settings once per process (no-op afterwards)."""
+        if self._index_ready:
+            return
+        async with self._index_lock:
+            if self._index_ready:
+                return
+            resp = await self._client().get(self._index_path)
+            if resp.status_code == 404:
+                task = await self._request('POST', '/indexes', json={'uid': self.index_name, 'primaryKey': 'id'})
+                await self.wait_for_task(task['taskUid'])
+            else:
+                resp.raise_for_status()
+
+            live = await self._request('GET', f"{self._index_path}/settings")
+            changes = self._settings_diff(live)
+            if changes:
+                # One settings task for all differing keys (avoids reindex churn)
+                task = await self._request('PATCH', f"{self._index_path}/settings", json=changes)
+                logger.info(f"Updating index settings {list(changes)} (task {task['taskUid']}).")
+            self._index_ready = True
+
+    # --- Documents ---
+
+    async def add_documents(self, documents: list) -> int:
+        # PUT merges into existing documents, so re-ingesting a message keeps
+        # fields maintained by background jobs (e.g. hold_ids, see hold_sync.py)
+        await self.ensure_index()
+        task = await self._request('PUT', f"{self._index_path}/documents", json=documents)
+        return task['taskUid']
+
+    async def update_documents(self, documents: list) -> int:
+        """Partial update: only the given fields are changed."""
+        await self.ensure_index()
+        task = await self._request('PUT', f"{self._index_path}/documents", json=documents)
+        return task['taskUid']
+
+    async def delete_documents(self, ids: list) -> int:
+        await self.ensure_index()
+        task = await self._request('POST', f"{self._index_path}/documents/delete-batch", json=list(ids))
+        return task['taskUid']
+
+    async def get_document(self, doc_id: str):
+        resp = await self._client().get(f"{self._index_path}/documents/{doc_id}")
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.json()
+
+    async def search(self, query: str, params: dict) -> dict:
+        await self.ensure_index()
+        return await self._request('POST', f"{self._index_path}/search", json={'q': query, **params})
+
+    async def fetch_documents(self, body: dict) -> dict:
+        await self.ensure_index()
+        return await self._request('POST', f"{self._index_path}/documents/fetch", json=body)
+
+    async def get_stats(self) -> dict:
+        return await self._request('GET', f"{self._index_path}/stats")
+
+async_client = AsyncSearchClient(MEILI_HOST, MEILI_KEY, INDEX_NAME)
+
+async def ensure_index():
+    await async_client.ensure_index()
+
+async def close():
+    await async_client.close()
+
+async def _wait_succeeded(task_uid: int):
+    """Waits for a task and raises unless it succeeded (failed/canceled tasks still 'finish')."""
+    task = await async_client.wait_for_task(task_uid)
+    if task['status'] != 'succeeded':
+        raise RuntimeError(f"Meilisearch task {task_uid} {task['status']}: {(task.get('error') or {}).get('message')}")
+
+async def index_documents(documents, wait: bool = False):
+    """Queues documents for indexing. Returns the Meilisearch task uid (None on error)."""
+    for doc in documents:
+        doc.setdefault('id_key', id_key(doc['id']))
     try:
-        index = client.index('emails')
-        task = index.add_documents(documents)
-        return task
+        task_uid = await async_client.add_documents(documents)
+        if wait:
+            await _wait_succeeded(task_uid)
+        return task_uid
     except Exception as e:
         print(f"Error indexing documents: {e}")
         return None
 
-def search_documents(query: str, limit: int = 20, filter_query: str = None, offset: int = 0):
-    ensure_index()
+async def update_documents(documents, wait: bool = False):
+    """Sends partial documents ({'id': ..., <fields>}). Returns the task uid (None on error)."""
+    try:
+        task_uid = await async_client.update_documents(documents)
+        if wait:
+            await _wait_succeeded(task_uid)
+        return task_uid
+    except Exception as e:
+        print(f"Error updating documents: {e}")
+        return None
+
+async def existing_ids(ids) -> set:
+    """Which of these document ids are in the index (one filtered search)."""
+    ids = list(ids)
+    if not ids:
+        return set()
+    id_list = ", ".join(json.dumps(i) for i in ids)
+    res = await async_client.search('', {
+        'filter': f"id IN [{id_list}]",
+        'limit': len(ids),
+        'attributesToRetrieve': ['id'],
+    })
+    return {hit['id'] for hit in res.get('hits', [])}
+
+async def delete_documents(ids, wait: bool = False):
+    try:
+        task_uid = await async_client.delete_documents(ids)
+        if wait:
+            await _wait_succeeded(task_uid)
+        return task_uid
+    except Exception as e:
+        print(f"Error deleting documents: {e}")
+        return None
+
+async def get_document(doc_id: str):
+    """Returns the document as a dict, or None if it doesn't exist."""
+    return await async_client.get_document(doc_id)
+
+# --- Cursor Pagination ---
+# Cursor pages are sorted by (date_timestamp desc, id_key asc) with an empty
+# query, so the order is total and independent of ranking. A cursor records
+# the last hit's (date_timestamp, id_key) plus the ids already returned at
+# exactly that pair (only more than one on an id_key collision), and the next
+# page is a numeric range filter on that composite key instead of an offset
+# Meilisearch would have to rank and skip. Documents without a date_timestamp
+# sort after every dated one and are paged the same way, with ts = None.
+
+CURSOR_SORT = ['date_timestamp:desc', 'id_key:asc']
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(hits: list, previous: dict = None):
+    """Builds the opaque cursor for the page after `hits` (None if hits is empty)."""
+    if not hits:
+        return None
+    ts = hits[-1].get('date_timestamp')
+    same_ts = [h for h in hits if h.get('date_timestamp') == ts]
+    carried = (previous['key'], previous['ids']) if previous and previous['ts'] == ts else None
+    key, ids = _next_key(same_ts, carried)
+    raw = json.dumps({'ts': ts, 'key': key, 'ids': ids}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        ts, key, ids = data['ts'], data['key'], data['ids']
+        if (ts is not None and not isinstance(ts, (int, float))) or (key is not None and not isinstance(key, int)):
+            raise ValueError("malformed")
+        if not isinstance(ids, list) or not all(isinstance(i, str) for i in ids):
+            raise ValueError("malformed")
+        return {'ts': ts, 'key': key, 'ids': ids}
+    except Exception as e:
+        raise InvalidCursor(f"Invalid cursor: {e}")
+
+def cursor_filter(position: dict) -> str:
+    after = _after_key(position['key'], position['ids'])
+    if position['ts'] is None:
+        return f"(date_timestamp NOT EXISTS AND {after})"
+    ts = position['ts']
+    return f"(date_timestamp < {ts} OR (date_timestamp = {ts} AND {after}) OR date_timestamp NOT EXISTS)"
+
+async def search_documents(query: str, limit: int = 20, filter_query: str = None, offset: int = 0, cursor: str = None):
+    """
+    Offset pagination by default; pass cursor ("" for the first page) for
+    keyset pagination, which requires an empty query (ranked results have no
+    stable key order). Results always include next_cursor.
+    Raises InvalidCursor for a cursor that can't be decoded or is used with a
+    query. In cursor mode search errors propagate too: an empty page would
+    read as the end of the results.
+    """
+    if cursor is not None and query and query.strip():
+        raise InvalidCursor("Cursor pagination requires an empty query; use offset")
+    position = decode_cursor(cursor) if cursor else None
     try:
-        index = client.index('emails')
         search_params = {
             'limit': limit,
-            'offset': offset,
-            'sort': ['date_timestamp:desc'] # Default sort by newest
+            'offset': 0 if cursor is not None else offset,
+            'sort': CURSOR_SORT if cursor is not None else ['date_timestamp:desc'] # Default sort by newest
         }
-        
-        if filter_query:
-            search_params['filter'] = filter_query
-            
-        return index.search(query, search_params)
+
+        if filter_query and position:
+            search_params['filter'] = f"({filter_query}) AND {cursor_filter(position)}"
+        elif filter_query or position:
+            search_params['filter'] = filter_query or cursor_filter(position)
+
+        results = await async_client.search(query, search_params)
+        hits = results.get('hits', [])
+        results['next_cursor'] = encode_cursor(hits, position) if cursor is not None and len(hits) >= limit else None
+        return results
     except Exception as e:
         print(f"Error searching documents: {e}")
-        return {'hits': []}
+        if cursor is not None:
+            raise
+        return {'hits': [], 'next_cursor': None}
+
+# --- Bulk Iteration ---
+
+async def fetch_documents(filter_query: str = None, fields: list = None, limit: int = 1000, offset: int = 0) -> dict:
+    """One page of POST /documents/fetch (filtered, unranked). Returns {'results', 'total', ...}."""
+    body = {'limit': limit, 'offset': offset}
+    if filter_query:
+        body['filter'] = filter_query
+    if fields:
+        body['fields'] = list(fields)
+    return await async_client.fetch_documents(body)
+
+def _and(*parts) -> str:
+    return " AND ".join(p for p in parts if p) or None
+
+def _after_key(key, ids) -> str:
+    """
+    Documents after position (id_key, ids seen at that id_key) in id_key
+    order; documents without an id_key sort last, so key None is the
+    position inside that (pre-backfill) tail.
+    """
+    seen = f"NOT id IN [{', '.join(json.dumps(i) for i in ids)}]" if ids else None
+    if key is None:
+        return "(" + _and("id_key NOT EXISTS", seen) + ")"
+    same_key = f" OR (id_key = {key} AND {seen})" if seen else ""
+    return f"(id_key > {key}{same_key} OR id_key NOT EXISTS)"
+
+def _next_key(hits: list, previous=None):
+    """(id_key, ids) after the last hit; the ids list only spans one id_key value."""
+    key = hits[-1].get('id_key')
+    ids = [h['id'] for h in hits if h.get('id_key') == key]
+    if previous is not None and previous[0] == key:
+        ids = previous[1] + ids
+    return key, ids
+
+async def _iter_group(filter_query: str, retrieve: list, page_size: int):
+    """
+    Yields every document matching a filter in id_key order, one page at a
+    time: each page is a fresh "after the last key" query, so nothing is
+    held across pages and deletes made by the consumer can't shift them.
+    """
+    position = None
+    while True:
+        params = {
+            'limit': page_size,
+            'sort': ['id_key:asc'],
+            'attributesToRetrieve': retrieve,
+            'filter': _and(filter_query, _after_key(*position) if position is not None else None),
+        }
+        hits = (await async_client.search('', params)).get('hits', [])
+        if hits:
+            yield hits
+        if len(hits) < page_size:
+            break
+        position = _next_key(hits, position)
+
+async def iter_documents(filter_query: str = None, fields: list = None, page_size: int = 1000):
+    """
+    Async generator over every document matching filter_query, in pages of at
+    most page_size dicts holding only `fields` (all fields if None).
+
+    Keyset pagination on date_timestamp (newest first): each page is a fresh
+    "date_timestamp < last" query, so memory and per-page cost stay constant
+    and the consumer may delete what it has been given. Runs of equal
+    timestamps at a page boundary, and documents with no date_timestamp, are
+    paged by id_key within the group. Errors propagate to the caller.
+    """
+    want = list(fields) if fields else None
+    retrieve = sorted(set(want) | {'id', 'date_timestamp', 'id_key'}) if want else ['*']
+    base = f"({filter_query})" if filter_query else None
+
+    def trim(docs):
+        return [{k: d[k] for k in want if k in d} for d in docs] if want else docs
+
+    upper = None
+    while True:
+        params = {
+            'limit': page_size,
+            'sort': ['date_timestamp:desc'],
+            'attributesToRetrieve': retrieve,
+            'filter': _and(base, "date_timestamp EXISTS", f"date_timestamp < {upper}" if upper is not None else None),
+        }
+        hits = (await async_client.search('', params)).get('hits', [])
+        if not hits:
+            break
+        if len(hits) < page_size:
+            yield trim(hits)
+            break
+
+        ts = hits[-1]['date_timestamp']
+        head = [h for h in hits if h['date_timestamp'] != ts]
+        if head:
+            yield trim(head)
+        # The run of documents at `ts` may continue past this page: drain all of it
+        async for page in _iter_group(_and(base, f"date_timestamp = {ts}"), retrieve, page_size):
+            yield trim(page)
+        upper = ts
+
+    # Documents indexed without a date_timestamp
+    async for page in _iter_group(_and(base, "date_timestamp NOT EXISTS"), retrieve, page_size):
+        yield trim(page)
+
+async def backfill_id_keys(batch_size: int = 1000) -> int:
+    """
+    Sets id_key on documents indexed before it existed. Updated documents
+    drop out of the filter, so every round reads the first page again.
+    Returns the number of documents updated.
+    """
+    total = 0
+    while True:
+        res = await fetch_documents("id_key NOT EXISTS", ['id'], batch_size, 0)
+        ids = [d['id'] for d in res.get('results', [])]
+        if not ids:
+            return total
+        # A partial update would re-create a document deleted in the meantime
+        indexed = await existing_ids(ids)
+        ids = [i for i in ids if i in indexed]
+        if ids and await update_documents([{'id': i, 'id_key': id_key(i)} for i in ids], wait=True) is None:
+            raise RuntimeError(f"id_key backfill failed after {total} documents")
+        total += len(ids)
+
+async def run_id_key_backfill():
+    """Startup task: backfill_id_keys with the error logged rather than raised."""
+    try:
+        updated = await backfill_id_keys()
+        if updated:
+            print(f"Backfilled id_key on {updated} documents")
+    except Exception as e:
+        print(f"id_key backfill failed: {e}")
+
+async def count_documents(filter_query: str = None) -> int:
+    """Exact hit count (up to pagination.maxTotalHits) without fetching hits. Raises on error."""
+    params = {'hitsPerPage': 0, 'page': 1}
+    if filter_query:
+        params['filter'] = filter_query
+    res = await async_client.search('', params)
+    return res.get('totalHits', 0)
 
-def get_stats(filter_query: str = None):
-    ensure_index()
+async def get_stats(filter_query: str = None):
     try:
-        index = client.index('emails')
         if filter_query:
             # Perform a search with limit=0 to get count
-            res = index.search('', {'filter': filter_query, 'limit': 0})
+            res = await async_client.search('', {'filter': filter_query, 'limit': 0})
             return {'total_emails': res.get('estimatedTotalHits', 0)}
         else:
-            stats = index.get_stats()
-            return {'total_emails': stats.number_of_documents}
+            stats = await async_client.get_stats()
+            return {'total_emails': stats.get('numberOfDocuments', 0)}
     except Exception as e:
         print(f"Error getting stats: {e}")
         return {'total_emails': 0}
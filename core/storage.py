@@ -1,5 +1,11 @@
+import abc
+import asyncio
 import boto3
+import hashlib
 import os
+import threading
+import uuid
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT", "http://localhost:9000")
@@ -7,68 +13,375 @@ MINIO_ACCESS_KEY = os.getenv("MINIO_ROOT_USER", "admin")
 MINIO_SECRET_KEY = os.getenv("MINIO_ROOT_PASSWORD", "password")
 BUCKET_NAME = "archive-blobs"
 
+# Blob store selection: 's3' (MinIO/S3) or 'local' (sharded directories, single node)
+BLOB_STORE_BACKEND = os.getenv("BLOB_STORE_BACKEND", "s3").lower()
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", "data/blobs")
+BLOB_STORE_CONCURRENCY = int(os.getenv("BLOB_STORE_CONCURRENCY", "16"))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Connection tuning (sync ingest runs up to SYNC_CONCURRENCY uploads at once)
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50"))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", "3"))
+S3_CONNECT_TIMEOUT = float(os.getenv("S3_CONNECT_TIMEOUT", "5"))
+S3_READ_TIMEOUT = float(os.getenv("S3_READ_TIMEOUT", "60"))
+S3_DELETE_BATCH = 1000 # DeleteObjects limit
+
 s3_client = boto3.client(
     's3',
     endpoint_url=MINIO_ENDPOINT,
     aws_access_key_id=MINIO_ACCESS_KEY,
     aws_secret_access_key=MINIO_SECRET_KEY,
+    config=Config(
+        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        connect_timeout=S3_CONNECT_TIMEOUT,
+        read_timeout=S3_READ_TIMEOUT,
+        retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': 'standard'},
+    ),
 )
 
-def ensure_bucket():
-    try:
-        s3_client.head_bucket(Bucket=BUCKET_NAME)
-    except ClientError:
-        s3_client.create_bucket(Bucket=BUCKET_NAME)
+class S3Backend:
+    """
+    Wraps the boto3 client for one bucket. The bucket is checked once and the
+    result cached; it is only re-checked after a NoSuchBucket error, so hot
+    paths cost a single round trip.
+    """
+    def __init__(self, client, bucket: str):
+        self.client = client
+        self.bucket = bucket
+        self._bucket_ready = False
+        self._lock = threading.Lock()
+
+    def ensure_bucket(self, force: bool = False):
+        if self._bucket_ready and not force:
+            return
+        with self._lock:
+            if self._bucket_ready and not force:
+                return
+            try:
+                self.client.head_bucket(Bucket=self.bucket)
+            except ClientError:
+                self.client.create_bucket(Bucket=self.bucket)
+            self._bucket_ready = True
+
+    def _call(self, method, **kwargs):
+        self.ensure_bucket()
+        try:
+            return method(Bucket=self.bucket, **kwargs)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchBucket':
+                raise
+            # Bucket vanished (e.g. fresh MinIO volume): recreate once and retry
+            self._bucket_ready = False
+            self.ensure_bucket(force=True)
+            return method(Bucket=self.bucket, **kwargs)
+
+    def put(self, key: str, data: bytes):
+        self._call(self.client.put_object, Key=key, Body=data)
+
+    def get(self, key: str) -> bytes:
+        return self._call(self.client.get_object, Key=key)['Body'].read()
+
+    def delete(self, key: str):
+        self._call(self.client.delete_object, Key=key)
+
+    def delete_batch(self, keys: list) -> list:
+        """One DeleteObjects call (max 1000 keys). Returns the keys that failed."""
+        resp = self._call(self.client.delete_objects, Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True})
+        return [e['Key'] for e in resp.get('Errors', [])]
+
+    def exists(self, key: str) -> bool:
+        try:
+            self._call(self.client.head_object, Key=key)
+            return True
+        except ClientError:
+            return False
+
+    def list_pages(self, prefix: str = ""):
+        self.ensure_bucket()
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            yield [(obj['Key'], obj['Size']) for obj in page.get('Contents', [])]
+
+backend = S3Backend(s3_client, BUCKET_NAME)
 
 import encryption
 
+def _decode_blob(raw_data: bytes) -> bytes:
+    """Master-key decrypt if the blob was stored encrypted, else return as-is (legacy plaintext)."""
+    decrypted = encryption.decrypt_data(raw_data)
+    if decrypted is not None:
+        return decrypted
+    return raw_data
+
+class BlobStore(abc.ABC):
+    """
+    Async blob storage interface used by the API and workers.
+    get/batch_get return decoded bytes (None when missing); stream_get yields
+    the stored bytes in chunks; put/delete return True on success.
+    """
+    @abc.abstractmethod
+    async def get_raw(self, key: str):
+        ...
+
+    @abc.abstractmethod
+    async def put(self, key: str, data: bytes) -> bool:
+        ...
+
+    @abc.abstractmethod
+    async def delete(self, key: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    async def exists(self, key: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def stream_get(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE):
+        """Async generator of chunks of the stored bytes."""
+
+    @abc.abstractmethod
+    def list_pages(self, prefix: str = ""):
+        """Async generator of pages of (key, size)."""
+
+    async def ensure_ready(self):
+        pass
+
+    async def get(self, key: str):
+        raw_data = await self.get_raw(key)
+        if raw_data is None:
+            return None
+        return _decode_blob(raw_data)
+
+    async def delete_many(self, keys, concurrency: int = BLOB_STORE_CONCURRENCY) -> list:
+        """Deletes many keys concurrently. Returns the keys that could not be deleted."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def remove(key):
+            async with semaphore:
+                return None if await self.delete(key) else key
+
+        return [k for k in await asyncio.gather(*[remove(k) for k in keys]) if k is not None]
+
+    async def batch_get(self, keys, concurrency: int = BLOB_STORE_CONCURRENCY) -> dict:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(key):
+            async with semaphore:
+                return key, await self.get(key)
+
+        return dict(await asyncio.gather(*[fetch(k) for k in dict.fromkeys(keys)]))
+
+class S3BlobStore(BlobStore):
+    """
+    S3/MinIO store. boto3 calls run in worker threads against the shared,
+    pooled S3Backend client so they never block the event loop.
+    """
+    def __init__(self, s3_backend: S3Backend):
+        self.backend = s3_backend
+
+    async def ensure_ready(self):
+        await asyncio.to_thread(self.backend.ensure_bucket)
+
+    async def get_raw(self, key: str):
+        try:
+            return await asyncio.to_thread(self.backend.get, key)
+        except Exception as e:
+            print(f"Error getting blob: {e}")
+            return None
+
+    async def put(self, key: str, data: bytes) -> bool:
+        try:
+            await asyncio.to_thread(self.backend.put, key, data)
+            return True
+        except Exception as e:
+            print(f"Error uploading blob: {e}")
+            return False
+
+    async def delete(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(self.backend.delete, key)
+            return True
+        except Exception as e:
+            print(f"Error deleting blob: {e}")
+            return False
+
+    async def exists(self, key: str) -> bool:
+        return await asyncio.to_thread(self.backend.exists, key)
+
+    async def delete_many(self, keys, concurrency: int = BLOB_STORE_CONCURRENCY) -> list:
+        """DeleteObjects in chunks of S3_DELETE_BATCH keys, chunks sent in parallel."""
+        keys = list(keys)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def remove(chunk):
+            async with semaphore:
+                try:
+                    return await asyncio.to_thread(self.backend.delete_batch, chunk)
+                except Exception as e:
+                    print(f"Error deleting blobs: {e}")
+                    return chunk
+
+        chunks = [keys[i:i + S3_DELETE_BATCH] for i in range(0, len(keys), S3_DELETE_BATCH)]
+        return [k for failed in await asyncio.gather(*[remove(c) for c in chunks]) for k in failed]
+
+    async def stream_get(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE):
+        response = await asyncio.to_thread(self.backend._call, self.backend.client.get_object, Key=key)
+        chunks = response['Body'].iter_chunks(chunk_size)
+        try:
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            response['Body'].close()
+
+    async def list_pages(self, prefix: str = ""):
+        pages = self.backend.list_pages(prefix)
+        while True:
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                break
+            yield page
+
+class LocalBlobStore(BlobStore):
+    """
+    Filesystem store for single-node deployments and benchmarks. Keys are
+    sharded two levels deep by a hash of the key (ab/cd/<key>) and written
+    via temp file + fsync + rename, so readers never see partial blobs.
+    """
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key: str) -> str:
+        if not key or '/' in key or '\\' in key or key.startswith('.'):
+            raise ValueError(f"Invalid blob key: {key!r}")
+        shard = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, shard[:2], shard[2:4], key)
+
+    async def ensure_ready(self):
+        await asyncio.to_thread(os.makedirs, self.root, exist_ok=True)
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def get_raw(self, key: str):
+        try:
+            return await asyncio.to_thread(self._read, self._path(key))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Error getting blob: {e}")
+            return None
+
+    async def put(self, key: str, data: bytes) -> bool:
+        try:
+            await asyncio.to_thread(self._write, self._path(key), data)
+            return True
+        except Exception as e:
+            print(f"Error uploading blob: {e}")
+            return False
+
+    async def delete(self, key: str) -> bool:
+        try:
+            await asyncio.to_thread(os.remove, self._path(key))
+            return True
+        except FileNotFoundError:
+            return True
+        except Exception as e:
+            print(f"Error deleting blob: {e}")
+            return False
+
+    async def exists(self, key: str) -> bool:
+        return await asyncio.to_thread(os.path.exists, self._path(key))
+
+    async def stream_get(self, key: str, chunk_size: int = STREAM_CHUNK_SIZE):
+        f = await asyncio.to_thread(open, self._path(key), 'rb')
+        try:
+            while True:
+                chunk = await asyncio.to_thread(f.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            f.close()
+
+    def _scan_pages(self, prefix: str, page_size: int = 1000):
+        page = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.tmp') or not name.startswith(prefix):
+                    continue
+                page.append((name, os.path.getsize(os.path.join(dirpath, name))))
+                if len(page) >= page_size:
+                    yield page
+                    page = []
+        if page:
+            yield page
+
+    async def list_pages(self, prefix: str = ""):
+        pages = self._scan_pages(prefix)
+        while True:
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                break
+            yield page
+
+def create_blob_store() -> BlobStore:
+    if BLOB_STORE_BACKEND == "local":
+        return LocalBlobStore(BLOB_STORE_PATH)
+    if BLOB_STORE_BACKEND != "s3":
+        raise ValueError(f"Unknown BLOB_STORE_BACKEND '{BLOB_STORE_BACKEND}' (expected 's3' or 'local')")
+    return S3BlobStore(backend)
+
+blob_store = create_blob_store()
+
+# --- Synchronous S3 helpers (used by scripts/; the API and workers use blob_store) ---
+
+def ensure_bucket():
+    backend.ensure_bucket()
+
 def upload_blob(object_name, data):
-    ensure_bucket()
     try:
         # Encrypt before upload
         # encrypted = encryption.encrypt_data(data)
         # DISABLE SSE due to double-encryption issues
-        s3_client.put_object(
-            Bucket=BUCKET_NAME,
-            Key=object_name,
-            Body=data
-        )
+        backend.put(object_name, data)
         return True
     except Exception as e:
         print(f"Error uploading blob: {e}")
         return False
 
 def get_blob(object_name):
-    ensure_bucket()
     try:
-        response = s3_client.get_object(Bucket=BUCKET_NAME, Key=object_name)
-        raw_data = response['Body'].read()
-        
-        # Try Decrypt
-        decrypted = encryption.decrypt_data(raw_data)
-        if decrypted is not None:
-            return decrypted
-        
-        # Fallback for legacy plaintext (optional, for transition)
-        return raw_data
-        
+        return _decode_blob(backend.get(object_name))
+
     except Exception as e:
         print(f"Error getting blob: {e}")
         return None
 
 def delete_blob(object_name):
-    ensure_bucket()
     try:
-        s3_client.delete_object(Bucket=BUCKET_NAME, Key=object_name)
+        backend.delete(object_name)
         return True
     except Exception as e:
         print(f"Error deleting blob: {e}")
         return False
 
 def blob_exists(object_name):
-    ensure_bucket()
-    try:
-        s3_client.head_object(Bucket=BUCKET_NAME, Key=object_name)
-        return True
-    except ClientError:
-        return False
+    return backend.exists(object_name)
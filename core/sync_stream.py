@@ -0,0 +1,99 @@
+import asyncio
+import json
+import os
+import struct
+
+# Binary framing for /api/v1/sync/stream (mirrored in sidecar/sync.py).
+# Every frame is: 1 byte type | 4 byte big-endian length | payload.
+# A MESSAGE or CAS frame (JSON metadata) is always followed by one BLOB frame
+# carrying the raw bytes, so blobs never go through base64 or JSON.
+FRAME_MESSAGE = 1   # {"id": ..., "key": ..., "metadata": {...}}
+FRAME_CAS = 2       # {"hash": ...}
+FRAME_BLOB = 3      # raw blob bytes
+FRAME_HEADER = struct.Struct(">BI")
+
+MAX_FRAME_SIZE = int(os.getenv("SYNC_STREAM_MAX_FRAME_BYTES", str(64 * 1024 * 1024)))
+# Blob bytes one stream may hold in memory across its in-flight uploads
+MAX_BUFFERED_BYTES = int(os.getenv("SYNC_STREAM_MAX_BUFFERED_BYTES", str(128 * 1024 * 1024)))
+
+class FrameError(ValueError):
+    pass
+
+class FrameReader:
+    """
+    Pulls frames off an async iterator of byte chunks (e.g. Request.stream()).
+    Only the frame currently being read is buffered.
+    """
+    def __init__(self, chunks):
+        self._chunks = chunks.__aiter__()
+        self._buf = bytearray()
+        self._eof = False
+
+    async def _fill(self, n: int) -> bool:
+        while len(self._buf) < n and not self._eof:
+            try:
+                self._buf += await self._chunks.__anext__()
+            except StopAsyncIteration:
+                self._eof = True
+        return len(self._buf) >= n
+
+    async def _take(self, n: int) -> bytes:
+        if not await self._fill(n):
+            raise FrameError("Stream ended mid-frame")
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+        return data
+
+    async def read_header(self):
+        """Returns (frame_type, length) or None at a clean end of stream."""
+        if not await self._fill(FRAME_HEADER.size):
+            if self._buf:
+                raise FrameError("Truncated frame header")
+            return None
+        ftype, length = FRAME_HEADER.unpack(await self._take(FRAME_HEADER.size))
+        if ftype not in (FRAME_MESSAGE, FRAME_CAS, FRAME_BLOB):
+            raise FrameError(f"Unknown frame type {ftype}")
+        if length > MAX_FRAME_SIZE:
+            raise FrameError(f"Frame of {length} bytes exceeds limit")
+        return ftype, length
+
+    async def read_body(self, length: int) -> bytes:
+        return await self._take(length)
+
+    async def read_metadata(self, length: int) -> dict:
+        meta = json.loads(await self.read_body(length))
+        if not isinstance(meta, dict):
+            raise FrameError("Metadata frame is not a JSON object")
+        return meta
+
+    async def expect_blob_header(self) -> int:
+        """Reads the blob frame header that must follow metadata. Returns the blob length."""
+        header = await self.read_header()
+        if header is None or header[0] != FRAME_BLOB:
+            raise FrameError("Metadata frame not followed by a blob frame")
+        return header[1]
+
+    async def expect_blob(self) -> bytes:
+        return await self.read_body(await self.expect_blob_header())
+
+class ByteBudget:
+    """Counts bytes held by in-flight uploads; acquire waits until they fit."""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._cond = asyncio.Condition()
+
+    def _cost(self, nbytes: int) -> int:
+        # A single frame larger than the budget still passes, on its own
+        return min(nbytes, self.limit)
+
+    async def acquire(self, nbytes: int):
+        cost = self._cost(nbytes)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used + cost <= self.limit)
+            self.used += cost
+
+    async def release(self, nbytes: int):
+        async with self._cond:
+            self.used -= self._cost(nbytes)
+            self._cond.notify_all()
@@ -1,22 +1,22 @@
 import search
 
-def get_thread(message_id: str, org_id: int):
+async def get_thread(message_id: str, org_id: int):
     """
     Finds all messages in the same conversation as message_id, scoped by org_id.
     """
     # 1. Get the starting message
-    index = search.client.index('emails')
     try:
-        doc = index.get_document(message_id)
+        doc = await search.get_document(message_id)
+        if doc is None:
+            return []
         
         # Verify org
-        doc_org_id = getattr(doc, 'org_id', None) or doc.get('org_id')
+        doc_org_id = doc.get('org_id')
         if doc_org_id != org_id:
             return []
 
-        # Attribute access for meilisearch client compatibility
-        msg_id = getattr(doc, 'message_id', None) or doc.get('message_id')
-        refs = getattr(doc, 'references', None) or doc.get('references')
+        msg_id = doc.get('message_id')
+        refs = doc.get('references')
         
         # Build filter query
         # We want all messages where (org_id match) AND (thread match)
@@ -39,7 +39,7 @@ def get_thread(message_id: str, org_id: int):
         combined_filter = f"(org_id = {org_id}) AND ({' OR '.join(thread_filters)})"
         
         # Search for everything in this thread
-        results = search.search_documents(query="", filter_query=combined_filter, limit=100)
+        results = await search.search_documents(query="", filter_query=combined_filter, limit=100)
         
         # Sort by date
         hits = results.get('hits', [])
@@ -29,9 +29,7 @@ EMAILS_PER_DOMAIN = 20
 
 async def main():
     print("Connecting to DB...")
-    conn = await database.get_db_connection()
-    
-    try:
+    async with database.connection() as conn:
         # 1. Create Organizations & Domains
         orgs = []
         domains_pool = [f"domain{i}.com" for i in range(1, DOMAINS_TOTAL + 1)]
@@ -139,11 +137,8 @@ async def main():
         
         # Batch Indexing
         if documents:
-            search.index_documents(documents)
+            await search.index_documents(documents)
             print(f"Indexed {len(documents)} emails to MeiliSearch.")
-        
-    finally:
-        await conn.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
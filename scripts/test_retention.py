@@ -23,7 +23,7 @@ async def main():
     # domain1.com is in Org 8.
     # I can use Meili directly or API.
     query = "domains = 'domain1.com'"
-    s1 = search.get_stats(filter_query=query)
+    s1 = await search.get_stats(filter_query=query)
     count_initial = s1['total_emails']
     print(f"Initial Emails for domain1.com: {count_initial}")
     
@@ -69,7 +69,7 @@ async def main():
     # Refresh index stats might take a moment?
     # Ensure index.
     
-    s2 = search.get_stats(filter_query=query)
+    s2 = await search.get_stats(filter_query=query)
     count_after = s2['total_emails']
     print(f"Emails for domain1.com AFTER purge: {count_after}")
     
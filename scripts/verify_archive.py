@@ -47,8 +47,7 @@ async def verify_messages():
 
 async def verify_audit_chain():
     print("\n--- Verifying Audit Log Chain ---")
-    conn = await database.get_db_connection()
-    try:
+    async with database.connection() as conn:
         rows = await conn.fetch("SELECT id, username, action, details, previous_hash, current_hash FROM audit_logs ORDER BY id ASC")
         
         last_hash = "ROOT_HASH"
@@ -75,8 +74,6 @@ async def verify_audit_chain():
             
         print(f"Audit Chain: VERIFIED ({len(rows)} entries)")
         return True
-    finally:
-        await conn.close()
 
 async def main():
     m_ok = await verify_messages()
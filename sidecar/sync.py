@@ -5,6 +5,7 @@ import json
 import base64
 import base64
 import os
+import struct
 # from dotenv import load_dotenv
 # load_dotenv()
 from buffer import get_pending_messages, mark_synced, get_pending_cas, mark_cas_synced
@@ -19,6 +20,42 @@ CORE_CAS_CHECK_URL = CORE_API_URL.replace("/sync", "/cas/check")
 CORE_CAS_UPLOAD_URL = CORE_API_URL.replace("/sync", "/cas/upload")
 API_KEY = os.getenv("CORE_API_KEY", "secret")
 ORG_ID = os.getenv("AGENT_ORG_ID", "1")
+CORE_STREAM_URL = CORE_API_URL + "/stream"
+# 'json' = base64 batches to /sync (default), 'stream' = binary frames to
+# /sync/stream (opt-in; needs a core that serves the stream endpoint)
+SYNC_TRANSPORT = os.getenv("SYNC_TRANSPORT", "json")
+
+# Binary framing (mirrors core/sync_stream.py): 1 byte type | 4 byte length | payload
+FRAME_MESSAGE = 1
+FRAME_CAS = 2
+FRAME_BLOB = 3
+FRAME_HEADER = struct.Struct(">BI")
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _frame(ftype, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(ftype, len(payload)) + payload
+
+def _blob_frame_chunks(path):
+    """Yields a blob frame straight from disk, never holding the whole file."""
+    yield FRAME_HEADER.pack(FRAME_BLOB, os.path.getsize(path))
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+async def stream_frames(cas_rows, message_rows):
+    """Request body for /sync/stream: CAS blobs first, then message blobs."""
+    for row in cas_rows:
+        yield _frame(FRAME_CAS, json.dumps({"hash": row['hash']}).encode('utf-8'))
+        for chunk in _blob_frame_chunks(row['storage_path']):
+            yield chunk
+    for row in message_rows:
+        meta = {"id": row["id"], "key": row["key"], "metadata": json.loads(row["metadata"])}
+        yield _frame(FRAME_MESSAGE, json.dumps(meta).encode('utf-8'))
+        for chunk in _blob_frame_chunks(row["storage_path"]):
+            yield chunk
 
 async def sync_loop():
     logger.info(f"Starting Sync Loop... [Agent Org ID: {ORG_ID}]")
@@ -49,7 +86,19 @@ async def sync_loop():
                              continue
 
                     # 2. Upload Missing
-                    if to_upload:
+                    if to_upload and SYNC_TRANSPORT == "stream":
+                        upload_rows = [row for row in pending_cas if row['hash'] in to_upload]
+                        async with session.post(
+                            CORE_STREAM_URL,
+                            data=stream_frames(upload_rows, []),
+                            headers={"X-API-Key": API_KEY, "X-Org-ID": ORG_ID, "Content-Type": "application/octet-stream"}
+                        ) as resp:
+                            body = await resp.json() if resp.status == 200 else {}
+                            if resp.status != 200 or not all(r.get("ok") for r in body.get("cas_results", [])):
+                                logger.error(f"CAS Upload Failed: {resp.status}")
+                                await asyncio.sleep(5)
+                                continue
+                    elif to_upload:
                         cas_batch = []
                         for row in pending_cas:
                             if row['hash'] in to_upload:
@@ -82,30 +131,48 @@ async def sync_loop():
                 logger.info(f"📤 SYNCING {len(pending)} MESSAGES | Org ID: {ORG_ID} | IDs: {msg_ids}")
                 
                 # 2. Prepare Batch
-                batch = []
-                for row in pending:
-                    # Read encrypted blob
-                    with open(row["storage_path"], "rb") as f:
-                        blob = f.read()
-                        
-                    batch.append({
-                        "id": row["id"],
-                        "key": row["key"],
-                        "metadata": json.loads(row["metadata"]),
-                        "blob_b64": base64.b64encode(blob).decode('utf-8')
-                    })
+                if SYNC_TRANSPORT == "stream":
+                    # Blobs are streamed from disk as raw frames (no base64, no full-batch buffer)
+                    request_kwargs = {
+                        "url": CORE_STREAM_URL,
+                        "data": stream_frames([], pending),
+                        "headers": {"X-API-Key": API_KEY, "X-Org-ID": ORG_ID, "Content-Type": "application/octet-stream"}
+                    }
+                else:
+                    batch = []
+                    for row in pending:
+                        # Read encrypted blob
+                        with open(row["storage_path"], "rb") as f:
+                            blob = f.read()
+                            
+                        batch.append({
+                            "id": row["id"],
+                            "key": row["key"],
+                            "metadata": json.loads(row["metadata"]),
+                            "blob_b64": base64.b64encode(blob).decode('utf-8')
+                        })
+                    request_kwargs = {
+                        "url": CORE_API_URL,
+                        "json": {"batch": batch},
+                        "headers": {"X-API-Key": API_KEY, "X-Org-ID": ORG_ID}
+                    }
                 
                 # 3. Send to Core
-                async with session.post(
-                    CORE_API_URL, 
-                    json={"batch": batch},
-                    headers={"X-API-Key": API_KEY, "X-Org-ID": ORG_ID}
-                ) as resp:
+                async with session.post(**request_kwargs) as resp:
                     if resp.status == 200:
-                        logger.info(f"✅ BATCH SYNCED SUCCESSFULLY | Sent {len(batch)} messages.")
-                        # 4. Mark as Synced
-                        for item in batch:
-                            await mark_synced(item["id"])
+                        body = await resp.json()
+                        # 4. Mark as Synced (only items Core confirmed; the rest retry next loop)
+                        results = body.get("results")
+                        if results is None:
+                            synced_ids = msg_ids
+                        else:
+                            synced_ids = [r["id"] for r in results if r.get("ok")]
+                            for r in results:
+                                if not r.get("ok"):
+                                    logger.warning(f"Core rejected {r['id']}: {r.get('error')}")
+                        for mid in synced_ids:
+                            await mark_synced(mid)
+                        logger.info(f"✅ BATCH SYNCED | Sent {len(pending)} messages, {len(synced_ids)} confirmed.")
                     else:
                         logger.error(f"Sync failed: {resp.status} - {await resp.text()}")
                         await asyncio.sleep(10) # Backoff